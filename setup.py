@@ -49,4 +49,10 @@ setup(name='zope.xmlpickle',
           ],
       include_package_data = True,
       zip_safe = False,
+      entry_points = {
+          'console_scripts': [
+              'xmlpickle-benchmark = zope.xmlpickle.benchmark:main',
+              'xmlpickle-convert = zope.xmlpickle.convert:main',
+              ],
+          },
       )
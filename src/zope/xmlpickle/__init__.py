@@ -13,12 +13,24 @@
 ##############################################################################
 """Utility for creating Python pickles in XML format.
 
-The zope.xmlpickle package exports two functions:
+The zope.xmlpickle package exports these functions:
 
   dumps(object) -- Returns an XML pickle
 
+  dump(object, file) -- Writes an XML pickle to a file
+
   loads(xmlpickle) -- Returns an object loaded from the pickle.
 
+  load(file) -- Returns an object loaded from a pickle read from a file
+
 """
-from xmlpickle import dumps, loads
-from xmlpickle import fromxml, toxml
+from xmlpickle import dump, dumps, iter_dumps, load, loads
+from xmlpickle import fromxml, fromxml_file, iter_toxml, toxml, toxml_to
+from xmlpickle import map_file
+from streamindex import StreamIndex
+from stats import Stats
+from batch import dumps_many, loads_many
+from transcoder import transcode
+from registry import register, unregister
+from query import select
+from cache import FragmentCache
@@ -0,0 +1,100 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Convert many independent objects at once
+
+dumps_many and loads_many are like calling dumps or loads for each of
+a sequence of objects or XML strings, and return the results in
+order:
+
+>>> xml = dumps_many([1, 'spam', [2.5]])
+>>> loads_many(xml)
+[1, 'spam', [2.5]]
+
+Given more than one process, or a pool, they spread the work over
+several processes.  The items are sent to the processes in chunks, so
+that small items don't each cost a round trip:
+
+>>> obs = range(100)
+>>> loads_many(dumps_many(obs, processes=2), processes=2) == obs
+True
+
+"""
+
+import multiprocessing
+
+from zope.xmlpickle.xmlpickle import dumps, loads
+
+
+def _dumps_chunk(chunk):
+    return [dumps(ob) for ob in chunk]
+
+def _loads_chunk(chunk):
+    return [loads(xml) for xml in chunk]
+
+
+def _chunks(items, size):
+    return [items[i:i+size] for i in xrange(0, len(items), size)]
+
+
+def _map(func, items, processes, chunk_size, pool):
+    items = list(items)
+    if pool is None:
+        if processes is None:
+            processes = 1
+        if processes <= 1 or len(items) < 2:
+            return func(items)
+    elif processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if chunk_size is None:
+        # A few chunks per process, so that the processes finish
+        # together even if some chunks take longer than others
+        chunk_size = len(items) // (processes * 4) + 1
+
+    if pool is None:
+        pool = multiprocessing.Pool(processes)
+        try:
+            chunks = pool.map(func, _chunks(items, chunk_size))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        chunks = pool.map(func, _chunks(items, chunk_size))
+
+    result = []
+    for chunk in chunks:
+        result.extend(chunk)
+    return result
+
+
+def dumps_many(obs, processes=None, chunk_size=None, pool=None):
+    """Return a list of the XML pickles of objects
+
+    By default, the objects are pickled in this process.  If processes
+    is more than one, they are pickled by a multiprocessing pool of
+    that many processes, which is created for the call.  A pool, or
+    anything else with a map(func, iterable) method such as a
+    concurrent.futures executor, can be given to use instead.  The
+    objects are sent to the processes in lists of chunk_size; by
+    default there are about four lists per process.
+    """
+    return _map(_dumps_chunk, obs, processes, chunk_size, pool)
+
+
+def loads_many(xmls, processes=None, chunk_size=None, pool=None):
+    """Return a list of the objects loaded from XML pickles
+
+    The arguments are as for dumps_many.
+    """
+    return _map(_loads_chunk, xmls, processes, chunk_size, pool)
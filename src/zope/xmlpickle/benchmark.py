@@ -0,0 +1,664 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks for zope.xmlpickle
+
+Run them with::
+
+  python -m zope.xmlpickle.benchmark
+
+or the xmlpickle-benchmark script.  The suite times dumps, loads,
+toxml and fromxml, and cPickle for comparison, on several kinds of
+data.  Results can be saved and compared with those of an earlier run::
+
+  xmlpickle-benchmark --save before.json
+  ... change something ...
+  xmlpickle-benchmark --compare before.json
+
+The --sections option runs the comparisons of new implementations
+with the ones they replaced instead.
+
+"""
+
+import cPickle
+import gc
+import optparse
+import os
+import sys
+import time
+from cStringIO import StringIO
+from xml.parsers import expat
+
+try:
+    import json
+except ImportError:
+    json = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from zope.xmlpickle import batch, ppml, xmlpickle
+from zope.xmlpickle.streamindex import StreamIndex
+
+
+class Record(object):
+
+    def __init__(self, i):
+        self.name = 'record%d' % i
+        self.value = i
+        self.tags = ('spam', 'eggs')
+        self.parent = None
+
+
+class ClassicRecord:
+
+    def __init__(self, i):
+        self.name = 'classic%d' % i
+        self.ratio = i / 7.0
+
+
+def wide_dict(n=20000):
+    """A dictionary with many identifier keys and small values"""
+    return dict(('key%d' % i, [i, str(i) * 3, {'x': i * 1.5}])
+                for i in range(n))
+
+def object_graph(n=5000):
+    """Many small instances that refer to each other"""
+    records = [Record(i) for i in range(n)]
+    for i, record in enumerate(records):
+        if i:
+            record.parent = records[i // 2]
+        record.classic = ClassicRecord(i)
+    return records
+
+def object_tree(n=5000):
+    """Many small instances that aren't shared
+
+    XML pickles of new-style instances lose their ids, so shared
+    instances can't be loaded back.
+    """
+    records = [Record(i) for i in range(n)]
+    for i, record in enumerate(records):
+        record.classic = ClassicRecord(i)
+    return records
+
+workloads = [
+    ('wide dict', wide_dict),
+    ('object graph', object_graph),
+    ]
+
+load_workloads = [
+    ('wide dict', wide_dict),
+    ('object tree', object_tree),
+    ]
+
+
+def dumps_via_pickle(ob):
+    """Serialize ob the way dumps() did before ToXMLPickler"""
+    p = xmlpickle._dumpsUsing_PicklerThatSortsDictItems(ob, 1)
+    return xmlpickle.toxml(p)
+
+
+def loads_via_pickle(xml):
+    """Load XML the way loads() did before XMLUnpickler"""
+    return cPickle.loads(xmlpickle.fromxml(xml))
+
+
+def best_of(func, arg, repeat=3):
+    """Return the best time of several calls and the last result
+
+    As with timeit, garbage collection is off while func runs.
+    """
+    best = None
+    for i in range(repeat):
+        gc.disable()
+        try:
+            start = time.time()
+            result = func(arg)
+            elapsed = time.time() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_dumps(repeat=3):
+    print 'dumps: pickle + toxml vs. direct'
+    for name, make in workloads:
+        ob = make()
+        old, old_xml = best_of(dumps_via_pickle, ob, repeat)
+        new, new_xml = best_of(xmlpickle.dumps, ob, repeat)
+        if old_xml != new_xml:
+            raise AssertionError("Output differs for %s" % name)
+        print '  %-14s %8d bytes  %7.3fs  %7.3fs  %5.1fx' % (
+            name, len(new_xml), old, new, old / new)
+
+
+def dumps_not_canonical(ob):
+    return xmlpickle.dumps(ob, canonical=False)
+
+
+def bench_canonical(repeat=3):
+    print 'dumps: canonical vs. not (MB of XML per second)'
+    for name, make in workloads:
+        ob = make()
+        old, xml = best_of(xmlpickle.dumps, ob, repeat)
+        new, new_xml = best_of(dumps_not_canonical, ob, repeat)
+        mb = len(xml) / 1e6
+        print '  %-14s %8d bytes  %7.1f MB/s  %7.1f MB/s  %5.2fx' % (
+            name, len(xml), mb / old, mb / new, old / new)
+
+
+def bench_loads(repeat=3):
+    print 'loads: fromxml + cPickle.loads vs. direct'
+    for name, make in load_workloads:
+        xml = xmlpickle.dumps(make())
+        old, old_ob = best_of(loads_via_pickle, xml, repeat)
+        new, new_ob = best_of(xmlpickle.loads, xml, repeat)
+        if xmlpickle.dumps(old_ob) != xmlpickle.dumps(new_ob):
+            raise AssertionError("Objects differ for %s" % name)
+        print '  %-14s %8d bytes  %7.3fs  %7.3fs  %5.1fx' % (
+            name, len(xml), old, new, old / new)
+
+
+def bench_fromxml(repeat=5):
+    print 'fromxml: protocol 1 vs. 2 pickle size and cPickle.loads time'
+    for name, make in load_workloads:
+        xml = xmlpickle.dumps(make())
+        p1 = xmlpickle.fromxml(xml)
+        p2 = xmlpickle.fromxml(xml, protocol=2)
+        old, old_ob = best_of(cPickle.loads, p1, repeat)
+        new, new_ob = best_of(cPickle.loads, p2, repeat)
+        if xmlpickle.dumps(old_ob) != xmlpickle.dumps(new_ob):
+            raise AssertionError("Objects differ for %s" % name)
+        print '  %-14s %8d bytes  %8d bytes  %7.3fs  %7.3fs  %5.1fx' % (
+            name, len(p1), len(p2), old, new, old / new)
+
+
+def small_scalars(n=100000):
+    """Many elements with little text each"""
+    return [(i, i * 0.5, 'x%d' % i, None) for i in range(n)]
+
+dense_workloads = [
+    ('wide dict', wide_dict),
+    ('object tree', object_tree),
+    ('small scalars', small_scalars),
+    ]
+
+
+def fromxml_untuned(xml):
+    """fromxml() with expat's default settings, as it used to parse"""
+    handler = ppml.xmlPickler()
+    parser = expat.ParserCreate()
+    parser.CharacterDataHandler = handler.handle_data
+    parser.StartElementHandler = handler.handle_starttag
+    parser.EndElementHandler = handler.handle_endtag
+    parser.Parse(xml, True)
+    return handler.get_value()
+
+
+def bench_fromxml_parser(repeat=3):
+    print 'fromxml: default vs. tuned expat settings (elements per second)'
+    for name, make in dense_workloads:
+        xml = xmlpickle.dumps(make())
+        elements = xml.count('<') - xml.count('</') - 1
+        old, old_p = best_of(fromxml_untuned, xml, repeat)
+        new, new_p = best_of(xmlpickle.fromxml, xml, repeat)
+        if old_p != new_p:
+            raise AssertionError("Output differs for %s" % name)
+        print '  %-14s %8d elements  %9.0f/s  %9.0f/s  %5.2fx' % (
+            name, elements, elements / old, elements / new, old / new)
+
+
+def dumps_compact(ob):
+    return xmlpickle.dumps(ob, pretty=False)
+
+
+def bench_compact(repeat=3):
+    print 'dumps, loads and fromxml: pretty vs. compact XML'
+    for name, make in [('deep nesting', deep_nesting)] + load_workloads:
+        ob = make()
+        old, xml = best_of(xmlpickle.dumps, ob, repeat)
+        new, compact = best_of(dumps_compact, ob, repeat)
+        print '  %-14s %8d bytes  %8d bytes  %5.1f%% smaller' % (
+            name, len(xml), len(compact),
+            100.0 * (len(xml) - len(compact)) / len(xml))
+        print '  %14s %-7s %7.3fs  %7.3fs  %5.2fx' % (
+            '', 'dumps', old, new, old / new)
+        for func in xmlpickle.loads, xmlpickle.fromxml:
+            old, r = best_of(func, xml, repeat)
+            new, r = best_of(func, compact, repeat)
+            print '  %14s %-7s %7.3fs  %7.3fs  %5.2fx' % (
+                '', func.__name__, old, new, old / new)
+
+
+def record_stream(n=300):
+    """Pickles of records, with one memo, as in a transaction log"""
+    f = StringIO()
+    pickler = cPickle.Pickler(f, 1)
+    records = object_graph(n)
+    for record in records:
+        pickler.dump(record)
+    return n, f.getvalue()
+
+
+def toxml_each(stream):
+    n, p = stream
+    return [xmlpickle.toxml(p, i) for i in range(n)]
+
+
+def bench_iter_toxml():
+    print 'iter_toxml: toxml(p, i) for each pickle vs. one pass'
+    stream = record_stream()
+    old, old_xmls = best_of(toxml_each, stream, 1)
+    new, new_xmls = best_of(list, xmlpickle.iter_toxml(stream[1]), 1)
+    if old_xmls != new_xmls:
+        raise AssertionError("Output differs for the record stream")
+    print '  %-14s %8d pickles  %7.3fs  %7.3fs  %5.1fx' % (
+        'records', stream[0], old, new, old / new)
+
+
+def bench_stream_index():
+    print 'StreamIndex: toxml(p, i) for the last pickle vs. with an index'
+    n, p = record_stream(3000)
+    i = n - 1
+    start = time.time()
+    index = StreamIndex.build(p)
+    built = time.time() - start
+    old, old_xml = best_of(lambda p: xmlpickle.toxml(p, i), p)
+    new, new_xml = best_of(lambda p: index.toxml(p, i), p)
+    if old_xml != new_xml:
+        raise AssertionError("Output differs for the record stream")
+    print '  %-14s %8d pickles  %7.3fs  %7.5fs  %5.0fx  (index %.3fs)' % (
+        'records', n, old, new, old / new, built)
+
+
+def bench_batch(repeat=3, processes=(1, 2, 4)):
+    print 'dumps_many and loads_many: items per second by processes'
+    obs = object_tree(20000)
+    xmls = batch.dumps_many(obs)
+    for name, func, items in (('dumps_many', batch.dumps_many, obs),
+                              ('loads_many', batch.loads_many, xmls)):
+        base = None
+        for n in processes:
+            elapsed, result = best_of(
+                lambda items: func(items, processes=n), items, repeat)
+            if base is None:
+                base = elapsed
+            print '  %-14s %2d processes  %9.0f/s  %5.2fx' % (
+                name, n, len(items) / elapsed, base / elapsed)
+
+
+def classic_records(n=10000):
+    """Classic instances, as pickled by protocol 0 with INST"""
+    return [ClassicRecord(i) for i in range(n)]
+
+node_workloads = [
+    ('wide dict', wide_dict, 1),
+    ('object graph', object_graph, 1),
+    ('classic', classic_records, 0),
+    ]
+
+
+def deep_size(ob):
+    """The memory used by ob and everything it refers to
+
+    Objects are counted once, however often they're referred to.
+    """
+    seen = set()
+    size = 0
+    todo = [ob]
+    while todo:
+        ob = todo.pop()
+        if id(ob) in seen:
+            continue
+        seen.add(id(ob))
+        size += sys.getsizeof(ob)
+        if isinstance(ob, (list, tuple)):
+            todo.extend(ob)
+        elif isinstance(ob, dict):
+            todo.extend(ob.keys())
+            todo.extend(ob.values())
+        elif not isinstance(ob, basestring):
+            d = getattr(ob, '__dict__', None)
+            if d is not None:
+                todo.append(d)
+            for cls in type(ob).__mro__:
+                for name in cls.__dict__.get('__slots__', ()):
+                    if hasattr(ob, name):
+                        todo.append(getattr(ob, name))
+    return size
+
+
+def bench_nodes():
+    print 'toxml: ppml node tree memory'
+    for name, make, proto in node_workloads:
+        p = xmlpickle._dumpsUsing_PicklerThatSortsDictItems(make(), proto)
+        start = time.time()
+        tree = ppml.ToXMLUnpickler(StringIO(p)).load()
+        elapsed = time.time() - start
+        print '  %-14s %8d pickle bytes  %10d node bytes  %7.3fs' % (
+            name, len(p), deep_size(tree), elapsed)
+
+
+sections = [
+    bench_dumps,
+    bench_canonical,
+    bench_loads,
+    bench_fromxml,
+    bench_fromxml_parser,
+    bench_compact,
+    bench_iter_toxml,
+    bench_stream_index,
+    bench_batch,
+    bench_nodes,
+    ]
+
+
+# The suite
+
+def deep_nesting(depth=100, n=50):
+    """Dictionaries and lists nested depth levels deep"""
+    chains = []
+    for i in range(n):
+        ob = None
+        for level in range(depth):
+            ob = {'level': level, 'items': [ob, 'x%d' % level]}
+        chains.append(ob)
+    return chains
+
+def binary_strings(n=8, size=1 << 17):
+    """Large strings of arbitrary bytes, which are base64 encoded"""
+    data = ''.join(map(chr, range(256))) * (size // 256)
+    return [data[i:] + data[:i] for i in range(n)]
+
+def unicode_text(n=2000):
+    """Unicode paragraphs in several scripts"""
+    words = [u'gr\xfc\xdfe', u'caf\xe9', u'\u03ba\u03cc\u03c3\u03bc\u03b5',
+             u'\u4e16\u754c', u'\u043c\u0438\u0440', u'plain', u'<&>']
+    return [u' '.join(words[(i + j) % len(words)] for j in range(40))
+            for i in range(n)]
+
+def cyclic_graph(n=3000, ring=10):
+    """Dictionaries that refer to each other in rings"""
+    nodes = [{'name': 'node%d' % i, 'edges': []} for i in range(n)]
+    for i, node in enumerate(nodes):
+        start = i - i % ring
+        for j in (i + 1, i - 1, start):
+            node['edges'].append(nodes[start + (j - start) % ring])
+    return nodes
+
+suite_workloads = [
+    ('wide dict', lambda: wide_dict(5000)),
+    ('deep nesting', deep_nesting),
+    ('small objects', lambda: object_tree(2000)),
+    ('binary', binary_strings),
+    ('unicode', unicode_text),
+    ('cyclic graph', cyclic_graph),
+    ]
+
+def _pickle(ob):
+    return cPickle.dumps(ob, 1)
+
+# name, function, what to make its argument from, whether its
+# throughput is measured by its result rather than its argument, and
+# the operation it is compared with
+suite_operations = [
+    ('cPickle.dumps', _pickle, 'object', True, None),
+    ('cPickle.loads', cPickle.loads, 'pickle', False, None),
+    ('dumps', xmlpickle.dumps, 'object', True, 'cPickle.dumps'),
+    ('loads', xmlpickle.loads, 'xml', False, 'cPickle.loads'),
+    ('toxml', xmlpickle.toxml, 'pickle', True, 'cPickle.dumps'),
+    ('fromxml', xmlpickle.fromxml, 'xml', False, 'cPickle.loads'),
+    ]
+
+
+def timings(func, arg, repeat):
+    """Return the times of repeat calls, with garbage collection off"""
+    times = []
+    for i in range(repeat):
+        gc.disable()
+        try:
+            start = time.time()
+            func(arg)
+            times.append(time.time() - start)
+        finally:
+            gc.enable()
+    return times
+
+
+def percentile(times, p):
+    """The pth percentile of times, by the nearest rank method"""
+    times = sorted(times)
+    return times[max(0, int(round(p / 100.0 * len(times))) - 1)]
+
+
+def peak_memory(func, arg):
+    """Return about how much memory func(arg) allocates at its peak
+
+    tracemalloc is used if it's there.  Otherwise func is called in a
+    child process, whose maximum resident set size is watched.  Memory
+    the child gets from the parent's free lists isn't noticed, so this
+    is a lower bound.  None is returned if neither can be done.
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            func(arg)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    if not hasattr(os, 'fork'):
+        return None
+
+    # Linux reports kilobytes, Mac OS X bytes
+    unit = sys.platform == 'darwin' and 1 or 1024
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            os.close(r)
+            # Touch arg first, so that the pages it shares with the
+            # parent aren't counted
+            deep_size(arg)
+            try:
+                # Linux lets the maximum be reset to the current size
+                f = open('/proc/self/clear_refs', 'w')
+                try:
+                    f.write('5')
+                finally:
+                    f.close()
+            except (IOError, OSError):
+                pass
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            func(arg)
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(w, str((after - before) * unit))
+        finally:
+            os._exit(0)
+    os.close(w)
+    data = os.read(r, 64)
+    os.close(r)
+    os.waitpid(pid, 0)
+    if not data:
+        return None
+    return int(data)
+
+
+def run_suite(workloads=None, operations=None, repeat=10):
+    """Run the suite and return its results
+
+    The results map "workload: operation" to a dictionary with the
+    bytes of pickle or XML processed, the throughput in MB/s, the 50th, 90th and 99th
+    percentile latencies in seconds, the peak memory in bytes and the
+    time relative to the operation it's compared with.
+    """
+    results = {}
+    for name, make in suite_workloads:
+        if workloads and name not in workloads:
+            continue
+        ob = make()
+        args = {'object': ob}
+        args['pickle'] = _pickle(ob)
+        args['xml'] = xmlpickle.dumps(ob)
+        for op, func, arg_name, by_result, baseline in suite_operations:
+            if operations and op not in operations:
+                continue
+            arg = args[arg_name]
+            # Before func leaves memory on free lists
+            peak = peak_memory(func, arg)
+            result = func(arg)
+            size = max(len(by_result and result or arg), 1)
+            del result
+            times = timings(func, arg, repeat)
+            p50 = percentile(times, 50)
+            stats = {
+                'bytes': size,
+                'throughput': size / 1e6 / max(p50, 1e-9),
+                'p50': p50,
+                'p90': percentile(times, 90),
+                'p99': percentile(times, 99),
+                'peak': peak,
+                'relative': None,
+                }
+            base = results.get('%s: %s' % (name, baseline))
+            if base is not None:
+                stats['relative'] = p50 / max(base['p50'], 1e-9)
+            results['%s: %s' % (name, op)] = stats
+    return results
+
+
+def _keys(results):
+    # The results in suite order
+    keys = []
+    for name, make in suite_workloads:
+        for op, func, arg_name, by_result, baseline in suite_operations:
+            key = '%s: %s' % (name, op)
+            if key in results:
+                keys.append(key)
+    return keys
+
+
+def _mb(n):
+    if n is None:
+        return '     ?'
+    return '%6.1f' % (n / 1e6)
+
+
+def print_results(results):
+    print '%-30s %10s %8s %8s %8s %8s %10s' % (
+        '', 'MB/s', 'p50 ms', 'p90 ms', 'p99 ms', 'peak MB', 'x cPickle')
+    for key in _keys(results):
+        r = results[key]
+        relative = r['relative']
+        if relative is None:
+            relative = ''
+        else:
+            relative = '%.1f' % relative
+        print '%-30s %10.1f %8.2f %8.2f %8.2f %8s %10s' % (
+            key, r['throughput'], r['p50'] * 1000, r['p90'] * 1000,
+            r['p99'] * 1000, _mb(r['peak']), relative)
+
+
+def save_results(results, path):
+    f = open(path, 'w')
+    try:
+        json.dump({'python': sys.version.split()[0],
+                   'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'results': results},
+                  f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+
+
+def load_results(path):
+    f = open(path)
+    try:
+        return json.load(f)['results']
+    finally:
+        f.close()
+
+
+def compare_results(old, new):
+    """Print the change in p50 latency and peak memory of each result
+    """
+    print '%-30s %9s %9s %8s %9s %9s' % (
+        '', 'old ms', 'new ms', 'change', 'old MB', 'new MB')
+    for key in _keys(new):
+        if key not in old:
+            continue
+        o = old[key]
+        n = new[key]
+        print '%-30s %9.2f %9.2f %+7.1f%% %9s %9s' % (
+            key, o['p50'] * 1000, n['p50'] * 1000,
+            (n['p50'] / max(o['p50'], 1e-9) - 1) * 100,
+            _mb(o['peak']), _mb(n['peak']))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = optparse.OptionParser(
+        usage="%prog [options]",
+        description="Benchmark zope.xmlpickle against cPickle.")
+    parser.add_option('-n', '--repeat', type='int', default=10,
+                      help="how many times to time each operation")
+    parser.add_option('-w', '--workload', action='append',
+                      help="only run this workload (may be repeated)")
+    parser.add_option('-o', '--operation', action='append',
+                      help="only run this operation (may be repeated)")
+    parser.add_option('--save', metavar='FILE',
+                      help="save the results to FILE")
+    parser.add_option('--compare', metavar='FILE',
+                      help="compare the results with those saved in FILE")
+    parser.add_option('--sections', action='store_true',
+                      help="compare new implementations with the old"
+                      " ones instead")
+    options, args = parser.parse_args(args)
+
+    if options.sections:
+        for section in sections:
+            section()
+        return
+
+    for option, names, suite in [
+        ('workload', options.workload, suite_workloads),
+        ('operation', options.operation, suite_operations),
+        ]:
+        valid = [entry[0] for entry in suite]
+        for name in names or ():
+            if name not in valid:
+                parser.error("no %s %r, choose from: %s"
+                             % (option, name, ', '.join(valid)))
+
+    if (options.save or options.compare) and json is None:
+        parser.error("saving and comparing results needs json")
+    results = run_suite(options.workload, options.operation,
+                        options.repeat)
+    print_results(results)
+    if options.save:
+        save_results(results, options.save)
+    if options.compare:
+        print
+        compare_results(load_results(options.compare), results)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
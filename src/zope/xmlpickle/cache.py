@@ -0,0 +1,108 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Reuse the XML of values that are dumped again and again
+
+Pass a `FragmentCache` as the cache argument of dumps or dump, and the
+XML written for tuples, and for long strings, is kept, and written
+again when the same value is dumped later, rather than walked and
+escaped or encoded once more:
+
+>>> from zope.xmlpickle import dumps
+>>> cache = FragmentCache()
+>>> table = tuple([(i, 'x' * i) for i in range(100)])
+>>> xml = dumps([1, table], cache=cache)
+>>> dumps([2, table], cache=cache) == xml.replace('>1<', '>2<', 1)
+True
+>>> cache.hits, cache.misses
+(1, 1)
+
+The XML is the same as without a cache.  Only values that can't change
+are cached: tuples, strings and unicode, and tuples of those and of
+numbers, booleans and None.  Values are cached by identity, and the
+cache keeps them alive until they are dropped from it.
+
+A value whose XML refers to a value dumped before it, or that some
+value dumped before it is in, is written as usual, and counts as a
+miss.  That XML depends on the rest of the pickle, which is also why
+the values in a cached tuple aren't looked up on their own.
+
+The cache holds the XML of up to maxsize values.  When it's full, the
+value used least recently is dropped.  A cache can be shared by any
+number of dumps, in threads, or by iter_dumps generators that are
+advanced in turn.
+
+"""
+
+import threading
+from collections import OrderedDict
+
+# Strings shorter than this, and tuples with less XML, are written
+# again rather than cached
+MIN_LENGTH = 64
+
+
+class FragmentCache(object):
+    """The XML of recently dumped values, for at most maxsize of them
+
+    hits is the number of values found in the cache and written from
+    it, and misses is the number of values looked up and written as
+    usual.
+    """
+
+    def __init__(self, maxsize=1000):
+        if maxsize < 1:
+            raise ValueError("a fragment cache must hold something")
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()   # id -> (value, fragment)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Drop all values, and reset the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def get(self, value):
+        """Return the fragment cached for value, or None"""
+        entries = self._entries
+        entry = entries.get(id(value))
+        if entry is None:
+            return None
+        with self._lock:
+            # Used most recently
+            if entries.pop(id(value), None) is None:
+                return None
+            entries[id(value)] = entry
+        return entry[1]
+
+    def put(self, value, fragment):
+        """Cache the fragment written for value"""
+        entries = self._entries
+        with self._lock:
+            entries.pop(id(value), None)
+            entries[id(value)] = value, fragment
+            if len(entries) > self.maxsize:
+                entries.popitem(False)
+
+    def count(self, hit):
+        """Count a hit, if hit is true, or a miss"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
@@ -0,0 +1,271 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compressed XML pickle files
+
+XML pickles compress very well.  The files returned by `compressing`
+and `decompressing` compress what is written to them, and decompress
+what is read from them, a block at a time, so that the uncompressed
+text is never all in memory:
+
+>>> from cStringIO import StringIO
+>>> f = StringIO()
+>>> out = compressing(f, 'gzip')
+>>> out.write('<pickle> <none/> </pickle>\\n')
+>>> out.close()
+>>> f.getvalue()[:2] == '\\x1f\\x8b'
+True
+>>> f.seek(0)
+>>> decompressing(f).read()
+'<pickle> <none/> </pickle>\\n'
+
+The codecs are gzip, bz2, zlib and, if the lzma module is available,
+xz.  Reading, the codec is detected from the first bytes of the file,
+and uncompressed files are read as they are.
+
+"""
+
+import bz2
+import os
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+extensions = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.zz': 'zlib',
+    }
+
+BLOCK_SIZE = 1 << 16
+SMALL_BLOCK_SIZE = 1 << 12
+
+
+def _lzma():
+    if lzma is None:
+        raise ValueError("xz compression needs the lzma module")
+    return lzma
+
+_compressors = {
+    'gzip': lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    'zlib': lambda: zlib.compressobj(6),
+    'bz2': lambda: bz2.BZ2Compressor(9),
+    'xz': lambda: _lzma().LZMACompressor(),
+    }
+
+_decompressors = {
+    'gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'zlib': zlib.decompressobj,
+    'bz2': bz2.BZ2Decompressor,
+    'xz': lambda: _lzma().LZMADecompressor(),
+    }
+
+
+def codec_of_path(path):
+    """The codec for a file name's extension, or None"""
+    return extensions.get(os.path.splitext(path)[1])
+
+
+def codec_of_data(data):
+    """The codec that compressed data starts like, or None
+
+    At least 6 bytes should be given, if there are that many.
+    """
+    if data.startswith('\x1f\x8b'):
+        return 'gzip'
+    if data.startswith('BZh'):
+        return 'bz2'
+    if data.startswith('\xfd7zXZ\x00'):
+        return 'xz'
+    if (len(data) >= 2 and data[0] == '\x78'
+        and (ord(data[0]) << 8 | ord(data[1])) % 31 == 0):
+        # A zlib header.  XML can't start with an x.
+        return 'zlib'
+    return None
+
+
+def _check(codec):
+    if codec not in _compressors:
+        raise ValueError("unknown compression: %r" % (codec, ))
+
+
+class _Compressing(object):
+
+    def __init__(self, file, codec):
+        self._file = file
+        self._compressor = _compressors[codec]()
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self._file.write(data)
+
+    def close(self):
+        """Finish the compressed data; the file isn't closed"""
+        self._file.write(self._compressor.flush())
+
+
+def compressing(file, codec):
+    """Return a file whose writes are compressed and written to file
+
+    Its close method must be called to finish the compressed data.
+    """
+    _check(codec)
+    return _Compressing(file, codec)
+
+
+class _Decompressing(object):
+    # zlib decompresses at most BLOCK_SIZE bytes at a time.  bz2 and
+    # lzma decompress all they are given, so they are given less
+    # compressed data whenever they give more than BLOCK_SIZE bytes,
+    # and more whenever they give less than half that.  That can't
+    # bound what a few bytes of a bz2 block expand to, but keeps it to
+    # about a block for anything but long runs of one byte.
+
+    def __init__(self, file, codec, data):
+        self._file = file
+        self._codec = codec
+        self._decompressor = _decompressors[codec]()
+        self._bounded = codec in ('gzip', 'zlib')
+        self._input = data  # compressed data, not decompressed
+        self._start = 0     # from this offset on
+        self._step = SMALL_BLOCK_SIZE   # given to bz2 and lzma at once
+        self._eof = False
+        self._blocks = []   # decompressed data not read yet,
+        self._offset = 0    # from this offset in the first block on,
+        self._size = 0      # which is this many bytes
+
+    def _more(self):
+        # Decompress some more, and return whether there was more
+        decompressor = self._decompressor
+        data = self._input
+        start = self._start
+        if start >= len(data):
+            data = ''
+            if not self._eof:
+                data = self._file.read(BLOCK_SIZE)
+            self._input = data
+            start = self._start = 0
+            if not data:
+                self._eof = True
+                if not self._bounded:
+                    return False
+                # What zlib held back
+                block = decompressor.flush()
+                self._add(block)
+                return bool(block)
+
+        if self._bounded:
+            block = decompressor.decompress(data, BLOCK_SIZE)
+            self._input = decompressor.unconsumed_tail
+        else:
+            step = self._step
+            try:
+                block = decompressor.decompress(data[start:start+step])
+            except EOFError:
+                # A stream ended with the data given last, and this is
+                # the start of another
+                self._decompressor = _decompressors[self._codec]()
+                return True
+            self._start = start + step
+            if len(block) > BLOCK_SIZE:
+                self._step = max(step >> 1, 16)
+            elif len(block) < BLOCK_SIZE >> 1:
+                self._step = min(step << 1, BLOCK_SIZE)
+        if decompressor.unused_data:
+            # Streams can be concatenated.  What zlib leaves unconsumed
+            # after the end of one is the same as what it didn't use.
+            data = decompressor.unused_data
+            if not self._bounded:
+                data += self._input[self._start:]
+            self._input = data
+            self._start = 0
+            self._decompressor = _decompressors[self._codec]()
+        self._add(block)
+        return True
+
+    def _add(self, block):
+        if block:
+            self._blocks.append(block)
+            self._size += len(block)
+
+    def read(self, size=-1):
+        while size < 0 or self._size < size:
+            if not self._more():
+                break
+        blocks = self._blocks
+        if not blocks:
+            return ''
+        if size < 0 or size >= self._size:
+            if self._offset:
+                blocks[0] = blocks[0][self._offset:]
+            data = ''.join(blocks)
+            del blocks[:]
+            self._offset = self._size = 0
+            return data
+
+        self._size -= size
+        result = []
+        while size:
+            block = blocks[0]
+            offset = self._offset
+            if len(block) - offset > size:
+                result.append(block[offset:offset+size])
+                self._offset = offset + size
+                break
+            if offset:
+                block = block[offset:]
+            result.append(block)
+            size -= len(block)
+            del blocks[0]
+            self._offset = 0
+        return ''.join(result)
+
+
+class _Prefixed(object):
+
+    def __init__(self, file, data):
+        self._file = file
+        self._data = data
+
+    def read(self, size=-1):
+        data = self._data
+        if not data:
+            return self._file.read(size)
+        self._data = ''
+        if size < 0:
+            return data + self._file.read()
+        if len(data) > size:
+            self._data = data[size:]
+            return data[:size]
+        return data
+
+
+def decompressing(file, codec=None):
+    """Return a file that reads the decompressed data of file
+
+    If codec is None, it is detected from the data, and if the data
+    isn't compressed, it is read as it is.
+    """
+    if codec is not None:
+        _check(codec)
+        return _Decompressing(file, codec, '')
+    data = file.read(6)
+    codec = codec_of_data(data)
+    if codec is None:
+        return _Prefixed(file, data)
+    return _Decompressing(file, codec, data)
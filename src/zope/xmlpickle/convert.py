@@ -0,0 +1,258 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Convert pickle files to XML and XML files to pickles
+
+Run it with::
+
+  python -m zope.xmlpickle [options] path...
+
+or the xmlpickle-convert script.  Files ending in .xml are converted
+to pickles, and other files to XML, unless --to-xml or --to-pickle is
+given.  Directories are searched for files ending in .pickle, .pkl or
+.xml.  Each output file is written next to its input, or under the
+directory given with --output-dir, with the input's extension
+replaced, and inputs whose output is newer than they are are skipped,
+as are inputs that are the outputs of others.
+
+Files are converted in parallel by the number of processes given with
+-j, and the time taken and the throughput are reported for each.
+
+"""
+
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+from zope.xmlpickle import ppml
+from zope.xmlpickle.xmlpickle import fromxml_file, map_file, toxml_to
+
+pickle_extensions = '.pickle', '.pkl'
+xml_extension = '.xml'
+
+
+def _to_xml(input, output):
+    mapped = map_file(input)
+    try:
+        toxml_to(mapped, output)
+    finally:
+        mapped.close()
+
+def _to_pickle(input, output, protocol):
+    fromxml_file(input, output, protocol=protocol)
+
+
+def convert(job):
+    """Convert a file
+
+    job is (input path, output path, whether to convert to XML, pickle
+    protocol).  The output is written to a temporary file, which
+    replaces the output path once it is complete.  Returns (input
+    path, output path, input size, seconds taken, error message or
+    None).
+    """
+    input, output, to_xml, protocol = job
+    start = time.time()
+    temp = output + '.tmp'
+    try:
+        size = os.path.getsize(input)
+        out = open(temp, 'wb')
+        try:
+            if to_xml:
+                _to_xml(input, out)
+            else:
+                infile = open(input, 'rb')
+                try:
+                    _to_pickle(infile, out, protocol)
+                finally:
+                    infile.close()
+        finally:
+            out.close()
+        os.rename(temp, output)
+    except Exception, v:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return input, output, 0, time.time() - start, '%s: %s' % (
+            v.__class__.__name__, v)
+    return input, output, size, time.time() - start, None
+
+
+def _is_pickle(path):
+    return os.path.splitext(path)[1] in pickle_extensions
+
+def _is_xml(path):
+    return os.path.splitext(path)[1] == xml_extension
+
+
+def find_jobs(paths, to_xml=None, output_dir=None, protocol=None):
+    """Return the conversion jobs for files and directories
+
+    to_xml is True or False to convert all inputs to XML or to
+    pickles, or None to decide by their extensions.  Inputs that are
+    the outputs of other jobs are left out, so that converting a
+    directory again doesn't convert what was made of it before.
+    An input given twice is converted once, and ValueError is raised
+    if two inputs would be converted to the same output, as x.pkl and
+    x.pickle would.
+    """
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    input = os.path.join(dirpath, name)
+                    if to_xml is None:
+                        if not (_is_pickle(input) or _is_xml(input)):
+                            continue
+                    elif not (to_xml and _is_pickle or _is_xml)(input):
+                        continue
+                    jobs.append(_job(input, os.path.relpath(input, path),
+                                     to_xml, output_dir, protocol))
+        else:
+            jobs.append(_job(path, os.path.basename(path),
+                             to_xml, output_dir, protocol))
+    outputs = set(_normpath(job[1]) for job in jobs)
+    by_output = {}
+    result = []
+    for job in jobs:
+        input = _normpath(job[0])
+        if input in outputs:
+            continue
+        other = by_output.setdefault(_normpath(job[1]), job)
+        if other is job:
+            result.append(job)
+        elif _normpath(other[0]) != input:
+            raise ValueError("%s and %s would both be converted to %s"
+                             % (other[0], job[0], job[1]))
+    return result
+
+def _normpath(path):
+    return os.path.normcase(os.path.abspath(path))
+
+def _job(input, relpath, to_xml, output_dir, protocol):
+    if to_xml is None:
+        to_xml = not _is_xml(input)
+    if output_dir is None:
+        output = input
+    else:
+        output = os.path.join(output_dir, relpath)
+    output = os.path.splitext(output)[0] + (
+        to_xml and xml_extension or pickle_extensions[0])
+    return input, output, to_xml, protocol
+
+
+def up_to_date(job):
+    """Is the output of a job newer than its input?"""
+    input, output = job[:2]
+    return (os.path.exists(output)
+            and os.path.getmtime(output) >= os.path.getmtime(input))
+
+
+def _mb_per_second(size, elapsed):
+    if elapsed <= 0:
+        return 0.0
+    return size / elapsed / (1 << 20)
+
+
+def run(jobs, processes=1, write=sys.stdout.write):
+    """Convert files, reporting on each, and return the number of failures
+    """
+    for job in jobs:
+        directory = os.path.dirname(job[1])
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(convert, jobs)
+    else:
+        pool = None
+        results = (convert(job) for job in jobs)
+
+    start = time.time()
+    failed = total = 0
+    try:
+        for input, output, size, elapsed, error in results:
+            if error:
+                failed += 1
+                write('%s: failed: %s\n' % (input, error))
+            else:
+                total += size
+                write('%s -> %s: %d bytes in %.3fs, %.1f MB/s\n' % (
+                    input, output, size, elapsed,
+                    _mb_per_second(size, elapsed)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+    write('%d converted, %d failed, %d bytes in %.3fs, %.1f MB/s\n' % (
+        len(jobs) - failed, failed, total, elapsed,
+        _mb_per_second(total, elapsed)))
+    return failed
+
+
+def main(args=None, write=sys.stdout.write):
+    if args is None:
+        args = sys.argv[1:]
+    parser = optparse.OptionParser(
+        usage="%prog [options] path...",
+        description="Convert pickle files to XML and XML files to pickles.")
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help="how many files to convert at once")
+    parser.add_option('-x', '--to-xml', action='store_true',
+                      help="convert all inputs to XML")
+    parser.add_option('-p', '--to-pickle', action='store_true',
+                      help="convert all inputs to pickles")
+    parser.add_option('-o', '--output-dir', metavar='DIR',
+                      help="write output files under DIR")
+    parser.add_option('--protocol', type='int',
+                      help="the protocol of the pickles written")
+    parser.add_option('-f', '--force', action='store_true',
+                      help="convert inputs even if their output is"
+                      " up to date")
+    options, args = parser.parse_args(args)
+
+    if not args:
+        parser.error("no files or directories to convert")
+    if options.to_xml and options.to_pickle:
+        parser.error("--to-xml and --to-pickle can't both be given")
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    try:
+        ppml.xmlPickler(options.protocol)
+    except ValueError, v:
+        parser.error(str(v))
+    to_xml = None
+    if options.to_xml:
+        to_xml = True
+    elif options.to_pickle:
+        to_xml = False
+
+    try:
+        jobs = find_jobs(args, to_xml, options.output_dir, options.protocol)
+    except ValueError, v:
+        parser.error(str(v))
+    if not options.force:
+        todo = [job for job in jobs if not up_to_date(job)]
+        if len(todo) < len(jobs):
+            write('%d up to date\n' % (len(jobs) - len(todo)))
+        jobs = todo
+    if run(jobs, options.jobs, write):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,333 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Load XML pickles lazily
+
+loads(xml, lazy=True) scans the XML once, to index where its lists and
+dictionaries are, and makes them `LazyList` and `LazyDict` instances,
+which load their items the first time they are used:
+
+>>> from zope.xmlpickle import dumps, loads
+>>> l = [1, 2]
+>>> v = loads(dumps({'eggs': l, 'spam': [l, 'x']}), lazy=True)
+>>> v.__class__.__name__
+'LazyDict'
+>>> spam = v['spam']
+>>> spam.__class__.__name__, '_lazy' in spam.__dict__
+('LazyList', True)
+>>> spam
+[[1, 2], 'x']
+>>> spam[0] is v['eggs']
+True
+
+Only the lists and dictionaries that are used are loaded, and those a
+reference in them needs.  Instances are made when the container they
+are in is loaded, with their state, whose lists and dictionaries are
+lazy too.  The lists and dictionaries in the arguments of instances
+are loaded with them.  XML with comments, CDATA sections or processing
+instructions is loaded eagerly.
+
+Much like the persistent lists and mappings of the ZODB, lazy lists
+and dictionaries aren't subclasses of list and dict, but they can be
+used like them, and they are pickled, by dumps() too, as lists and
+dictionaries.  The XML is kept until all of them are loaded.
+
+"""
+
+import re
+import UserDict
+import UserList
+from array import array
+from cPickle import BadPickleGet
+from xml.parsers import expat
+
+from zope.xmlpickle.unpickler import XMLUnpickler, _memo_key
+
+# The tags of lists and dictionaries, and of the elements that decide
+# whether they are lazy, and the start tags of other elements with ids.
+# References have ids, but aren't memoized.  Tags in comments, CDATA
+# sections and the like would be found too, so XML with those is
+# loaded eagerly.
+_tags = re.compile(
+    r'<(/?)(list|dictionary|klass|arguments|state)(?=[\s/>])'
+    r'|<(?!reference[\s/>])[\w.:-]+(?:\s[^>]*?)?\sid\s*=\s*["\']([^"\']*)')
+_id = re.compile(r'\sid\s*=\s*["\']([^"\']*)')
+_encoding = re.compile(r'<\?xml[^>]*\sencoding\s*=\s*["\']([\w.-]+)')
+
+_OTHER, _LIST, _DICTIONARY = range(3)
+
+
+class LazyList(UserList.UserList):
+    """A list that loads its items the first time it's used"""
+
+    def __getattr__(self, name):
+        if name != 'data' or '_lazy' not in self.__dict__:
+            raise AttributeError(name)
+        loader, element = self.__dict__.pop('_lazy')
+        self.data = data = []
+        data.extend(loader.children(element))
+        return data
+
+    def __reduce__(self):
+        return list, (), None, iter(self.data)
+
+
+class LazyDict(UserDict.IterableUserDict, object):
+    """A dictionary that loads its items the first time it's used"""
+
+    __hash__ = None
+
+    def __getattr__(self, name):
+        if name != 'data' or '_lazy' not in self.__dict__:
+            raise AttributeError(name)
+        loader, element = self.__dict__.pop('_lazy')
+        self.data = data = {}
+        for key, value in loader.children(element):
+            data[key] = value
+        return data
+
+    def __reduce__(self):
+        return dict, (), None, None, self.data.iteritems()
+
+
+class _Index(object):
+    """Where the lazy lists and dictionaries of an XML pickle are
+
+    Lists and dictionaries are lazy, except in the classes and
+    arguments of instances, and except for the states of instances
+    themselves.  The index has an entry for each of them, and for each
+    other element with an id, in the order they start.  An entry has a
+    kind, the byte offset where it starts, and the entry of the lazy
+    container it's in, or -1.  A container's entry also has the offset
+    where it ends, and a size, the number of entries in it, and itself.
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.kinds = kinds = array('B')
+        self.starts = starts = array('L')
+        self.ends = ends = array('L')
+        self.sizes = sizes = array('L')
+        self.parents = parents = array('l')
+        self.elements = elements = {}   # memo key -> the entry with its id
+        self.keys = keys = {}           # container's entry -> memo key
+
+        # [tag, container, eager, end of a state's start tag] of each
+        # open element that _tags finds, where container is the entry
+        # of the lazy container the element is, or is in, and eager is
+        # whether the containers in it are loaded eagerly
+        open = [[None, -1, False, None]]
+        for match in _tags.finditer(xml):
+            end, tag, id = match.groups()
+            top = open[-1]
+            if end:
+                del open[-1]
+                if tag != top[0]:
+                    raise ValueError("mismatched tag in XML pickle: %r"
+                                     % tag)
+                entry = top[1]
+                if entry > open[-1][1]:
+                    # A lazy container ends
+                    ends[entry] = xml.index('>', match.end()) + 1
+                    sizes[entry] = len(kinds) - entry
+                continue
+
+            start = match.start()
+            if tag is None:
+                # Another element with an id
+                elements[_memo_key(id)] = len(kinds)
+                kinds.append(_OTHER)
+                starts.append(start)
+                ends.append(0)
+                sizes.append(1)
+                parents.append(top[1])
+                continue
+
+            gt = xml.index('>', match.end())
+            empty = xml[gt-1] == '/'
+            match = _id.search(xml, match.end(), gt)
+            container = top[1]
+            eager = top[2]
+            if tag == 'list' or tag == 'dictionary':
+                if not eager and (top[3] is None or
+                                  xml.find('<', top[3]) != start):
+                    # A lazy container
+                    container = len(kinds)
+                    if tag == 'list':
+                        kinds.append(_LIST)
+                    else:
+                        kinds.append(_DICTIONARY)
+                    starts.append(start)
+                    ends.append(gt + 1)
+                    sizes.append(1)
+                    parents.append(top[1])
+                    if match is not None:
+                        key = _memo_key(match.group(1))
+                        elements[key] = container
+                        keys[container] = key
+                elif match is not None:
+                    elements[_memo_key(match.group(1))] = len(kinds)
+                    kinds.append(_OTHER)
+                    starts.append(start)
+                    ends.append(0)
+                    sizes.append(1)
+                    parents.append(top[1])
+            elif tag == 'state':
+                if not empty:
+                    open.append([tag, container, eager, gt + 1])
+                continue
+            else:
+                eager = True
+            if not empty:
+                open.append([tag, container, eager, None])
+        if len(open) != 1:
+            raise ValueError("unclosed element in XML pickle: %r"
+                             % open[-1][0])
+
+
+class _Loader(XMLUnpickler):
+    """Load the parts of an indexed XML pickle
+
+    Each part is parsed with a new parser, fed the XML around the lazy
+    containers in it.
+    """
+
+    def __init__(self, index, encoding):
+        XMLUnpickler.__init__(self)
+        self._index = index
+        self._encoding = encoding
+        self._waiting = {}  # entry -> lazy container that isn't loaded
+
+    def root(self):
+        """Load the pickled object"""
+        xml = self._index.xml
+        start = xml.index('>', xml.index('<pickle')) + 1
+        values = self._parse(start, xml.rindex('</pickle'),
+                             0, len(self._index.kinds))
+        if len(values) != 1:
+            raise ValueError("a pickle holds one object")
+        return values[0]
+
+    def children(self, entry):
+        """Load the values in a lazy container"""
+        del self._waiting[entry]
+        index = self._index
+        xml = index.xml
+        start = xml.index('>', index.starts[entry]) + 1
+        end = index.ends[entry]
+        if xml[start-2] == '/':
+            # Empty
+            return []
+        return self._parse(start, xml.rindex('<', start, end),
+                           entry + 1, entry + index.sizes[entry])
+
+    def _parse(self, start, end, first, stop):
+        # Return the values of the elements between the offsets, where
+        # the entries from first to stop are
+        index = self._index
+        xml = index.xml
+        kinds = index.kinds
+        starts = index.starts
+        ends = index.ends
+        sizes = index.sizes
+
+        saved = self.__dict__.get('_stack')
+        parser = expat.ParserCreate(self._encoding)
+        parser.returns_unicode = False
+        parser.buffer_text = True
+        parser.StartElementHandler = self.handle_starttag
+        parser.EndElementHandler = self.handle_endtag
+        parser.CharacterDataHandler = self.handle_data
+        self._stack = [[None, None, [], None]]
+        try:
+            parser.Parse('<pickle>', False)
+            values = self._stack[-1][2]
+            pos = start
+            entry = first
+            while entry < stop:
+                kind = kinds[entry]
+                if kind == _OTHER:
+                    entry += 1
+                    continue
+                # Leave the container out of the XML, and add it
+                if pos < starts[entry]:
+                    parser.Parse(xml[pos:starts[entry]], False)
+                if kind == _LIST:
+                    container = LazyList()
+                else:
+                    container = LazyDict()
+                del container.data
+                container._lazy = self, entry
+                self._waiting[entry] = container
+                key = index.keys.get(entry)
+                if key is not None:
+                    self.memo[key] = container
+                top = self._stack[-1]
+                top[2].append(container)
+                if top[3] is not None:
+                    top[3](top)
+                pos = ends[entry]
+                entry += sizes[entry]
+            if pos < end:
+                parser.Parse(xml[pos:end], False)
+        finally:
+            if saved is None:
+                del self._stack
+            else:
+                self._stack = saved
+        return values
+
+    def load_reference(self, frame):
+        key = _memo_key(frame[1]['id'])
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        # The element is in a lazy container that isn't loaded.  Load
+        # the containers from the outermost one made down to it.
+        index = self._index
+        entry = index.elements.get(key)
+        if entry is None:
+            raise BadPickleGet(key)
+        entry = index.parents[entry]
+        path = []
+        while entry >= 0:
+            path.append(entry)
+            if entry in self._waiting:
+                break
+            entry = index.parents[entry]
+        else:
+            raise BadPickleGet(key)
+        for entry in reversed(path):
+            # Loading one container can load the next, to resolve a
+            # reference of its own
+            container = self._waiting.get(entry)
+            if container is not None:
+                container.data
+        try:
+            return self.memo[key]
+        except KeyError:
+            raise BadPickleGet(key)
+
+    dispatch = XMLUnpickler.dispatch.copy()
+    dispatch['reference'] = load_reference
+
+
+def load_lazily(xml):
+    """Load the object an XML string holds, with lazy lists and dicts"""
+    if type(xml) is unicode:
+        xml = xml.encode('utf-8')
+    if xml.find('<!') >= 0 or xml.find('<?', 1) >= 0:
+        return XMLUnpickler().loads(xml)
+    match = _encoding.match(xml)
+    return _Loader(_Index(xml), match and match.group(1)).root()
@@ -0,0 +1,1139 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Pickle Python objects straight to XML.
+
+`ToXMLPickler` walks an object graph following the rules of the
+standard protocol 1 pickler, with dictionary items sorted as
+`xmlpickle.dumps` has always done, and collects the XML that
+`ppml.ToXMLUnpickler` would produce for the resulting pickle.  Neither
+the pickle nor the node tree is ever built.
+
+"""
+
+import sys
+from copy_reg import dispatch_table
+from itertools import groupby, imap
+from operator import itemgetter
+from pickle import PicklingError, whichmodule
+from types import NoneType, IntType, LongType, FloatType, StringType, \
+     UnicodeType, TupleType, ListType, DictionaryType, InstanceType, \
+     ClassType, FunctionType, BuiltinFunctionType, TypeType
+
+from zope.xmlpickle.ppml import _binary_char, _convert_sub, _invalid_xml_char
+from zope.xmlpickle.ppml import _chunk_sizes, encode_chunks, identifier
+from zope.xmlpickle.cache import MIN_LENGTH as _MIN_LENGTH
+from zope.xmlpickle.lazy import LazyDict, LazyList
+from zope.xmlpickle.registry import _writers, _attributes
+
+# The XML is collected as a list of fragments.  Besides strings, a
+# fragment can be:
+#
+# - an int, standing for a line break followed by that much
+#   indentation, or _SP, standing for the single space that separates
+#   a scalar from the tags of the element wrapped around it,
+#
+# - a _Node, standing for the id attribute of a memoized object, which
+#   is only needed if something refers back to the object later, or
+#
+# - a _Choice between two renderings of an object, for the one case
+#   where the rendering depends on what is referred to later, or
+#
+# - an _Encoded binary string, which is encoded as it is output, or
+#
+# - the _Pasted XML of a value that was in a cache.FragmentCache.
+
+_SP = -1
+
+# The number of fragments iter_output makes each part of
+_STEP = 1024
+
+class _Indents(dict):
+
+    def __missing__(self, n):
+        s = self[n] = '\n' + ' ' * n
+        return s
+
+_indents = _Indents({_SP: ' '})
+
+class _NoIndents(dict):
+
+    def __missing__(self, n):
+        return ''
+
+_no_indents = _NoIndents()
+
+
+class _Node(object):
+    """What ToXMLUnpickler would make of a saved value
+
+    Memoized values get a node of their own, which also carries the id
+    assigned when the value is first referred to.
+    """
+
+    __slots__ = ('node', 'scalar', 'size', 'id', 'obj', 'module', 'name')
+
+    def __init__(self, node, scalar=False, size=None):
+        self.node = node
+        self.scalar = scalar
+        self.size = size
+        self.id = None
+
+_NONE = _Node('none', True)
+_BOOL = _Node('bool', True)
+_SCALAR = _Node('scalar', True)
+_REFERENCE = _Node('reference', True)
+_PERSISTENT = _Node('persistent')
+_EMPTY_TUPLE = _Node('tuple', size=0)
+
+
+class _Choice(object):
+    """Two renderings of an object, chosen once all ids are known
+
+    ppml.Initialized_Object only outputs an instance as an <object>
+    element if the globals it was made with compare equal to
+    copy_reg._reconstructor and object, and a global with an id
+    doesn't.  Whether those globals get an id depends on the rest of
+    the pickle, so both renderings are kept until it has been walked.
+    """
+
+    __slots__ = ('nodes', 'initialized', 'object')
+
+    def __init__(self, nodes, initialized, object):
+        self.nodes = nodes
+        self.initialized = initialized
+        self.object = object
+
+    def choose(self):
+        for node in self.nodes:
+            if node.id is not None:
+                return self.initialized
+        return self.object
+
+
+class _Encoded(object):
+    """A binary string, encoded a chunk at a time as it is output"""
+
+    __slots__ = ('v', 'encoding')
+
+    def __init__(self, v, encoding):
+        self.v = v
+        self.encoding = encoding
+
+    def choose(self):
+        return encode_chunks(self.v, self.encoding)
+
+
+class _Shared(_Node):
+    """The node of a value in a _Fragment, shared by the picklers that
+    paste it
+
+    Its id is never set.  Each pickler keeps the ids it gives shared
+    nodes in a dictionary of its own.
+    """
+
+    __slots__ = ()
+
+
+class _Reference(object):
+    """A reference, in a _Fragment, to a node in it"""
+
+    __slots__ = ('node', )
+
+    def __init__(self, node):
+        self.node = node
+
+
+class _Fragment(object):
+    """The fragments of a value, kept in a cache.FragmentCache
+
+    The fragments are indented as if the value were at indentation 0,
+    and binary strings are encoded, with encoding if there are any.
+    The value, and the values in it that are memoized, have _Shared
+    nodes among them, which are put in the memo of each pickler that
+    pastes the fragment.  The references in the value are to nodes in
+    it, and are _References, as the ids of the nodes referred to, in
+    order, depend on the ids given before.  A fragment isn't changed
+    once it's made, so any number of picklers can paste it at once.
+    """
+
+    def __init__(self, fragments, nodes, referred, encoding):
+        self.fragments = fragments
+        self.nodes = nodes
+        self.referred = referred
+        self.memo = dict((id(node.obj), node) for node in nodes)
+        self.encoding = encoding
+        self._texts = {}
+
+    def paste(self, ids, got):
+        """Give the nodes referred to in the value, in ids, the ids
+        they get after got ids are given"""
+        for node in self.referred:
+            ids[node] = 'o%d' % got
+            got += 1
+        return got
+
+    def texts(self, indent, indents):
+        """The text between the nodes and references, for a value at
+        indent, and the nodes and references"""
+        key = indent, indents is _no_indents
+        texts = self._texts.get(key)
+        if texts is None:
+            texts = []
+            marks = []
+            text = []
+            for f in self.fragments:
+                c = f.__class__
+                if c is str:
+                    text.append(f)
+                elif c is int:
+                    if f != _SP:
+                        f += indent
+                    text.append(indents[f])
+                else:
+                    texts.append(''.join(text))
+                    marks.append(f)
+                    text = []
+            texts.append(''.join(text))
+            texts = self._texts[key] = texts, marks
+        return texts
+
+
+class _Pasted(object):
+    """A _Fragment, pasted at an indentation, with the ids the pickler
+    gave its nodes"""
+
+    __slots__ = ('fragment', 'indent', 'ids')
+
+    def __init__(self, fragment, indent, ids):
+        self.fragment = fragment
+        self.indent = indent
+        self.ids = ids
+
+    def output(self, write, indents):
+        texts, marks = self.fragment.texts(self.indent, indents)
+        ids = self.ids
+        start = 0
+        for i, mark in enumerate(marks):
+            if mark.__class__ is _Reference:
+                text = '<reference id="%s"/>' % ids[mark.node]
+            else:
+                id = ids.get(mark)
+                if id is None:
+                    continue
+                text = ' id="%s"' % id
+            write(''.join(texts[start:i+1]))
+            write(text)
+            start = i + 1
+        write(''.join(texts[start:]))
+
+
+def _shift(fragments, delta):
+    """Return a copy of fragments, indented by delta more"""
+    result = []
+    for f in fragments:
+        c = f.__class__
+        if c is int:
+            if f != _SP:
+                f += delta
+        elif c is _Choice:
+            f = _Choice(f.nodes,
+                        _shift(f.initialized, delta),
+                        _shift(f.object, delta))
+        elif c is _Pasted:
+            f = _Pasted(f.fragment, f.indent + delta, f.ids)
+        result.append(f)
+    return result
+
+
+def _output(fragments, write, indents=_indents):
+    for f in fragments:
+        c = f.__class__
+        if c is str:
+            write(f)
+        elif c is int:
+            write(indents[f])
+        elif c is _Node:
+            if f.id is not None:
+                write(' id="%s"' % f.id)
+        elif c is _Pasted:
+            f.output(write, indents)
+        else:
+            _output(f.choose(), write, indents)
+
+
+def _same_global(node, module, name):
+    """Compare a node with Global(module, name), as Base.__eq__ does
+
+    Note that Base.__eq__ considers nodes of different types equal.
+    If the answer depends on whether the node is referred to later,
+    the node itself is returned.
+    """
+    if node.node != 'global':
+        return True
+    if node.module != module or node.name != name or node.id is not None:
+        return False
+    return node
+
+def _type_name(item):
+    t = type(item[0])
+    return t.__module__, t.__name__
+
+def _repr_of_key(item):
+    return repr(item[0])
+
+def _sort_items(items, key=itemgetter(0)):
+    """Sort dictionary items by key
+
+    Keys that can't all be compared with each other, such as complex
+    numbers, or non-ASCII strings mixed with unicode, are grouped by
+    type, and sorted by their reprs if they can't be compared within
+    their group either.
+    """
+    try:
+        items.sort(key=key)
+    except (TypeError, UnicodeError):
+        items.sort(key=_type_name)
+        groups = []
+        for name, group in groupby(items, _type_name):
+            group = list(group)
+            try:
+                group.sort(key=key)
+            except (TypeError, UnicodeError):
+                group.sort(key=_repr_of_key)
+            groups.extend(group)
+        items[:] = groups
+
+_DICTIONARY = 'dictionary', 'item', 'key', 'key'
+_ATTRIBUTES = 'attributes', 'attribute', 'name', 'name'
+_DICTITEMS = 'dictitems', 'item', 'key', 'key'
+
+
+class ToXMLPickler(object):
+    """Pickle objects to XML
+
+    Like pickle.Pickler, the pickler has a memo that is shared by all
+    the objects it dumps, and subclasses can override persistent_id.
+    Dictionary items are sorted, so the XML doesn't depend on the
+    order of items in dictionaries, unless canonical is false.
+    Binary strings are encoded with binary_encoding, 'base64' or
+    'hex'.  If cache is a cache.FragmentCache, the XML of the values
+    it holds is written from it.
+
+    >>> pickler = ToXMLPickler()
+    >>> pickler.dump([42, 'spam'])
+    >>> import sys
+    >>> pickler.output(sys.stdout.write)
+    <?xml version="1.0" encoding="utf-8" ?>
+    <pickle>
+      <list>
+        <int>42</int>
+        <string>spam</string>
+      </list>
+    </pickle>
+    """
+
+    def __init__(self, canonical=True, binary_encoding='base64',
+                 cache=None):
+        if binary_encoding not in _chunk_sizes:
+            raise ValueError('bad encoding', binary_encoding)
+        self.canonical = canonical
+        self.binary_encoding = binary_encoding
+        self.cache = cache
+        if cache is not None:
+            self.dispatch = dispatch = self.dispatch.copy()
+            for t in _cacheable:
+                dispatch[t] = self.__class__.save_cached.im_func
+            self._caching = False
+            self._shared_ids = {}   # _Shared node -> id
+        self.memo = {}
+        self._out = []
+        self._write = self._out.append
+        self._got = 0
+        self._keep = []
+
+    def persistent_id(self, obj):
+        # This exists so a subclass can override it
+        return None
+
+    def dump(self, obj):
+        """Collect the XML pickle of obj"""
+        pid = self.persistent_id
+        if getattr(pid, 'im_func', None) is _default_persistent_id:
+            pid = None
+        self._pid = pid
+        self._write('<?xml version="1.0" encoding="utf-8" ?>')
+        self._wrap('pickle', obj, 0)
+        self._write(0)
+
+    def output(self, write, pretty=True):
+        """Write the collected XML
+
+        If pretty is false, the XML is written without the line breaks
+        and indentation between elements.
+        """
+        if pretty:
+            _output(self._out, write)
+        else:
+            _output(self._out, write, _no_indents)
+
+    def iter_output(self, pretty=True):
+        """Generate the collected XML a part at a time
+
+        The parts add up to what output() writes.
+        """
+        indents = pretty and _indents or _no_indents
+        out = self._out
+        r = []
+        for i in xrange(0, len(out), _STEP):
+            _output(out[i:i+_STEP], r.append, indents)
+            if r:
+                yield ''.join(r)
+                del r[:]
+
+    # The save methods write a value at the given indentation and
+    # return its _Node.
+
+    def save(self, obj, indent):
+        pid = self._pid
+        if pid is not None:
+            p = pid(obj)
+            if p is not None:
+                return self.save_pers(p, indent)
+
+        x = self.memo.get(id(obj))
+        if x is not None:
+            return self._get(x, indent)
+
+        f = self.dispatch.get(type(obj))
+        if f is not None:
+            return f(self, obj, indent)
+
+        return self._reduce(obj, indent)
+
+    def _save_unpersisted(self, obj, indent):
+        # save() for an object already known to have no persistent id
+        x = self.memo.get(id(obj))
+        if x is not None:
+            return self._get(x, indent)
+
+        f = self.dispatch.get(type(obj))
+        if f is not None:
+            return f(self, obj, indent)
+
+        return self._reduce(obj, indent)
+
+    def _reduce(self, obj, indent):
+        t = type(obj)
+
+        registered = _writers.get(t)
+        if registered is not None:
+            return self.save_registered(obj, indent, *registered)
+
+        # Check copy_reg.dispatch_table
+        reduce = dispatch_table.get(t)
+        if reduce:
+            rv = reduce(obj)
+        else:
+            # Check for a class with a custom metaclass; treat as regular
+            # class
+            try:
+                issc = issubclass(t, TypeType)
+            except TypeError:
+                issc = 0
+            if issc:
+                return self.save_global(obj, indent)
+
+            reduce = getattr(obj, "__reduce_ex__", None)
+            if reduce:
+                rv = reduce(1)
+            else:
+                reduce = getattr(obj, "__reduce__", None)
+                if reduce:
+                    rv = reduce()
+                else:
+                    raise PicklingError("Can't pickle %r object: %r" %
+                                        (t.__name__, obj))
+
+        if type(rv) is StringType:
+            return self.save_global(obj, indent, rv)
+
+        if type(rv) is not TupleType:
+            raise PicklingError("%s must return string or tuple" % reduce)
+
+        l = len(rv)
+        if not (2 <= l <= 5):
+            raise PicklingError("Tuple returned by %s must have "
+                                "two to five elements" % reduce)
+
+        return self.save_reduce(indent, obj=obj, *rv)
+
+    def save_pers(self, pid, indent):
+        self._wrap('persistent', pid, indent)
+        return _PERSISTENT
+
+    def save_reduce(self, indent, func, args, state=None,
+                    listitems=None, dictitems=None, obj=None):
+        if not isinstance(args, TupleType):
+            raise PicklingError("args from reduce() should be a tuple")
+
+        if not hasattr(func, '__call__'):
+            raise PicklingError("func from reduce should be callable")
+
+        return self._save_object(indent, obj, func, args,
+                                 state, listitems, dictitems)
+
+    def _memoize(self, obj, node):
+        assert id(obj) not in self.memo
+        node.obj = obj
+        self.memo[id(obj)] = node
+        return node
+
+    def _get(self, node, indent):
+        write = self._write
+        write(indent)
+        if node.node == 'identifier':
+            # ToXMLUnpickler repeats these rather than referring to them
+            write('<string>%s</string>' % node.obj)
+            return _SCALAR
+
+        if node.__class__ is _Shared:
+            # Pasted from a cache, and shared with other picklers
+            ids = self._shared_ids
+            id = ids.get(node)
+            if id is None:
+                id = ids[node] = 'o%d' % self._got
+                self._got += 1
+            write('<reference id="%s"/>' % id)
+            return _REFERENCE
+
+        if node.id is None:
+            node.id = 'o%d' % self._got
+            self._got += 1
+        write('<reference id="%s"/>' % node.id)
+        return _REFERENCE
+
+    def _wrap(self, name, obj, indent, save=None):
+        # Save obj inside a ppml.Wrapper element
+        out = self._out
+        write = self._write
+        write(indent)
+        write('<%s>' % name)
+        start = len(out)
+        node = (save or self.save)(obj, indent + 2)
+        if node.scalar:
+            out[start] = _SP
+            write(_SP)
+        else:
+            write(indent)
+        write('</%s>' % name)
+        return node
+
+    dispatch = {}
+
+    def save_none(self, obj, indent):
+        write = self._write
+        write(indent)
+        write('<none/>')
+        return _NONE
+    dispatch[NoneType] = save_none
+
+    def save_bool(self, obj, indent):
+        write = self._write
+        write(indent)
+        write(obj and '<true/>' or '<false/>')
+        return _BOOL
+    dispatch[bool] = save_bool
+
+    def save_int(self, obj, indent):
+        write = self._write
+        write(indent)
+        write('<int>%d</int>' % obj)
+        return _SCALAR
+    dispatch[IntType] = save_int
+
+    def save_long(self, obj, indent):
+        write = self._write
+        write(indent)
+        write('<long>%d</long>' % obj)
+        return _SCALAR
+    dispatch[LongType] = save_long
+
+    def save_float(self, obj, indent):
+        write = self._write
+        write(indent)
+        write('<float>%r</float>' % obj)
+        return _SCALAR
+    dispatch[FloatType] = save_float
+
+    def _save_encoded(self, tag, obj, v):
+        node = self._memoize(obj, _Node(tag, True))
+        write = self._write
+        write('<' + tag)
+        write(node)
+        write(' encoding="%s">' % self.binary_encoding)
+        write(_Encoded(v, self.binary_encoding))
+        write('</%s>' % tag)
+        return node
+
+    def save_string(self, obj, indent):
+        write = self._write
+        write(indent)
+        if _binary_char(obj):
+            return self._save_encoded('string', obj, obj)
+
+        v = _convert_sub(obj)[1]
+        if identifier(v):
+            write('<string>%s</string>' % v)
+            return self._memoize(obj, _Node('identifier', True))
+
+        node = self._memoize(obj, _Node('string', True))
+        write('<string')
+        write(node)
+        write('>%s</string>' % v)
+        return node
+    dispatch[StringType] = save_string
+
+    def save_unicode(self, obj, indent):
+        write = self._write
+        write(indent)
+        v = obj.encode('utf-8')
+        if _invalid_xml_char(obj):
+            return self._save_encoded('unicode', obj, v)
+
+        node = self._memoize(obj, _Node('unicode', True))
+        write('<unicode')
+        write(node)
+        write('>%s</unicode>' % _convert_sub(v)[1])
+        return node
+    dispatch[UnicodeType] = save_unicode
+
+    def save_tuple(self, obj, indent, items=None):
+        # If items is given, it is extended with the node, start and
+        # end of each element, so our caller can see what became of them.
+        write = self._write
+        if not obj:
+            write(indent)
+            write('<tuple />')
+            return _EMPTY_TUPLE
+
+        out = self._out
+        start = len(out)
+        node = _Node('tuple', size=len(obj))
+        write(indent)
+        write('<tuple')
+        write(node)
+        write('>')
+
+        save = self.save
+        indent2 = indent + 2
+        if items is None:
+            for element in obj:
+                save(element, indent2)
+        else:
+            for element in obj:
+                begin = len(out)
+                items.append((save(element, indent2), begin, len(out)))
+
+        x = self.memo.get(id(obj))
+        if x is not None:
+            # The tuple is recursive, so it got saved while its
+            # elements were.  The pickler throws away what it wrote
+            # and gets the tuple from the memo.
+            del out[start:]
+            return self._get(x, indent)
+
+        write(indent)
+        write('</tuple>')
+        return self._memoize(obj, node)
+    dispatch[TupleType] = save_tuple
+
+    def save_list(self, obj, indent):
+        write = self._write
+        node = self._memoize(obj, _Node('list', size=len(obj)))
+        write(indent)
+        write('<list')
+        write(node)
+        if obj:
+            write('>')
+            save = self.save
+            indent2 = indent + 2
+            for x in obj:
+                save(x, indent2)
+            write(indent)
+            write('</list>')
+        else:
+            write(' />')
+        return node
+    dispatch[ListType] = save_list
+    dispatch[LazyList] = save_list
+
+    def save_dict(self, obj, indent, names=_DICTIONARY, record=None):
+        # If record is given, it is extended with the positions of the
+        # fragments that differ when the dictionary is output as
+        # attributes, together with their replacements.
+        out = self._out
+        write = self._write
+        node = self._memoize(obj, _Node('dictionary', size=len(obj)))
+        items = obj.items()
+        if self.canonical:
+            _sort_items(items)
+
+        write(indent)
+        if record is not None:
+            record.append((len(out), '<attributes'))
+        write('<' + names[0])
+        write(node)
+        if not items:
+            write(' />')
+            return node
+        write('>')
+        self._save_items(items, indent, names, record)
+        return node
+    dispatch[DictionaryType] = save_dict
+    dispatch[LazyDict] = save_dict
+
+    def _save_items(self, items, indent, names=_DICTIONARY, record=None):
+        # Save the items and end tag of a dictionary
+        out = self._out
+        write = self._write
+        memo = self.memo
+        tag, item, key_name, key_class = names
+        save = self.save
+        pid = self._pid
+        indent2 = indent + 2
+        indent4 = indent + 4
+        item_end = '</%s>' % item
+        for key, value in items:
+            p = None
+            if type(key) is str and identifier(key):
+                if pid is not None:
+                    p = pid(key)
+                if p is None:
+                    if id(key) not in memo:
+                        self._memoize(key, _Node('identifier', True))
+                    write(indent2)
+                    if record is not None:
+                        record.append(
+                            (len(out), '<attribute name="%s">' % key))
+                    write('<%s %s="%s">' % (item, key_name, key))
+                    save(value, indent + 6)
+                    write(indent2)
+                    if record is not None:
+                        record.append((len(out), '</attribute>'))
+                    write(item_end)
+                    continue
+
+            write(indent2)
+            if record is not None:
+                record.append((len(out), '<attribute>'))
+            write('<%s>' % item)
+            begin = len(out)
+            if p is None:
+                self._wrap(key_class, key, indent4)
+            else:
+                write(indent4)
+                write('<%s>' % key_class)
+                self.save_pers(p, indent + 6)
+                write(indent4)
+                write('</%s>' % key_class)
+            if record is not None:
+                record.append((begin + 1, '<name>'))
+                record.append((len(out) - 1, '</name>'))
+            self._wrap('value', value, indent4)
+            write(indent2)
+            if record is not None:
+                record.append((len(out), '</attribute>'))
+            write(item_end)
+
+        write(indent)
+        if record is not None:
+            record.append((len(out), '</attributes>'))
+        write('</%s>' % tag)
+
+    def save_inst(self, obj, indent):
+        cls = obj.__class__
+
+        registered = _writers.get(cls)
+        if registered is not None:
+            return self.save_registered(obj, indent, *registered)
+
+        if hasattr(obj, '__getinitargs__'):
+            args = obj.__getinitargs__()
+            len(args) # XXX Assert it's a sequence
+            self._keep.append(args)
+        else:
+            args = ()
+
+        return self._save_object(indent, obj, cls, args, classic=True)
+    dispatch[InstanceType] = save_inst
+
+    def _save_object(self, indent, obj, func, args, state=None,
+                     listitems=None, dictitems=None, classic=False):
+        # Save an instance as ppml.Initialized_Object outputs it.
+        #
+        # It is written as an <initialized_object> at first.  Once we
+        # know what its arguments and state became, it may have to be
+        # rewritten as an <object> or <classic_object>.
+        out = self._out
+        write = self._write
+        memo = self.memo
+        start = len(out)
+
+        node = _Node('object')
+        write(indent)
+        write('<initialized_object')
+        write(node)
+        write('>')
+        klass = self._wrap('klass', func, indent + 2)
+
+        arguments = len(out)
+        items = []
+        write(indent + 2)
+        write('<arguments>')
+        if classic:
+            # OBJ puts the arguments in a new tuple
+            write(indent + 4)
+            if args:
+                write('<tuple>')
+                save = self.save
+                for arg in args:
+                    begin = len(out)
+                    items.append((save(arg, indent + 6), begin, len(out)))
+                write(indent + 4)
+                write('</tuple>')
+                args_node = _Node('tuple', size=len(args))
+            else:
+                write('<tuple />')
+                args_node = _EMPTY_TUPLE
+            write(indent + 2)
+        else:
+            begin = len(out)
+            args_node = self._save_args(args, indent + 4, items)
+            if args_node.scalar:
+                out[begin] = _SP
+                write(_SP)
+            else:
+                write(indent + 2)
+        write('</arguments>')
+
+        if not classic and id(obj) in memo:
+            # The object is recursive, so it got saved while its
+            # arguments were.  The pickler throws away what it wrote
+            # and gets the object from the memo.  Anything it writes
+            # after that doesn't show up in the XML.
+            del out[start:]
+            result = self._get(memo[id(obj)], indent)
+            begin = len(out)
+            if listitems is not None:
+                for x in listitems:
+                    self.save(x, indent)
+            if state is not None:
+                self.save(state, indent)
+            del out[begin:]
+            return result
+
+        self._memoize(obj, node)
+
+        # The items are added by APPENDS and SETITEMS before the state
+        # is set.
+        items_written = False
+        if listitems is not None:
+            save = self.save
+            for x in listitems:
+                if not items_written:
+                    write(indent + 2)
+                    write('<listitems>')
+                    items_written = True
+                save(x, indent + 4)
+            if items_written:
+                write(indent + 2)
+                write('</listitems>')
+
+        if dictitems is not None:
+            dictitems = list(dictitems)
+            if dictitems:
+                write(indent + 2)
+                write('<dictitems>')
+                self._save_items(dictitems, indent + 2, _DICTITEMS)
+                items_written = True
+
+        if classic:
+            try:
+                getstate = obj.__getstate__
+            except AttributeError:
+                state = obj.__dict__
+            else:
+                state = getstate()
+                self._keep.append(state)
+        elif state is None:
+            write(indent)
+            write('</initialized_object>')
+            return node
+
+        p = None
+        pid = self._pid
+        if pid is not None:
+            p = pid(state)
+
+        if (p is None and type(state) is DictionaryType
+            and id(state) not in memo and not items_written):
+            form, nodes = self._form(klass, args_node, items)
+        else:
+            form = 'initialized'
+
+        if form == 'initialized':
+            if p is None:
+                self._wrap('state', state, indent + 2,
+                           self._save_unpersisted)
+            else:
+                write(indent + 2)
+                write('<state>')
+                self.save_pers(p, indent + 4)
+                write(indent + 2)
+                write('</state>')
+            write(indent)
+            write('</initialized_object>')
+            return node
+
+        if form == 'classic':
+            # The klass element is kept, but the arguments, and the id,
+            # are dropped.
+            del out[arguments:]
+            out[start + 1:start + 4] = ['<classic_object>']
+            self.save_dict(state, indent + 2, _ATTRIBUTES)
+            write(indent)
+            write('</classic_object>')
+            return node
+
+        # The first argument becomes the klass, and everything else
+        # but the state, including the id, is dropped.
+        klass = self._klass(items[0], indent + 2)
+        if not nodes:
+            out[start:] = [indent, '<object>'] + klass
+            self.save_dict(state, indent + 2, _ATTRIBUTES)
+            write(indent)
+            write('</object>')
+            return node
+
+        write(indent + 2)
+        write('<state>')
+        begin = len(out)
+        record = []
+        self.save_dict(state, indent + 4, _DICTIONARY, record)
+        attributes = _shift(out[begin:], -2)
+        for i, f in record:
+            attributes[i - begin] = f
+        write(indent + 2)
+        write('</state>')
+        write(indent)
+        write('</initialized_object>')
+        out[start:] = [_Choice(nodes, out[start:],
+                               [indent, '<object>'] + klass + attributes
+                               + [indent, '</object>'])]
+        return node
+
+    def _save_args(self, args, indent, items):
+        # save() for reduce arguments, passing items to save_tuple
+        pid = self._pid
+        if pid is not None:
+            p = pid(args)
+            if p is not None:
+                return self.save_pers(p, indent)
+
+        x = self.memo.get(id(args))
+        if x is not None:
+            return self._get(x, indent)
+
+        if type(args) is TupleType:
+            return self.save_tuple(args, indent, items)
+
+        return self._reduce(args, indent)
+
+    def _form(self, klass, args, items):
+        # Decide which element Initialized_Object.output would use
+        # for an instance with a dictionary state.  Returns the form and,
+        # for the object form, the nodes that must not get an id.
+        if (args.node == 'tuple' and args.size == 3
+            and items[2][0] is not _BOOL):
+            nodes = []
+            for same in (_same_global(klass, 'copy_reg', '_reconstructor'),
+                         _same_global(items[1][0], '__builtin__', 'object'),
+                         ):
+                if same is False:
+                    break
+                if same is not True:
+                    nodes.append(same)
+            else:
+                return 'object', nodes
+
+        if args.node == 'tuple' and args.size == 0:
+            return 'classic', None
+
+        return 'initialized', None
+
+    def _klass(self, item, indent):
+        # The klass element for an argument that was saved at indent + 4
+        node, begin, end = item
+        fragments = self._out[begin:end]
+        if node.scalar:
+            fragments[0] = _SP
+            return [indent, '<klass>'] + fragments + [_SP, '</klass>']
+        return ([indent, '<klass>'] + _shift(fragments, -2)
+                + [indent, '</klass>'])
+
+    def save_registered(self, obj, indent, tag, writer):
+        # An instance of a class registered with registry.register
+        attributes = _attributes(writer(obj))
+        node = self._memoize(obj, _Node(tag, True))
+        write = self._write
+        write(indent)
+        write('<' + tag)
+        write(node)
+        write(attributes + '/>')
+        return node
+
+    def save_global(self, obj, indent, name=None):
+        if name is None:
+            name = obj.__name__
+
+        module = getattr(obj, "__module__", None)
+        if module is None:
+            module = whichmodule(obj, name)
+
+        try:
+            __import__(module)
+            mod = sys.modules[module]
+            klass = getattr(mod, name)
+        except (ImportError, KeyError, AttributeError):
+            raise PicklingError(
+                "Can't pickle %r: it's not found as %s.%s" %
+                (obj, module, name))
+        else:
+            if klass is not obj:
+                raise PicklingError(
+                    "Can't pickle %r: it's not the same object as %s.%s" %
+                    (obj, module, name))
+
+        node = _Node('global')
+        node.module = module
+        node.name = name
+        write = self._write
+        write(indent)
+        write('<global')
+        write(node)
+        write(' name="%s" module="%s"/>' % (name, module))
+        return self._memoize(obj, node)
+    dispatch[ClassType] = save_global
+    dispatch[FunctionType] = save_global
+    dispatch[BuiltinFunctionType] = save_global
+    dispatch[TypeType] = save_global
+
+    # With a cache, values of the _cacheable types are saved by
+    # save_cached, which saves them with the class's dispatch table,
+    # unless their _Fragment is in the cache.  The values in a value
+    # being cached aren't looked up, as what they memoize would then
+    # be missing from its fragment.
+
+    def save_cached(self, obj, indent):
+        t = type(obj)
+        save = self.__class__.dispatch[t]
+        if (self._caching or self._pid is not None
+            or (t is not TupleType and len(obj) < _MIN_LENGTH)):
+            return save(self, obj, indent)
+
+        cache = self.cache
+        fragment = cache.get(obj)
+        memo = self.memo
+        if (fragment is not None
+            and fragment.encoding in (None, self.binary_encoding)
+            and not any(imap(memo.__contains__, fragment.memo))):
+            cache.count(True)
+            ids = self._shared_ids
+            self._got = fragment.paste(ids, self._got)
+            memo.update(fragment.memo)
+            write = self._write
+            write(indent)
+            write(_Pasted(fragment, indent, ids))
+            return memo[id(obj)]
+        cache.count(False)
+
+        out = self._out
+        start = len(out)
+        got = self._got
+        self._caching = True
+        try:
+            node = save(self, obj, indent)
+        finally:
+            self._caching = False
+        if (memo.get(id(obj)) is node and node.node != 'identifier'
+            and (t is not TupleType or len(out) - start >= _MIN_LENGTH)):
+            fragment = self._fragment(out[start+1:], indent, got)
+            if fragment is not None:
+                cache.put(obj, fragment)
+        return node
+
+    def _fragment(self, fragments, indent, got):
+        # The _Fragment of the fragments written for a value, after the
+        # indentation before it, while the ids from got on were given,
+        # or None if they can't be reused.  Its nodes are _Shared
+        # copies, as the value's own nodes get ids in this pickler.
+        result = []
+        nodes = []
+        shared = []
+        references = []
+        encoding = None
+        for f in fragments:
+            c = f.__class__
+            if c is str:
+                if f.startswith('<reference id="'):
+                    references.append(f[15:-3])
+                    f = _Reference(None)
+            elif c is int:
+                if f != _SP:
+                    f -= indent
+            elif c is _Node:
+                if type(getattr(f, 'obj', None)) not in _cacheable:
+                    return None
+                nodes.append(f)
+                f = _Shared(f.node, f.scalar, f.size)
+                f.obj = nodes[-1].obj
+                shared.append(f)
+            elif c is _Encoded:
+                f = ''.join(f.choose())
+                encoding = self.binary_encoding
+            else:
+                return None
+            result.append(f)
+
+        # The references must be to nodes in the value, which got the
+        # ids from got on
+        referred = [(int(node.id[1:]), copy)
+                    for node, copy in zip(nodes, shared)
+                    if node.id is not None]
+        if len(referred) != self._got - got:
+            return None
+        ids = dict(('o%d' % n, copy) for n, copy in referred)
+        references = iter(references)
+        for f in result:
+            if f.__class__ is _Reference:
+                f.node = ids.get(references.next())
+                if f.node is None:
+                    return None
+        referred.sort()
+        return _Fragment(result, shared, [copy for n, copy in referred],
+                         encoding)
+
+_cacheable = StringType, UnicodeType, TupleType
+
+_default_persistent_id = ToXMLPickler.__dict__['persistent_id']
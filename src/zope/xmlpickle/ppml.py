@@ -13,23 +13,49 @@
 """Provide conversion between Python pickles and XML.
 
 """
-# TODO: This doesn't work properly for protocol 2 pickles yet; that
-# still needs to be dealt with.  Particular issues that need to be
-# addressed involve supporting the changes for new-style objects.
 
 import base64
+import binascii
 import marshal
 import re
 import struct
 
-from pickle import Unpickler
+from copy_reg import _extension_registry, _inverted_registry
+from pickle import Unpickler, decode_long, encode_long
 from pickle import \
      PERSID, NONE, INT, BININT, BININT1, BININT2, LONG, FLOAT, \
      BINFLOAT, STRING, BINSTRING, SHORT_BINSTRING, UNICODE, \
      BINUNICODE, TUPLE, EMPTY_TUPLE, EMPTY_LIST, EMPTY_DICT, LIST, \
      DICT, INST, OBJ, GLOBAL, REDUCE, GET, BINGET, LONG_BINGET, PUT, \
      BINPUT, LONG_BINPUT, STOP, MARK, BUILD, SETITEMS, SETITEM, \
-     BINPERSID, APPEND, APPENDS
+     BINPERSID, APPEND, APPENDS, \
+     PROTO, NEWOBJ, EXT1, EXT2, EXT4, TUPLE1, TUPLE2, TUPLE3, LONG1, LONG4
+
+# Opcodes of protocols 3 to 5, which the pickle module doesn't know
+BINBYTES = 'B'
+SHORT_BINBYTES = 'C'
+SHORT_BINUNICODE = '\x8c'
+BINUNICODE8 = '\x8d'
+BINBYTES8 = '\x8e'
+EMPTY_SET = '\x8f'
+ADDITEMS = '\x90'
+FROZENSET = '\x91'
+NEWOBJ_EX = '\x92'
+STACK_GLOBAL = '\x93'
+MEMOIZE = '\x94'
+FRAME = '\x95'
+BYTEARRAY8 = '\x96'
+NEXT_BUFFER = '\x97'
+READONLY_BUFFER = '\x98'
+
+HIGHEST_PROTOCOL = 5
+
+# Protocol 3 and later pickles are written by Python 3, which doesn't
+# map these module names to their Python 2 names for them.
+_python3_modules = {
+    'builtins': '__builtin__',
+    'copyreg': 'copy_reg',
+    }
 
 try:
     from pickle import NEWTRUE, NEWFALSE
@@ -84,23 +110,124 @@ def _convert_sub(string):
 def unconvert_string(encoding, string):
     if encoding == 'base64':
         return base64.decodestring(string)
+    elif encoding == 'hex':
+        return binascii.a2b_hex(''.join(string.split()))
     elif encoding:
         raise ValueError('bad encoding', encoding)
 
     return string
 
 def unconvert_unicode(encoding, string):
-    if encoding == 'base64':
-        string = base64.decodestring(string.encode('ascii'))
-    elif encoding:
-        raise ValueError('bad encoding', encoding)
+    if encoding:
+        string = unconvert_string(encoding, string.encode('ascii'))
 
     return string
 
 
+# The encoded text of large binary strings is made and decoded a chunk
+# at a time, so that it is never all in memory.  Base64 chunks are made
+# of whole 57 byte lines, so they add up to what encodestring makes.
+
+_chunk_sizes = {'base64': 57 << 10, 'hex': 1 << 15}
+
+def encode_chunks(string, encoding='base64'):
+    """Generate the encoded text of a binary string in chunks
+
+    With base64, the chunks add up to what base64.encodestring makes,
+    without its final newline.
+    """
+    size = _chunk_sizes.get(encoding)
+    if size is None:
+        raise ValueError('bad encoding', encoding)
+    n = len(string)
+    for i in xrange(0, n, size):
+        chunk = string[i:i+size]
+        if encoding == 'base64':
+            chunk = base64.encodestring(chunk)
+            if i + size >= n:
+                chunk = chunk[:-1]
+            yield chunk
+        else:
+            yield binascii.b2a_hex(chunk)
+
+class Unconverter(object):
+    """Decode encoded text as it is parsed, a chunk at a time
+
+    Whitespace is ignored, and a chunk may end anywhere:
+
+    >>> u = Unconverter('base64')
+    >>> u.append('c3Bh bS')
+    >>> u.append('BhbmQgZWdncw==')
+    >>> u.value()
+    'spam and eggs'
+    """
+
+    _quanta = {'base64': (binascii.a2b_base64, 4),
+               'hex': (binascii.a2b_hex, 2)}
+
+    def __init__(self, encoding):
+        try:
+            self._decode, self._quantum = self._quanta[encoding]
+        except KeyError:
+            raise ValueError('bad encoding', encoding)
+        self._rest = ''
+        self._chunks = []
+
+    def append(self, text):
+        text = self._rest + str(''.join(text.split()))
+        n = len(text)
+        n -= n % self._quantum
+        self._rest = text[n:]
+        if n:
+            self._chunks.append(self._decode(text[:n]))
+
+    def value(self):
+        if self._rest:
+            self._chunks.append(self._decode(self._rest))
+            self._rest = ''
+        return ''.join(self._chunks)
+
+
+def _slot_names(cls):
+    names = []
+    for c in reversed(cls.__mro__):
+        names.extend(c.__dict__.get('__slots__', ()))
+    return names
+
+
 class Base(object):
 
-    id = ''
+    # Nodes have no __dict__, and may be shared by several parents if
+    # they can't be memoized.  A shared node's _id is None.  Otherwise
+    # it's the id assigned when the node is first referred to, if any.
+    __slots__ = ('_id', )
+
+    def _get_id(self):
+        return getattr(self, '_id', None) or ''
+
+    def _set_id(self, id):
+        if self.shared:
+            raise TypeError("Shared nodes can't have ids")
+        self._id = id
+
+    id = property(_get_id, _set_id)
+
+    @property
+    def shared(self):
+        return getattr(self, '_id', '') is None
+
+    def share(self):
+        """Mark the node as shared and return it"""
+        self._id = None
+        return self
+
+    def copy(self):
+        """Return an unshared copy of the node"""
+        copy = object.__new__(self.__class__)
+        for name in _slot_names(self.__class__):
+            if name != '_id' and hasattr(self, name):
+                setattr(copy, name, getattr(self, name))
+        return copy
 
     def __str__(self):
         result = []
@@ -116,10 +243,22 @@ class Base(object):
             return 1
         if type(self) != type(other):
             return 1
-        return self.__dict__ == other.__dict__
+        return self._state() == other._state()
+
+    def _state(self):
+        state = {}
+        for name in _slot_names(self.__class__):
+            if name == '_id':
+                if self.id:
+                    state['id'] = self.id
+            elif hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
 
 class Global(Base):
 
+    __slots__ = ('module', 'name')
+
     def __init__(self, module, name):
         self.module=module
         self.name=name
@@ -141,6 +280,8 @@ _object_global = Global('__builtin__', 'object')
 
 class Scalar(Base):
 
+    __slots__ = ('_v', )
+
     def __init__(self, v):
         self._v=v
 
@@ -162,16 +303,27 @@ class Scalar(Base):
             write('\n')
 
 class Int(Scalar):
-    pass
+    __slots__ = ()
+
+_small_ints = [Int(i).share() for i in range(256)]
+
+def _int(i):
+    if 0 <= i < 256:
+        return _small_ints[i]
+    return Int(i)
 
 class Long(Scalar):
 
+    __slots__ = ()
+
     def value(self):
         result = str(self._v)
         return result
 
 class Float(Scalar):
 
+    __slots__ = ()
+
     def value(self):
         return `self._v`
 
@@ -180,17 +332,21 @@ _binary_char = re.compile("[^\n\t\r -\x7e]").search
 
 class String(Scalar):
 
+    __slots__ = ('encoding', )
+
     def __init__(self, v, encoding=''):
         encoding, v = self.convert(v)
         self.encoding = encoding
         Scalar.__init__(self, v)
 
     def convert(self, string):
-        """Convert a string to a form that can be included in XML text"""
+        """Convert a string to a form that can be included in XML text
+
+        Binary strings are kept as they are, and encoded as they are
+        output.
+        """
         if _binary_char(string):
-            string = base64.encodestring(string)[:-1]
             return 'base64', string
-
         return _convert_sub(string)
 
     def output(self, write, indent=0, strip=0):
@@ -208,7 +364,14 @@ class String(Scalar):
         name = self.__class__.__name__.lower()
 
         write('%s<%s%s%s>' % (' '*indent, name, id, encoding))
-        write(self.value())
+        text = write
+        if write.__class__ is Compact:
+            text = write.text
+        if encoding:
+            for chunk in encode_chunks(self._v, self.encoding):
+                text(chunk)
+        else:
+            text(self.value())
         write('</%s>' % name)
         if not strip:
             write('\n')
@@ -234,18 +397,40 @@ _invalid_xml_char = re.compile(
 
 class Unicode(String):
 
-    def convert(self, string):
+    __slots__ = ()
 
+    def convert(self, string):
         if _invalid_xml_char(string):
-            string = string.encode('utf-8')
-            string = base64.encodestring(string)[:-1]
-            return 'base64', string
-
+            return 'base64', string.encode('utf-8')
         return _convert_sub(string.encode('utf-8'))
 
 
+class Compact(object):
+    """Wrap a write function, dropping the whitespace between elements
+
+    Nodes write their markup with the whitespace around it in separate
+    writes from text, which they pass to the text method.
+
+    >>> out = []
+    >>> String('  spam').output(Compact(out.append), 4)
+    >>> out
+    ['<string>', '  spam', '</string>']
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self.text = write
+
+    def __call__(self, s):
+        s = s.strip()
+        if s:
+            self._write(s)
+
+
 class Wrapper(Base):
 
+    __slots__ = ('_v', )
+
     def __init__(self, v):
         self._v = v
 
@@ -275,6 +460,8 @@ class Wrapper(Base):
 
 class CloseWrapper(Wrapper):
 
+    __slots__ = ()
+
     # TODO: This doesn't do what I want anymore because we can't strip v
     def _output_nonscalar(self, write, name, id, v, str_indent, indent):
         write('%s<%s%s> ' % (str_indent, name, id))
@@ -282,6 +469,9 @@ class CloseWrapper(Wrapper):
         write(' </%s>\n' % name)
 
 class Collection(Base):
+
+    __slots__ = ()
+
     def value(self, write, indent):
         raise AttributeError('value')
 
@@ -303,15 +493,16 @@ class Collection(Base):
             write('%s<%s%s />\n' % (i, name, id))
 
 class Key(Wrapper):
-    pass
+    __slots__ = ()
 
 class Name(Wrapper):
-    pass
+    __slots__ = ()
 
 class Value(Wrapper):
-    pass
+    __slots__ = ()
 
 class Dictionary(Collection):
+    __slots__ = ('_d', )
     key_name = 'key'
     item_name = 'item'
     key_class = Key
@@ -350,17 +541,21 @@ class Dictionary(Collection):
                 write(end)
 
 class Attributes(Dictionary):
+    __slots__ = ()
     key_name = 'name'
     item_name = 'attribute'
     key_class = Name
 
     def __init__(self, dictionary):
-        Dictionary.__init__(self)
-        self.__dict__.update(dictionary.__dict__)
+        self._d = dictionary._d
+        if dictionary.id:
+            self.id = dictionary.id
 
 
 class Sequence(Collection):
 
+    __slots__ = ('_subs', )
+
     def __init__(self, v=None):
         if not v:
             v = []
@@ -383,27 +578,29 @@ class Sequence(Collection):
             v.output(write, indent)
 
 class List(Sequence):
-    pass
+    __slots__ = ()
 
 class Tuple(Sequence):
-    pass
+    __slots__ = ()
 
 class Klass(CloseWrapper):
-    pass
+    __slots__ = ()
 
 class Arguments(CloseWrapper):
-    pass
+    __slots__ = ()
 
 class State(CloseWrapper):
-    pass
+    __slots__ = ()
 
 class Pickle(Wrapper):
-    pass
+    __slots__ = ()
 
 class Persistent(Wrapper):
-    pass
+    __slots__ = ()
 
 class NamedScalar(Scalar):
+    __slots__ = ('name', )
+
     def __init__(self, name):
         self.name = name
 
@@ -412,12 +609,14 @@ class NamedScalar(Scalar):
         if not strip:
             write('\n')
 
-none = NamedScalar("none")
-true = NamedScalar("true")
-false = NamedScalar("false")
+none = NamedScalar("none").share()
+true = NamedScalar("true").share()
+false = NamedScalar("false").share()
 
 class Reference(Scalar):
 
+    __slots__ = ()
+
     def output(self, write, indent=0, strip=0):
         write('%s<reference id="%s"/>' % (' '*indent,self._v))
         if not strip:
@@ -426,26 +625,63 @@ class Reference(Scalar):
 Get=Reference # Get is pickle name, but Reference is nicer name
 
 class Object(Sequence):
-    pass
+    __slots__ = ()
 
 class Classic_Object(Sequence):
-    pass
+    __slots__ = ()
+
+class Set(Sequence):
+    __slots__ = ()
+
+class Frozenset(Sequence):
+    __slots__ = ()
+
+class Listitems(Sequence):
+    __slots__ = ()
+
+class Dictitems(Dictionary):
+    __slots__ = ()
 
 class Initialized_Object(Sequence):
 
+    __slots__ = ('klass', 'args', 'state', 'items')
+
     def __init__(self, klass, args):
         self.klass = klass
         self.args = args
+        self.items = None
         Sequence.__init__(self, [Klass(klass), Arguments(args)])
 
     def __setstate__(self, v):
         self.state = v
-        self.append(State(v))
+        self._subs.append(State(v))
+
+    # The list and dictionary items from a reduce are added with the
+    # APPEND(S) and SETITEM(S) opcodes.
+
+    def _items(self, factory):
+        items = self.items
+        if items.__class__ is not factory:
+            items = self.items = factory()
+            self._subs.append(items)
+        return items
+
+    def append(self, v):
+        self._items(Listitems).append(v)
+
+    def extend(self, v):
+        self._items(Listitems).extend(v)
+
+    def __setitem__(self, k, v):
+        self._items(Dictitems)[k] = v
 
     def output(self, write, indent=0):
         klass = self.klass
         args = self.args
 
+        if self.items is not None:
+            return Sequence.output(self, write, indent)
+
         if (klass == _reconstructor_global and
             isinstance(args, Tuple) and
             len(args) == 3 and
@@ -469,6 +705,14 @@ class Initialized_Object(Sequence):
 
         return Sequence.output(self, write, indent)
 
+class New_Object(Initialized_Object):
+    """An object made by calling klass.__new__(klass, *args)"""
+
+    __slots__ = ()
+
+    def output(self, write, indent=0):
+        return Sequence.output(self, write, indent)
+
 
 class ToXMLUnpickler(Unpickler):
 
@@ -477,10 +721,80 @@ class ToXMLUnpickler(Unpickler):
         self.__put_objects = {}
         self.__get_info = {} # id and object
         self.__got = 0
+        self.__strings = {}
+        self.__globals = {}
+        self.__new_references = [None, None]
+        self.__checkpoint = None
+        self.proto = 0
+
+    def _string(self, v):
+        # Identifier strings are never given ids, so they can be shared
+        if identifier(v):
+            node = self.__strings.get(v)
+            if node is None:
+                node = self.__strings[v] = String(v).share()
+            return node
+        return String(v)
+
+    def _global(self, module, name):
+        if self.proto >= 3:
+            module = _python3_modules.get(module, module)
+        node = self.__globals.get((module, name))
+        if node is None:
+            node = self.__globals[module, name] = Global(module, name).share()
+        return node
 
     def load(self):
         return Pickle(Unpickler.load(self))
 
+    # A checkpoint holds what a pickle in a stream needs from the
+    # pickles before it: the number of ids given out, and, for each
+    # memo key it gets that an earlier pickle put, None if the object
+    # hasn't been given an id yet, (id, None) if it has, or (None, s)
+    # if it's an identifier string s, which is repeated.
+
+    def load_checkpoint(self):
+        """Load a pickle and return it and its checkpoint
+        """
+        checkpoint = self.__got, {}, set()
+        self.__checkpoint = checkpoint
+        try:
+            xmlob = self.load()
+        finally:
+            self.__checkpoint = None
+        return xmlob, checkpoint[:2]
+
+    def restore_checkpoint(self, checkpoint):
+        """Prepare to load the pickle a checkpoint was made for
+
+        The pickles before it needn't be loaded.
+        """
+        got, gets = checkpoint
+        self.__got = got
+        for i, info in gets.iteritems():
+            if info is None:
+                self.__put_objects[i] = Base()
+            elif info[0] is None:
+                self.__get_info[i] = None, self._string(info[1])
+            else:
+                self.__get_info[i] = info
+
+    def __checkpoint_get(self, i):
+        got, gets, puts = self.__checkpoint
+        if i in puts or i in gets:
+            return
+        get_info = self.__get_info.get(i)
+        if get_info is None:
+            ob = self.__put_objects[i]
+            if self.__repeated(ob):
+                gets[i] = None, ob.value()
+            else:
+                gets[i] = None
+        elif get_info[0] is None:
+            gets[i] = None, get_info[1].value()
+        else:
+            gets[i] = get_info[0], None
+
     dispatch = {}
     dispatch.update(Unpickler.dispatch)
 
@@ -515,19 +829,19 @@ class ToXMLUnpickler(Unpickler):
             elif i == 0 and s != "0": # s == "00"
                 self.append(false)
                 return
-        self.append(Int(i))
+        self.append(_int(i))
     dispatch[INT] = load_int
 
     def load_binint(self):
-        self.append(Int(mloads('i' + self.read(4))))
+        self.append(_int(mloads('i' + self.read(4))))
     dispatch[BININT] = load_binint
 
     def load_binint1(self):
-        self.append(Int(mloads('i' + self.read(1) + '\000\000\000')))
+        self.append(_small_ints[ord(self.read(1))])
     dispatch[BININT1] = load_binint1
 
     def load_binint2(self):
-        self.append(Int(mloads('i' + self.read(2) + '\000\000')))
+        self.append(_int(mloads('i' + self.read(2) + '\000\000')))
     dispatch[BININT2] = load_binint2
 
     def load_long(self):
@@ -543,18 +857,18 @@ class ToXMLUnpickler(Unpickler):
     dispatch[BINFLOAT] = load_binfloat
 
     def load_string(self):
-        self.append(String(eval(self.readline()[:-1],
-                                {'__builtins__': {}}))) # Let's be careful
+        self.append(self._string(eval(self.readline()[:-1],
+                                      {'__builtins__': {}}))) # Let's be careful
     dispatch[STRING] = load_string
 
     def load_binstring(self):
         len = mloads('i' + self.read(4))
-        self.append(String(self.read(len)))
+        self.append(self._string(self.read(len)))
     dispatch[BINSTRING] = load_binstring
 
     def load_short_binstring(self):
-        len = mloads('i' + self.read(1) + '\000\000\000')
-        self.append(String(self.read(len)))
+        len = ord(self.read(1))
+        self.append(self._string(self.read(len)))
     dispatch[SHORT_BINSTRING] = load_short_binstring
 
     def load_unicode(self):
@@ -607,7 +921,7 @@ class ToXMLUnpickler(Unpickler):
         del self.stack[k:]
         module = self.readline()[:-1]
         name = self.readline()[:-1]
-        value = Initialized_Object(Global(module, name), args)
+        value = Initialized_Object(self._global(module, name), args)
         self.append(value)
     dispatch[INST] = load_inst
 
@@ -625,7 +939,7 @@ class ToXMLUnpickler(Unpickler):
     def load_global(self):
         module = self.readline()[:-1]
         name = self.readline()[:-1]
-        self.append(Global(module, name))
+        self.append(self._global(module, name))
     dispatch[GLOBAL] = load_global
 
     def load_reduce(self):
@@ -639,22 +953,189 @@ class ToXMLUnpickler(Unpickler):
         self.append(value)
     dispatch[REDUCE] = load_reduce
 
+    # Protocol 2 and later
+
+    def load_proto(self):
+        proto = ord(self.read(1))
+        if not 0 <= proto <= HIGHEST_PROTOCOL:
+            raise ValueError("unsupported pickle protocol: %d" % proto)
+        self.proto = proto
+    dispatch[PROTO] = load_proto
+
+    def load_frame(self):
+        # Frames only matter to readers that want to read ahead
+        self.read(8)
+    dispatch[FRAME] = load_frame
+
+    def load_newobj(self):
+        stack = self.stack
+        klass = stack[-2]
+        args = stack[-1]
+        del stack[-2:]
+        self.append(New_Object(klass, args))
+    dispatch[NEWOBJ] = load_newobj
+
+    def load_newobj_ex(self):
+        stack = self.stack
+        klass, args, kw = stack[-3:]
+        del stack[-3:]
+        if kw.__class__ is Dictionary and not kw:
+            value = New_Object(klass, args)
+        else:
+            value = Initialized_Object(Global('copy_reg', '__newobj_ex__'),
+                                       Tuple([klass, args, kw]))
+        self.append(value)
+    dispatch[NEWOBJ_EX] = load_newobj_ex
+
+    def load_tuple1(self):
+        self.stack[-1] = Tuple([self.stack[-1]])
+    dispatch[TUPLE1] = load_tuple1
+
+    def load_tuple2(self):
+        self.stack[-2:] = [Tuple(self.stack[-2:])]
+    dispatch[TUPLE2] = load_tuple2
+
+    def load_tuple3(self):
+        self.stack[-3:] = [Tuple(self.stack[-3:])]
+    dispatch[TUPLE3] = load_tuple3
+
+    def load_long1(self):
+        n = ord(self.read(1))
+        self.append(Long(decode_long(self.read(n))))
+    dispatch[LONG1] = load_long1
+
+    def load_long4(self):
+        n = mloads('i' + self.read(4))
+        self.append(Long(decode_long(self.read(n))))
+    dispatch[LONG4] = load_long4
+
+    def load_short_binbytes(self):
+        len = ord(self.read(1))
+        self.append(self._string(self.read(len)))
+    dispatch[SHORT_BINBYTES] = load_short_binbytes
+
+    def load_binbytes(self):
+        len = mloads('i' + self.read(4))
+        self.append(self._string(self.read(len)))
+    dispatch[BINBYTES] = load_binbytes
+
+    def load_binbytes8(self):
+        len, = struct.unpack('<Q', self.read(8))
+        self.append(self._string(self.read(len)))
+    dispatch[BINBYTES8] = load_binbytes8
+
+    def load_short_binunicode(self):
+        len = ord(self.read(1))
+        self.append(Unicode(unicode(self.read(len), 'utf-8')))
+    dispatch[SHORT_BINUNICODE] = load_short_binunicode
+
+    def load_binunicode8(self):
+        len, = struct.unpack('<Q', self.read(8))
+        self.append(Unicode(unicode(self.read(len), 'utf-8')))
+    dispatch[BINUNICODE8] = load_binunicode8
+
+    def load_bytearray8(self):
+        len, = struct.unpack('<Q', self.read(8))
+        self.append(Initialized_Object(
+            self._global('__builtin__', 'bytearray'),
+            Tuple([String(self.read(len))])))
+    dispatch[BYTEARRAY8] = load_bytearray8
+
+    def load_next_buffer(self):
+        raise ValueError("out-of-band buffers are not supported")
+    dispatch[NEXT_BUFFER] = load_next_buffer
+
+    def load_readonly_buffer(self):
+        pass
+    dispatch[READONLY_BUFFER] = load_readonly_buffer
+
+    def load_empty_set(self):
+        self.append(Set())
+    dispatch[EMPTY_SET] = load_empty_set
+
+    def load_additems(self):
+        k = self.marker()
+        items = self.stack[k+1:]
+        del self.stack[k:]
+        self.stack[-1].extend(items)
+    dispatch[ADDITEMS] = load_additems
+
+    def load_frozenset(self):
+        k = self.marker()
+        self.stack[k:] = [Frozenset(self.stack[k+1:])]
+    dispatch[FROZENSET] = load_frozenset
+
+    def load_stack_global(self):
+        stack = self.stack
+        name = self.__name(stack.pop())
+        module = self.__name(stack.pop())
+        self.append(self._global(module, name))
+    dispatch[STACK_GLOBAL] = load_stack_global
+
+    def __name(self, node):
+        if node.__class__ is Reference:
+            # The name was memoized by an earlier STACK_GLOBAL.  It
+            # isn't output, so if this reference gave it its id, take
+            # the id back.
+            new_references = self.__new_references
+            last, i = new_references[-1] or (None, None)
+            if node is last:
+                del self.__get_info[i]
+                self.__got -= 1
+                new_references.pop()
+                new_references.insert(0, None)
+                node = self.__put_objects[i]
+                node.id = ''
+            else:
+                for get_id, ob in self.__get_info.itervalues():
+                    if (get_id is not None
+                        and self.idprefix + get_id == node.value()):
+                        node = ob
+                        break
+        return node.value()
+
+    def load_ext1(self):
+        self.__extension(ord(self.read(1)))
+    dispatch[EXT1] = load_ext1
+
+    def load_ext2(self):
+        self.__extension(mloads('i' + self.read(2) + '\000\000'))
+    dispatch[EXT2] = load_ext2
+
+    def load_ext4(self):
+        self.__extension(mloads('i' + self.read(4)))
+    dispatch[EXT4] = load_ext4
+
+    def __extension(self, code):
+        key = _inverted_registry.get(code)
+        if not key:
+            raise ValueError("unregistered extension code %d" % code)
+        self.append(self._global(*key))
+
     idprefix = 'o'
 
+    def __repeated(self, ob):
+        # Is ob repeated wherever it's referred to, rather than
+        # referred to by id?
+        return (ob.__class__ is String
+                and not ob.encoding
+                and identifier(ob.value()))
+
     def __get(self, i):
+        if self.__checkpoint is not None:
+            self.__checkpoint_get(i)
+        new = False
         get_info = self.__get_info.get(i)
         if get_info is None:
             ob = self.__put_objects[i]
-            if (ob.__class__ is String
-                and not ob.encoding
-                and identifier(ob.value())
-                ):
+            if self.__repeated(ob):
                 # We don't want this memoized
                 get_id = None
             else:
                 get_id = `self.__got`
                 self.__got += 1
                 ob.id = self.idprefix+get_id
+                new = True
 
             get_info = get_id, ob
             self.__get_info[i] = get_info
@@ -664,14 +1145,24 @@ class ToXMLUnpickler(Unpickler):
 
         if get_id is not None:
             # Normal case
-            self.append(Get(self.idprefix+get_id))
+            ref = Get(self.idprefix+get_id)
+            if new:
+                new_references = self.__new_references
+                del new_references[0]
+                new_references.append((ref, i))
+            self.append(ref)
         else:
             ob = get_info[1]
             self.append(ob)
 
     def __put(self, i):
         ob = self.stack[-1]
+        if ob.shared and not self.__repeated(ob):
+            # It may be given an id
+            ob = self.stack[-1] = ob.copy()
         self.__put_objects[i] = ob
+        if self.__checkpoint is not None:
+            self.__checkpoint[2].add(i)
 
     def load_get(self):
         i = self.readline()[:-1]
@@ -703,6 +1194,10 @@ class ToXMLUnpickler(Unpickler):
         self.__put(`i`)
     dispatch[LONG_BINPUT] = load_long_binput
 
+    def load_memoize(self):
+        self.__put(`len(self.__put_objects)`)
+    dispatch[MEMOIZE] = load_memoize
+
 
 def ToXMLload(file):
     return ToXMLUnpickler(file).load()
@@ -711,58 +1206,97 @@ def ToXMLloads(str):
     file = StringIO(str)
     return ToXMLUnpickler(file).load()
 
+class _Items(list):
+    """The pickle of the list or dictionary items of an object"""
+
+
+def _tuple_items(v):
+    # The pickle of the items of a tuple, from the pickle of the tuple
+    if v == (EMPTY_TUPLE, ):
+        return ()
+    if v[-1] == TUPLE:
+        return v[1:-1]
+    return v[:-1]
+
+_tuples = {1: TUPLE1, 2: TUPLE2, 3: TUPLE3}
+
+_binint1 = [(BININT1, chr(i)) for i in range(256)]
+_pack_uint2 = struct.Struct('<H').pack
+_pack_int4 = struct.Struct('<i').pack
+
+# Elements whose text isn't stripped
+_text_tags = 'string', 'unicode'
+
+
+class _Unconverting(list):
+    """The stack entry of an encoded string, which decodes its text
+    as it is parsed
+    """
+
+    def __init__(self, tag, attrs):
+        list.__init__(self, (tag, attrs))
+        unconverter = Unconverter(attrs['encoding'])
+        self.append = unconverter.append
+        self.value = unconverter.value
+
+
 class xmlPickler(object):
+    """Make a pickle from XML pickle parser events
 
-    binary = 1
+    Pickles are written with protocol 1 unless another protocol is
+    given.  Protocol 2 pickles are smaller and faster to load, but
+    need Python 2.3 or later.
 
-    def __init__(self):
-        self._stack = []
-        self._push([])
+    Each element is handled, when it ends, by the method named after
+    its tag (global_ for global), which returns the element's pickle as
+    a sequence of strings.  The methods are looked up once per class,
+    in its dispatch table, so subclasses can override them, or add
+    methods for elements of their own.  Parsers may return str or
+    unicode.
+    """
 
-    def _push(self, top):
-        self._stack.append(top)
-        self._append = top.append
+    binary = 1
+    proto = 1
 
-    def _pop(self):
-        _stack = self._stack
-        top = _stack.pop()
-        self._append = _stack[-1].append
-        return top
+    def __init__(self, protocol=None):
+        self._set_protocol(protocol)
+        self.dispatch = _dispatch_table(self.__class__)
+        self._stack = [[]]
+
+    def _set_protocol(self, protocol):
+        if protocol is not None:
+            if protocol not in (1, 2):
+                raise ValueError("unsupported pickle protocol: %r"
+                                 % (protocol, ))
+            self.proto = protocol
 
     def handle_starttag(self, tag, attrs):
 
         # Convert attrs to dict, if necessary
         if type(attrs) is list:
-            x=0
-            temp={}
-            while x<len(attrs):
-                temp[attrs[x]]=attrs[x+1]
-                x=x+2
-            attrs=temp
-
-        self._push([tag, attrs])
-
-    def handle_endtag(self, tag):
-        top = self._pop()
+            attrs = dict(zip(attrs[::2], attrs[1::2]))
 
-        if tag == 'global':
-            top = self.global_(tag, top)
+        if 'encoding' in attrs and (tag == 'string' or tag == 'unicode'):
+            self._stack.append(_Unconverting(tag, attrs))
         else:
-            try:
-                m = getattr(self, tag)
-            except AttributeError:
-                try: tag = tag.encode('us-ascii')
-                except: pass
-                raise ValueError(
-                    "unrecognized element in XML pickle: %r" % tag)
-            else:
-                top = m(tag, top)
+            self._stack.append([tag, attrs])
 
-        self._append(top)
+    def handle_endtag(self, tag):
+        stack = self._stack
+        top = stack.pop()
+        end = self.dispatch.get(tag)
+        if end is None:
+            try: tag = tag.encode('us-ascii')
+            except: pass
+            from zope.xmlpickle.registry import _reader
+            _reader(tag)
+            end = xmlPickler.registered
+        stack[-1].append(end(self, tag, top))
 
     def handle_data(self, data):
-        if data.strip() or (self._stack[-1][0] in ('string', 'unicode')):
-            self._append(data)
+        top = self._stack[-1]
+        if data.strip() or top[0] in _text_tags:
+            top.append(data)
 
     def get_value(self):
         for s in self._stack[0][0]:
@@ -778,6 +1312,9 @@ class xmlPickler(object):
         else:
             v += STOP_tuple
 
+        if self.proto >= 2:
+            v = [PROTO + chr(self.proto)] + list(v)
+
         return v
 
     def none(self, tag, data, NONE_tuple = (NONE, )):
@@ -790,7 +1327,15 @@ class xmlPickler(object):
         return FALSE,
 
     def long(self, tag, data):
-        return ((LONG + ''.join(data[2:]).strip().encode('ascii') + 'L\n'), )
+        v = ''.join(data[2:]).strip().encode('ascii')
+        if self.proto >= 2:
+            v = encode_long(long(v, 0))
+            l = len(v)
+            if l < 256:
+                return LONG1, chr(l), v
+            return LONG4, struct.pack('<i', l), v
+
+        return ((LONG + v + 'L\n'), )
 
     def save_wrapper(self, tag, data):
         return data[2]
@@ -820,25 +1365,18 @@ class xmlPickler(object):
         if self.binary:
             object = int(object)
 
-            # If the int is small enough to fit in a signed 4-byte 2's-comp
-            # format, we can store it more efficiently than the general
-            # case.
+            if 0 <= object < 256:
+                return _binint1[object]
+            if 0 <= object < 65536:
+                return BININT2, _pack_uint2(object)
+            # If the int fits in a signed 4-byte 2's-comp format, we
+            # can store it more efficiently than the general case.
             high_bits = object >> 31  # note that Python shift sign-extends
             if  high_bits == 0 or high_bits == -1:
-                # All high bits are copies of bit 2**31, so the value
-                # fits in a 4-byte signed int.
-                i = mdumps(object)[1:]
-                assert len(i) == 4
-                if i[-2:] == '\000\000':    # fits in 2-byte unsigned int
-                    if i[-3] == '\000':     # fits in 1-byte unsigned int
-                        return (BININT1, i[0])
-                    else:
-                        return (BININT2, i[:2])
-                else:
-                    return (BININT, i)
+                return BININT, _pack_int4(object)
 
         # Text pickle, or int too big to fit in signed 4-byte format.
-        return (INT, object, '\n')
+        return (INT, str(object), '\n')
 
     def float(self, tag, data):
         v = ''.join(data[2:]).strip().encode('ascii')
@@ -864,22 +1402,21 @@ class xmlPickler(object):
         return self.put(v, attrs)
 
     def string(self, tag, data):
-        v = ''.join(data[2:]).encode('ascii')
-        attrs = data[1]
-        encoding = attrs.get('encoding')
-        if encoding:
-            v = unconvert_string(encoding, v)
-
-        return self._string(v, attrs)
+        if data.__class__ is _Unconverting:
+            v = data.value()
+        else:
+            v = ''.join(data[2:]).encode('ascii')
+        return self._string(v, data[1])
 
     def unicode(self, tag, data):
-        v = ''.join(data[2:]).encode('utf-8')
+        if data.__class__ is _Unconverting:
+            v = data.value()
+        else:
+            v = ''.join(data[2:])
+            if v.__class__ is unicode:
+                v = v.encode('utf-8')
         attrs = data[1]
 
-        encoding = attrs.get('encoding')
-        if encoding:
-            v = unconvert_unicode(encoding, v)
-
         if self.binary:
             # v = v.encode('utf-8')
             l = len(v)
@@ -899,6 +1436,13 @@ class xmlPickler(object):
         if not T:
             return (EMPTY_TUPLE, )
 
+        if self.proto >= 2 and len(T) <= 3:
+            v = []
+            for x in T:
+                v.extend(x)
+            v.append(_tuples[len(T)])
+            return self.put(v, data[1])
+
         v = [MARK]
         for x in T:
             v.extend(x)
@@ -1016,25 +1560,48 @@ class xmlPickler(object):
 
         v = [MARK]
         v.extend(data[2])
-
-        if args_pickle != (EMPTY_TUPLE, ):
-            v.extend(args_pickle[1:-1])
-
+        v.extend(_tuple_items(args_pickle))
         v.append(OBJ)
 
         v = self.put(v, data[1])
 
-        if len(data) > 4:
-            v.extend(data[4])
-            v.append(BUILD)
+        return self._items_and_state(v, data[4:])
+
+    def _items_and_state(self, v, data):
+        for x in data:
+            v.extend(x)
+            if x.__class__ is not _Items:
+                v.append(BUILD)
+
+        return v
+
+    def listitems(self, tag, data):
+        return self._items(data[2:], APPENDS)
+
+    def dictitems(self, tag, data):
+        return self._items(data[2:], SETITEMS)
+
+    def _items(self, items, opcode):
+        v = _Items()
+        if items:
+            v.append(MARK)
+            for x in items:
+                v.extend(x)
+            v.append(opcode)
 
         return v
 
     def object(self, tag, data):
-        v = ['(ccopy_reg\n_reconstructor\n']
-        v.extend(data[2])
-        v.append('c__builtin__\nobject\nN')
-        v.append(OBJ)
+        if self.proto >= 2:
+            # What copy_reg.__reduce_ex__ does for protocol 2
+            v = list(data[2])
+            v.append(EMPTY_TUPLE)
+            v.append(NEWOBJ)
+        else:
+            v = ['(ccopy_reg\n_reconstructor\n']
+            v.extend(data[2])
+            v.append('c__builtin__\nobject\nN')
+            v.append(OBJ)
 
         v = self.put(v, data[1])
         v.extend(data[3])
@@ -1042,6 +1609,37 @@ class xmlPickler(object):
 
         return v
 
+    def new_object(self, tag, data):
+        v = list(data[2])
+        v.extend(data[3])
+        v.append(NEWOBJ)
+
+        v = self.put(v, data[1])
+
+        return self._items_and_state(v, data[4:])
+
+    # expat gives us unicode tags, so look the globals up
+    _set_globals = {
+        'set': GLOBAL + '__builtin__\nset\n',
+        'frozenset': GLOBAL + '__builtin__\nfrozenset\n',
+        }
+
+    def set(self, tag, data):
+        # cPickle doesn't know EMPTY_SET, so reduce
+        v = [self._set_globals[tag], MARK, EMPTY_LIST]
+        S = data[2:]
+        if S:
+            v.append(MARK)
+            for x in S:
+                v.extend(x)
+            v.append(APPENDS)
+        v.append(TUPLE)
+        v.append(REDUCE)
+
+        return self.put(v, data[1])
+
+    frozenset = set
+
     def classic_object(self, tag, data):
         v = [MARK]
         v.extend(data[2])
@@ -1058,6 +1656,17 @@ class xmlPickler(object):
         module = attrs['module'].encode('ascii')
         name = attrs['name'].encode('ascii')
 
+        if self.proto >= 2:
+            code = _extension_registry.get((module, name))
+            if code:
+                if code <= 0xff:
+                    v = EXT1 + chr(code)
+                elif code <= 0xffff:
+                    v = EXT2 + chr(code & 0xff) + chr(code >> 8)
+                else:
+                    v = EXT4 + struct.pack('<i', code)
+                return self.put((v, ), attrs)
+
         return self.put((GLOBAL, module, '\n', name, '\n'), attrs)
 
     def item(self, tag, data, key_name = 'key'):
@@ -1086,3 +1695,267 @@ class xmlPickler(object):
 
     def attribute(self, tag, data):
         return self.item(tag, data, 'name')
+
+    def registered(self, tag, data):
+        # An element of a class registered with registry.register,
+        # pickled as a call of registry._load(tag, attributes)
+        if len(data) > 2:
+            raise ValueError("registered elements have no content")
+        attrs = data[1]
+        items = []
+        for name in sorted(attrs):
+            if name != 'id':
+                value = attrs[name]
+                if type(value) is unicode:
+                    value = value.encode('utf-8')
+                v = list(self._string(name.encode('ascii'), {}))
+                v.extend(self._string(value, {}))
+                items.append(v)
+        v = [GLOBAL + 'zope.xmlpickle.registry\n_load\n', MARK]
+        v.extend(self._string(tag, {}))
+        v.extend(self.dictionary('dictionary', ['dictionary', {}] + items))
+        v.append(TUPLE)
+        v.append(REDUCE)
+        return self.put(v, attrs)
+
+    dispatch = {}
+    for tag in ('pickle', 'none', 'true', 'false', 'long', 'arguments',
+                'value', 'key', 'name', 'klass', 'state', 'persis',
+                'persistent', 'int', 'float', 'string', 'unicode', 'tuple',
+                'list', 'dictionary', 'attributes', 'reference',
+                'initialized_object', 'listitems', 'dictitems', 'object',
+                'new_object', 'set', 'frozenset', 'classic_object', 'item',
+                'attribute'):
+        dispatch[tag] = locals()[tag]
+    dispatch['global'] = global_
+    del tag
+
+_dispatch_tables = {xmlPickler: xmlPickler.dispatch}
+
+def _dispatch_table(klass):
+    """The tag methods of an xmlPickler class, by tag"""
+    table = _dispatch_tables.get(klass)
+    if table is None:
+        table = {}
+        for base in klass.__mro__:
+            if issubclass(xmlPickler, base):
+                break
+            # Public methods xmlPickler doesn't have are for new tags
+            for name, end in base.__dict__.iteritems():
+                if (callable(end) and not name.startswith('_')
+                    and not hasattr(xmlPickler, name)):
+                    table.setdefault(name, end)
+        for tag, end in klass.dispatch.iteritems():
+            end = getattr(klass, end.__name__, end)
+            table[tag] = getattr(end, 'im_func', end)
+        _dispatch_tables[klass] = table
+    return table
+
+
+class _Open(object):
+    """An element whose pickle is written while it is being parsed
+
+    mark is written before the first child, after maps a child count
+    to data written once that many children are done, and suffix is
+    written at the end tag, or empty instead if there were no children.
+    The child at index collect, if any, isn't streamed; its pickle is
+    collected and then trimmed to the contents of the tuple it holds,
+    as xmlPickler.initialized_object does with its arguments.  Like
+    xmlPickler, only the first keep children are used, if keep is set.
+    """
+
+    def __init__(self, tag, write, mark='', after=None,
+                 suffix='', empty='', collect=None, keep=None):
+        self.tag = tag
+        self._write = write
+        self.mark = mark
+        self.after = after
+        self.suffix = suffix
+        self.empty = empty
+        self.collect = collect
+        self.keep = keep
+        self.count = 0
+
+    def streams(self):
+        """Can the next child be written as it is parsed?"""
+        count = self.count
+        return count != self.collect and (self.keep is None
+                                          or count < self.keep)
+
+    def start_child(self):
+        if not self.count and self.mark:
+            self._write(self.mark)
+
+    def end_child(self):
+        self.count += 1
+        if self.after:
+            after = self.after.get(self.count)
+            if after:
+                self._write(after)
+
+    def append(self, v):
+        # Add a child whose pickle was collected
+        if self.keep is not None and self.count >= self.keep:
+            self.count += 1
+            return
+        if self.count == self.collect:
+            v = _tuple_items(v)
+            if not v:
+                return self.end_child()
+        self.start_child()
+        self._write(''.join(v))
+        self.end_child()
+
+    def close(self):
+        if self.count:
+            self._write(self.suffix)
+        else:
+            self._write(self.empty)
+
+
+class xmlStreamingPickler(xmlPickler):
+    """An xmlPickler that writes the pickle while the XML is parsed
+
+    Pickle data is passed to write as soon as it is known, so apart
+    from scalars and the arguments of initialized objects, which are
+    collected as xmlPickler does, only data about the open elements is
+    kept.  The pickle written is the same as xmlPickler makes.
+    """
+
+    def __init__(self, write, protocol=None):
+        self._set_protocol(protocol)
+        if self.proto >= 2:
+            # The size of tuples isn't known until they end
+            self._streamed = dict(self._streamed)
+            del self._streamed['tuple']
+        self.dispatch = _dispatch_table(self.__class__)
+        self._write = write
+        self._stack = [_Open(None, write)]
+
+    def handle_starttag(self, tag, attrs):
+        top = self._stack[-1]
+        start = self._streamed.get(tag)
+        if start is None or top.__class__ is not _Open or not top.streams():
+            return xmlPickler.handle_starttag(self, tag, attrs)
+
+        if type(attrs) is list:
+            attrs = dict(zip(attrs[::2], attrs[1::2]))
+
+        top.start_child()
+        self._stack.append(start(self, tag, attrs))
+
+    def handle_endtag(self, tag):
+        top = self._stack[-1]
+        if top.__class__ is not _Open:
+            return xmlPickler.handle_endtag(self, tag)
+
+        self._stack.pop()
+        top.close()
+        self._stack[-1].end_child()
+
+    def handle_data(self, data):
+        top = self._stack[-1]
+        if top.__class__ is _Open:
+            if data.strip():
+                top.append(data)
+        else:
+            xmlPickler.handle_data(self, data)
+
+    def get_value(self):
+        raise TypeError("The pickle has been written")
+
+    def _put(self, v, attrs):
+        return ''.join(self.put(v, attrs))
+
+    def _start_wrapper(self, tag, attrs):
+        return _Open(tag, self._write, keep=1)
+
+    def _start_pickle(self, tag, attrs):
+        if self.proto >= 2:
+            self._write(PROTO + chr(self.proto))
+        return _Open(tag, self._write, suffix=STOP, empty=STOP, keep=1)
+
+    def _start_persistent(self, tag, attrs):
+        return _Open(tag, self._write, suffix=BINPERSID, empty=BINPERSID,
+                     keep=1)
+
+    def _start_list(self, tag, attrs):
+        self._write(self._put((EMPTY_LIST, ), attrs))
+        return _Open(tag, self._write, mark=MARK, suffix=APPENDS)
+
+    def _start_dictionary(self, tag, attrs):
+        self._write(self._put((EMPTY_DICT, ), attrs))
+        return _Open(tag, self._write, mark=MARK, suffix=SETITEMS)
+
+    def _start_tuple(self, tag, attrs):
+        return _Open(tag, self._write, mark=MARK,
+                     suffix=self._put((TUPLE, ), attrs), empty=EMPTY_TUPLE)
+
+    def _start_item(self, tag, attrs):
+        key_name = tag == 'item' and 'key' or 'name'
+        if key_name in attrs:
+            key = attrs[key_name].encode('ascii')
+            self._write(''.join(self._string(key, attrs)))
+            return _Open(tag, self._write, keep=1)
+        return _Open(tag, self._write, keep=2)
+
+    def _start_classic_object(self, tag, attrs):
+        self._write(MARK)
+        return _Open(tag, self._write, after={1: self._put((OBJ, ), attrs)},
+                     suffix=BUILD, empty=BUILD, keep=2)
+
+    def _start_object(self, tag, attrs):
+        if self.proto >= 2:
+            obj = EMPTY_TUPLE + self._put((NEWOBJ, ), attrs)
+        else:
+            self._write('(ccopy_reg\n_reconstructor\n')
+            obj = 'c__builtin__\nobject\nN' + self._put((OBJ, ), attrs)
+        return _Open(tag, self._write, after={1: obj},
+                     suffix=BUILD, empty=BUILD, keep=2)
+
+    def _start_state(self, tag, attrs):
+        return _Open(tag, self._write, suffix=BUILD, empty=BUILD, keep=1)
+
+    def _start_items(self, tag, attrs):
+        return _Open(tag, self._write, mark=MARK,
+                     suffix=tag == 'listitems' and APPENDS or SETITEMS)
+
+    def _start_new_object(self, tag, attrs):
+        return _Open(tag, self._write,
+                     after={2: self._put((NEWOBJ, ), attrs)})
+
+    def _start_set(self, tag, attrs):
+        self._write(self._set_globals[tag] + MARK + EMPTY_LIST)
+        reduce = TUPLE + self._put((REDUCE, ), attrs)
+        return _Open(tag, self._write, mark=MARK, suffix=APPENDS + reduce,
+                     empty=reduce)
+
+    def _start_initialized_object(self, tag, attrs):
+        self._write(MARK)
+        return _Open(tag, self._write,
+                     after={2: self._put((OBJ, ), attrs)}, collect=1)
+
+    _streamed = {
+        'pickle': _start_pickle,
+        'persistent': _start_persistent,
+        'persis': _start_persistent,
+        'list': _start_list,
+        'dictionary': _start_dictionary,
+        'attributes': _start_dictionary,
+        'tuple': _start_tuple,
+        'item': _start_item,
+        'attribute': _start_item,
+        'key': _start_wrapper,
+        'value': _start_wrapper,
+        'name': _start_wrapper,
+        'klass': _start_wrapper,
+        'state': _start_state,
+        'listitems': _start_items,
+        'dictitems': _start_items,
+        'classic_object': _start_classic_object,
+        'object': _start_object,
+        'initialized_object': _start_initialized_object,
+        'new_object': _start_new_object,
+        'set': _start_set,
+        'frozenset': _start_set,
+        }
@@ -0,0 +1,366 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Load one value out of an XML pickle
+
+`select` loads the value of one element of an XML pickle, chosen by a
+path, without loading the rest:
+
+>>> from zope.xmlpickle import dumps
+>>> l = ['spam']
+>>> xml = dumps({'eggs': l, 'ham': [1.5, l], 'toast': 2})
+>>> select(xml, 'item[@key="ham"]')
+[1.5, ['spam']]
+>>> select(xml, 'item[@key="ham"]/list/float')
+1.5
+>>> select(xml, 'item[3]')
+2
+
+A path is a list of steps separated by slashes, starting from the
+children of the pickled object's element.  A step is an element name,
+followed by any number of predicates: [@name="value"] is true of the
+elements with that attribute value, and [n] of the nth of the
+elements that the step is otherwise true of, counting from 1.  The
+first element the path matches is selected, and its value is what
+loads() makes of it, except that the value of an item or attribute is
+its value rather than its key and value.  The empty path selects the
+pickled object.  If nothing matches, KeyError is raised:
+
+>>> select(xml, 'item[4]')
+Traceback (most recent call last):
+...
+KeyError: 'item[4]'
+
+The XML is read in two passes.  The first finds the element, and the
+ids of the values that it refers to, and of the values that those
+values refer to, and so on, and stops once they are all known.  The
+second parses only the element and the elements with those ids,
+starting at each one's offset, so classes named in the rest of the
+pickle aren't imported.  Selecting the pickled object itself is
+slower than loads(), though.
+
+"""
+
+import re
+from xml.parsers import expat
+
+from zope.xmlpickle.unpickler import XMLUnpickler, _memo_key
+
+_step = re.compile(r'^([A-Za-z_][\w.-]*)((?:\[[^\]]*\])*)$').match
+_predicate = re.compile(
+    r'''\[\s*(?:(\d+)|@([A-Za-z_][\w.-]*)\s*=\s*(?:"([^"]*)"|'([^']*)'))'''
+    r'''\s*\]''')
+
+# The attribute that holds the key of an item or attribute, if the key
+# is an identifier string
+_key_names = {'item': 'key', 'attribute': 'name'}
+
+_chunk = 1 << 16
+
+
+class _Done(Exception):
+    """Stop parsing"""
+
+
+def _parse_path(path):
+    # [(tag, {attribute: value}, index or None)] for each step
+    if type(path) is unicode:
+        path = path.encode('utf-8')
+    steps = []
+    for text in path and path.split('/') or ():
+        match = _step(text.strip())
+        if match is None:
+            raise ValueError("bad path step: %r" % text)
+        tag, predicates = match.groups()
+        attrs = {}
+        index = None
+        end = 0
+        for p in _predicate.finditer(predicates):
+            if p.start() != end:
+                raise ValueError("bad path step: %r" % text)
+            end = p.end()
+            n, name, value, value2 = p.groups()
+            if n:
+                index = int(n)
+            elif value is None:
+                attrs[name] = value2
+            else:
+                attrs[name] = value
+        if end != len(predicates):
+            raise ValueError("bad path step: %r" % text)
+        steps.append((tag, attrs, index))
+    return steps
+
+
+class _Path(object):
+    # Follows the elements that are open, to find the first that a path
+    # matches.  The <pickle> element and the pickled object's element
+    # are levels 1 and 2, and an element that a step matches is at the
+    # level after its parent's.
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.depth = 0          # of the open elements
+        self.level = 0          # of the innermost open element matched
+        self.counts = [0] * len(steps)
+        self.found = False
+
+    def start(self, tag, attrs):
+        """Open an element, and return whether it's the one selected"""
+        depth = self.depth
+        self.depth = depth + 1
+        if self.found or self.level != depth:
+            return False
+        if depth >= 2:
+            step, step_attrs, index = self.steps[depth - 2]
+            if step != tag:
+                return False
+            for name, value in step_attrs.iteritems():
+                if attrs.get(name) != value:
+                    return False
+            self.counts[depth - 2] += 1
+            if index is not None and self.counts[depth - 2] != index:
+                return False
+        self.level = depth + 1
+        if depth + 1 < len(self.counts) + 2:
+            if depth >= 1:
+                self.counts[depth - 1] = 0
+            return False
+        self.found = True
+        return True
+
+    def end(self):
+        self.depth -= 1
+        if self.level > self.depth and not self.found:
+            self.level = self.depth
+
+
+def _closure(keys, refs):
+    # The keys, and the keys that the values with them refer to, and so on
+    result = set()
+    todo = list(keys)
+    while todo:
+        key = todo.pop()
+        if key not in result:
+            result.add(key)
+            todo.extend(refs.get(key, ()))
+    return result
+
+
+class _References(object):
+    """The first pass, which finds the ids that the selected value needs
+
+    needed is then the memo keys of the values that must be loaded, or
+    None if nothing was selected, and offsets the byte offsets of the
+    elements with ids, and of the selected element, which is under
+    None.
+    """
+
+    def __init__(self, parser, steps):
+        self._parser = parser
+        self._path = _Path(steps)
+        self._refs = {}     # memo key -> the keys referred to inside it
+        # [key, keys referred to, depth] for each open element that is
+        # memoized or selected.  The key of the selected element is
+        # None, unless it's memoized too.
+        self._open = []
+        self._target = None
+        self.needed = None
+        self.offsets = {}
+        self.encoding = None
+
+    def handle_xmldecl(self, version, encoding, standalone):
+        self.encoding = encoding
+
+    def handle_starttag(self, tag, attrs):
+        path = self._path
+        target = path.start(tag, attrs)
+        if target:
+            self.offsets[None] = self._parser.CurrentByteIndex
+        if tag == 'reference':
+            key = _memo_key(attrs['id'])
+            if self._open:
+                self._open[-1][1].add(key)
+            if target:
+                self._open.append([None, set([key]), path.depth])
+                self._target = self._open[-1]
+            return
+        id = attrs.get('id')
+        if id:
+            key = _memo_key(id)
+            self.offsets[key] = self._parser.CurrentByteIndex
+            if _key_names.get(tag) in attrs:
+                # Only the key is memoized, and it needs nothing
+                key = None
+        else:
+            key = None
+        if key is not None or target:
+            self._open.append([key, set(), path.depth])
+            if target:
+                self._target = self._open[-1]
+
+    def handle_endtag(self, tag):
+        path = self._path
+        open = self._open
+        if open and open[-1][2] == path.depth:
+            element = open.pop()
+            key, refs, depth = element
+            if open:
+                open[-1][1].update(refs)
+            if key is not None and refs:
+                self._refs[key] = refs
+            if element is self._target or self.needed is not None:
+                if self.needed is None:
+                    # The selected element ends
+                    self.needed = _closure(refs, self._refs)
+                elif key in self.needed:
+                    self.needed = _closure(self.needed, self._refs)
+                for element in open:
+                    if element[0] in self.needed:
+                        # A value that's needed is still being loaded
+                        break
+                else:
+                    raise _Done
+        path.end()
+
+    def handle_data(self, data):
+        pass
+
+
+class _Selector(XMLUnpickler):
+    """The second pass, which loads the selected value
+
+    It loads elements one at a time, each by parsing from its offset
+    until it ends, in the order they're in the XML.
+    """
+
+    def __init__(self, target):
+        XMLUnpickler.__init__(self)
+        self._target = target   # The offset of the selected element
+        self._mark = None       # The stack's size inside it
+
+    def load_element(self, xml_or_file, offset, encoding):
+        """Load the element at offset, and return where it ends
+
+        That's where its end tag starts, or, if it's empty, where the
+        element after it starts.
+        """
+        self._expat = parser = _parser(encoding)
+        self._offset = offset
+        self._stack = [[None, None, [], None]]
+        _parse(self, parser, xml_or_file, offset)
+        del self._stack
+        return self._end
+
+    def handle_starttag(self, tag, attrs):
+        stack = self._stack
+        if len(stack) == 1:
+            key_name = _key_names.get(tag)
+            if (key_name in attrs and
+                self._offset + self._expat.CurrentByteIndex != self._target):
+                # An item or attribute, of which only the key is needed
+                self.memo[_memo_key(attrs['id'])] = attrs[key_name]
+                self._end = self._offset
+                raise _Done
+        if self._offset + self._expat.CurrentByteIndex == self._target:
+            self._mark = len(stack)
+        XMLUnpickler.handle_starttag(self, tag, attrs)
+
+    def handle_endtag(self, tag):
+        stack = self._stack
+        frame = stack.pop()
+        value = frame[0](self, frame)
+        if len(stack) == self._mark:
+            if tag in _key_names:
+                self.value = value[1]
+            else:
+                self.value = value
+            self._mark = None
+        top = stack[-1]
+        top[2].append(value)
+        if top[3] is not None:
+            top[3](top)
+        if len(stack) == 1:
+            self._end = self._offset + self._expat.CurrentByteIndex
+            raise _Done
+
+
+def _parser(encoding=None):
+    parser = expat.ParserCreate(encoding)
+    parser.returns_unicode = False
+    parser.buffer_text = True
+    return parser
+
+
+def _parse(handler, parser, xml_or_file, offset=0):
+    # Parse from the offset until the handler raises _Done, or the end
+    parser.StartElementHandler = handler.handle_starttag
+    parser.EndElementHandler = handler.handle_endtag
+    parser.CharacterDataHandler = handler.handle_data
+    try:
+        if isinstance(xml_or_file, str):
+            for i in xrange(offset, len(xml_or_file), _chunk):
+                parser.Parse(xml_or_file[i:i+_chunk], False)
+            parser.Parse('', True)
+        else:
+            xml_or_file.seek(offset)
+            parser.ParseFile(xml_or_file)
+    except _Done:
+        pass
+
+
+def select(xml_or_file, path):
+    """Load the value of the element that path selects
+
+    xml_or_file is an XML pickle, or a seekable file it's read from.
+    """
+    steps = _parse_path(path)
+    if type(xml_or_file) is unicode:
+        xml_or_file = xml_or_file.encode('utf-8')
+    elif not isinstance(xml_or_file, str):
+        xml_or_file = _Offset(xml_or_file)
+
+    parser = _parser()
+    references = _References(parser, steps)
+    parser.XmlDeclHandler = references.handle_xmldecl
+    _parse(references, parser, xml_or_file)
+    if references.needed is None:
+        raise KeyError(path)
+
+    offsets = references.offsets
+    target = offsets[None]
+    selector = _Selector(target)
+    end = -1
+    needed = set([offsets[key] for key in references.needed])
+    needed.add(target)
+    for offset in sorted(needed):
+        # An empty element ends where the next one starts
+        if offset >= end:
+            # It isn't inside an element that was loaded
+            end = selector.load_element(xml_or_file, offset,
+                                        references.encoding)
+    return selector.value
+
+
+class _Offset(object):
+    # A file that reads from where it was, which seek counts from
+
+    def __init__(self, file):
+        self._file = file
+        self._start = file.tell()
+
+    def seek(self, offset):
+        self._file.seek(self._start + offset)
+
+    def read(self, size=-1):
+        return self._file.read(size)
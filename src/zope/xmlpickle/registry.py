@@ -0,0 +1,142 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compact XML for registered classes
+
+Instances are normally written as the pickler reduces them, with
+their class, arguments and state.  Much as copy_reg.pickle registers
+a reduction function for a type, `register` registers a writer and a
+reader for a class, and its instances are then written as a single
+element of their own, with the attributes the writer returns:
+
+>>> from zope.xmlpickle import dumps, loads
+>>> class Point(object):
+...     def __init__(self, x, y):
+...         self.x, self.y = x, y
+>>> register(Point, 'point',
+...          lambda p: {'x': repr(p.x), 'y': repr(p.y)},
+...          lambda attrs: Point(float(attrs['x']), float(attrs['y'])))
+>>> xml = dumps([Point(1.0, 2.5)])
+>>> print xml.strip()
+<?xml version="1.0" encoding="utf-8" ?>
+<pickle>
+  <list>
+    <point x="1.0" y="2.5"/>
+  </list>
+</pickle>
+
+The reader makes an instance from the attributes again:
+
+>>> p = loads(xml)[0]
+>>> p.__class__ is Point, p.x, p.y
+(True, 1.0, 2.5)
+
+The class must be registered wherever the XML is loaded:
+
+>>> unregister(Point)
+>>> loads(xml)
+Traceback (most recent call last):
+...
+ValueError: unrecognized element in XML pickle: 'point'
+
+That is true of the pickles fromxml() makes of the XML too, which
+call the reader when they are loaded.  Pickles of instances, and the
+XML toxml() makes of them, don't change.
+
+"""
+
+import re
+
+from zope.xmlpickle import ppml
+
+_writers = {}   # class -> (tag, writer)
+_readers = {}   # tag -> reader
+
+_name = re.compile(r'^[A-Za-z_][\w.-]*$').match
+_names = set()  # attribute names known to be good
+
+_special = re.compile('[&<>"\n\r\t]')
+_entities = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+             '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+
+def register(cls, tag, writer, reader):
+    """Write the instances of a class as elements named tag
+
+    writer is called with an instance and returns a dictionary of
+    attribute names and values, which are text, as str or unicode.
+    reader is called with a dictionary of the attributes, with values
+    that are utf-8 encoded strings, and returns an instance.  Only
+    instances of the class itself, not of subclasses, are written by
+    writer.
+    """
+    if not _name(tag) or tag in ppml.xmlPickler.dispatch:
+        raise ValueError("bad tag for a registered class: %r" % tag)
+    for other, (other_tag, other_writer) in _writers.items():
+        if other_tag == tag and other is not cls:
+            raise ValueError("%r is already registered for %r"
+                             % (tag, other))
+    unregister(cls)
+    _writers[cls] = tag, writer
+    _readers[tag] = reader
+
+
+def unregister(cls):
+    """Write the instances of a class as they are reduced again"""
+    registered = _writers.pop(cls, None)
+    if registered is not None:
+        del _readers[registered[0]]
+
+
+def _quote(value):
+    # Quote an attribute value, which must be text
+    if value.__class__ is unicode:
+        if ppml._invalid_xml_char(value):
+            raise ValueError("attribute value can't be put in XML: %r"
+                             % value)
+        value = value.encode('utf-8')
+    elif ppml._binary_char(value):
+        # It must be utf-8 text that XML can hold
+        _quote(unicode(value, 'utf-8'))
+    if _special.search(value):
+        value = _special.sub(lambda m: _entities[m.group()], value)
+    return value
+
+
+def _attributes(attrs):
+    """Render the attributes a writer returned"""
+    items = attrs.items()
+    items.sort()
+    result = []
+    for name, value in items:
+        if name not in _names:
+            if name == 'id' or not _name(name):
+                raise ValueError("bad attribute name: %r" % name)
+            _names.add(name)
+        result.append(' %s="%s"' % (name, _quote(value)))
+    return ''.join(result)
+
+
+def _reader(tag):
+    reader = _readers.get(tag)
+    if reader is None:
+        raise ValueError("unrecognized element in XML pickle: %r" % tag)
+    return reader
+
+
+def _load(tag, attrs):
+    """Make an instance of a registered class
+
+    The pickles fromxml() makes of registered elements call this.
+    """
+    return _reader(tag)(attrs)
@@ -0,0 +1,168 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Find out where the time goes in a conversion
+
+Pass a `Stats` object as the stats argument of dumps, loads, toxml,
+fromxml or their file variants, and it records the time spent in each
+phase of the conversion, and how often each step, a pickle opcode, an
+XML element or a type of object, was taken, and how long it took:
+
+>>> from zope.xmlpickle import dumps, loads
+>>> stats = Stats()
+>>> xml = dumps([1, 2], stats=stats)
+>>> sorted(stats.phases)
+['output', 'pickle']
+>>> stats.steps['int'][0]
+2
+
+The same object can collect stats for several conversions:
+
+>>> loads(xml, stats=stats)
+[1, 2]
+>>> sorted(stats.phases)
+['output', 'parse', 'pickle']
+>>> stats.steps['int'][0]
+4
+
+Steps are timed by replacing the dispatch tables of the pickler or
+unpickler doing the work, and only if stats are asked for, so that
+conversions without stats cost nothing extra.
+
+"""
+
+import pickletools
+import sys
+import time
+
+from zope.xmlpickle import ppml
+
+_opcode_names = dict((op.code, op.name) for op in pickletools.opcodes)
+for name in ('BINBYTES', 'SHORT_BINBYTES', 'SHORT_BINUNICODE',
+             'BINUNICODE8', 'BINBYTES8', 'EMPTY_SET', 'ADDITEMS',
+             'FROZENSET', 'NEWOBJ_EX', 'STACK_GLOBAL', 'MEMOIZE', 'FRAME',
+             'BYTEARRAY8', 'NEXT_BUFFER', 'READONLY_BUFFER'):
+    _opcode_names[getattr(ppml, name)] = name
+del name
+
+
+class NullStats(object):
+    """Stats that record nothing, used when none are asked for"""
+
+    def call(self, phase, func, *args):
+        return func(*args)
+
+    def instrument(self, worker):
+        return worker
+
+_null = NullStats()
+
+
+class Stats(object):
+    """Time spent in the phases and steps of conversions
+
+    phases maps a phase name to the number of times the phase was run
+    and the seconds spent in it.  steps maps a step name to the number
+    of times the step was taken and the seconds spent in it.  The time
+    of steps taken while serializing objects, which are nested,
+    includes the time of the steps taken for their contents.
+    """
+
+    timer = time.time
+
+    def __init__(self):
+        self.phases = {}
+        self.steps = {}
+
+    def call(self, phase, func, *args):
+        """Return func(*args), timed as phase"""
+        timer = self.timer
+        start = timer()
+        try:
+            return func(*args)
+        finally:
+            self._add(self.phases, phase, timer() - start)
+
+    def _add(self, table, name, elapsed, count=1):
+        record = table.get(name)
+        if record is None:
+            table[name] = [count, elapsed]
+        else:
+            record[0] += count
+            record[1] += elapsed
+
+    def timed(self, name, func, count=1):
+        """Return func, wrapped to be timed as step name"""
+        timer = self.timer
+        add = self._add
+        steps = self.steps
+
+        def timed(*args):
+            start = timer()
+            try:
+                return func(*args)
+            finally:
+                add(steps, name, timer() - start, count)
+
+        return timed
+
+    def instrument(self, worker):
+        """Time the steps of a pickler, unpickler or XML handler
+
+        The worker is returned.
+        """
+        # Imported here, as these modules use this one
+        from zope.xmlpickle.pickler import ToXMLPickler
+        from zope.xmlpickle.unpickler import XMLUnpickler
+
+        timed = self.timed
+        if isinstance(worker, ToXMLPickler):
+            worker.dispatch = dict(
+                (t, timed(t.__name__, f))
+                for t, f in worker.dispatch.iteritems())
+            worker._reduce = timed('reduce', worker._reduce)
+        elif isinstance(worker, ppml.ToXMLUnpickler):
+            worker.dispatch = dict(
+                (code, timed(_opcode_names.get(code, repr(code)), f))
+                for code, f in worker.dispatch.iteritems())
+        elif isinstance(worker, XMLUnpickler):
+            dispatch = dict((tag, timed(tag, f))
+                            for tag, f in worker.dispatch.iteritems())
+            worker._text = tuple(
+                dispatch[tag] for tag, f in worker.dispatch.iteritems()
+                if f in worker._text)
+            worker.dispatch = dispatch
+            # The time to start an element is counted with its end
+            worker._starts = dict((tag, timed(tag, f, 0))
+                                  for tag, f in worker._starts.iteritems())
+        elif isinstance(worker, ppml.xmlPickler):
+            worker.dispatch = dict((tag, timed(tag, f))
+                                   for tag, f in worker.dispatch.iteritems())
+            streamed = getattr(worker, '_streamed', None)
+            if streamed is not None:
+                worker._streamed = dict(
+                    (tag, timed(tag, f, 0))
+                    for tag, f in streamed.iteritems())
+        else:
+            raise TypeError("Can't time the steps of %r" % (worker, ))
+        return worker
+
+    def report(self, write=sys.stdout.write):
+        """Write a summary, with the slowest steps first"""
+        write('%-24s %10s %10s\n' % ('phase', 'calls', 'seconds'))
+        for name, (count, elapsed) in sorted(self.phases.iteritems()):
+            write('%-24s %10d %10.4f\n' % (name, count, elapsed))
+        write('%-24s %10s %10s\n' % ('step', 'count', 'seconds'))
+        steps = sorted(self.steps.iteritems(), key=lambda i: -i[1][1])
+        for name, (count, elapsed) in steps:
+            write('%-24s %10d %10.4f\n' % (name, count, elapsed))
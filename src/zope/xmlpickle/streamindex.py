@@ -0,0 +1,124 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Random access to the pickles in a stream
+
+The pickles in a stream share a memo, so converting one of them to XML
+normally means loading all of the pickles before it.  A `StreamIndex`
+records, in one pass over the stream, where each pickle starts and a
+checkpoint of what it needs from the memo, so that it can be converted
+on its own.
+
+"""
+
+import cPickle
+from cStringIO import StringIO
+
+from zope.xmlpickle import ppml
+from zope.xmlpickle.stats import _null
+from zope.xmlpickle.xmlpickle import _input, _output
+
+
+class StreamIndex(object):
+    """The offsets and memo checkpoints of the pickles in a stream
+
+    >>> import pickle
+    >>> f = StringIO()
+    >>> pickler = pickle.Pickler(f, 1)
+    >>> l = [1]
+    >>> for i in range(3):
+    ...     pickler.dump([i, l])
+    >>> s = f.getvalue()
+
+    >>> index = StreamIndex.build(s)
+    >>> len(index)
+    3
+    >>> print index.toxml(s, 2).strip()
+    <?xml version="1.0" encoding="utf-8" ?>
+    <pickle>
+      <list>
+        <int>2</int>
+        <reference id="o0"/>
+      </list>
+    </pickle>
+
+    The XML is the same as toxml() makes:
+
+    >>> from zope.xmlpickle import toxml
+    >>> index.toxml(s, 1) == toxml(s, 1)
+    True
+
+    An index can be saved, to a sidecar file for example, and loaded
+    again:
+
+    >>> f = StringIO()
+    >>> index.save(f)
+    >>> f.seek(0)
+    >>> StreamIndex.load(f).toxml(s, 1) == toxml(s, 1)
+    True
+
+    """
+
+    def __init__(self, entries=()):
+        # (offset, checkpoint) for each pickle
+        self.entries = list(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, p_or_file):
+        """Index the pickles in a string or a seekable file
+
+        The pickles are read in a single pass.
+        """
+        p_or_file = _input(p_or_file)
+        u = ppml.ToXMLUnpickler(p_or_file)
+        entries = []
+        while 1:
+            offset = p_or_file.tell()
+            try:
+                xmlob, checkpoint = u.load_checkpoint()
+            except EOFError:
+                if u.stack:
+                    # The last pickle was cut short
+                    raise
+                break
+            entries.append((offset, checkpoint))
+        return cls(entries)
+
+    def save(self, file):
+        """Write the index to a file"""
+        cPickle.dump(self.entries, file, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, file):
+        """Read an index written by save()"""
+        return cls(cPickle.load(file))
+
+    def toxml(self, p_or_file, index, stats=None, pretty=True):
+        """Convert the pickle at index in a string or file to xml
+
+        Only that pickle is read.
+        """
+        if stats is None:
+            stats = _null
+        p_or_file = _input(p_or_file)
+        offset, checkpoint = self.entries[index]
+        p_or_file.seek(offset)
+        u = stats.instrument(ppml.ToXMLUnpickler(p_or_file))
+        u.restore_checkpoint(checkpoint)
+        xmlob = stats.call('unpickle', u.load)
+        r = []
+        stats.call('output', _output, xmlob, r.append, pretty)
+        return ''.join(r)
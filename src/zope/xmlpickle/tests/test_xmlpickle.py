@@ -14,16 +14,48 @@
 """Tests of xmlpickle package
 
 """
+import copy_reg
+import cPickle
 import doctest
+import multiprocessing
+import os
 import pickle
+import pickletools
+import shutil
+import tempfile
 import unittest
-from zope.xmlpickle import dumps, loads
+from collections import OrderedDict
+from cStringIO import StringIO
+from zope.xmlpickle import dumps, loads, toxml, fromxml, fromxml_file
+from zope.xmlpickle import dump, load, iter_toxml, map_file, Stats
+from zope.xmlpickle import dumps_many, loads_many, transcode
+from zope.xmlpickle.pickler import ToXMLPickler
+from zope.xmlpickle.xmlpickle import _PicklerThatSortsDictItems
+from zope.xmlpickle.xmlpickle import _dumpsUsing_PicklerThatSortsDictItems
+
+
+def _dumps_via_pickle(ob, pickler=_PicklerThatSortsDictItems):
+    f = StringIO()
+    pickler(f, 1).dump(ob)
+    return toxml(f.getvalue())
+
+
+def _fromxml_file(xml, buffer_size=7, protocol=None):
+    f = StringIO()
+    fromxml_file(StringIO(xml), f, buffer_size, protocol)
+    return f.getvalue()
 
 
 class Test(unittest.TestCase):
 
     def __test(self, v, expected_xml=None):
         xml = dumps(v)
+        self.assertEqual(xml, _dumps_via_pickle(v))
+        self.assertEqual(_fromxml_file(xml), fromxml(xml))
+        self.assertEqual(dumps(cPickle.loads(fromxml(xml))), xml)
+        p = fromxml(xml, protocol=2)
+        self.assertEqual(_fromxml_file(xml, protocol=2), p)
+        self.assertEqual(dumps(cPickle.loads(p)), xml)
         if expected_xml:
             self.assertEqual(xml, expected_xml)
         newv = loads(xml)
@@ -215,6 +247,276 @@ class Test(unittest.TestCase):
             d[i] = str(i*i)
         self.__test(d)
 
+    def test_dict_w_keys_that_cant_be_compared(self):
+        items = [(2j, 1), (1j, 2), ('\xff', 3), (u'\xe9', 4), (1, 5),
+                 ('a', 6)]
+        xml = dumps(dict(items))
+        self.assertEqual(dumps(dict(reversed(items))), xml)
+        self.__test(dict(items))
+
+    def test_not_canonical(self):
+        v = dict(('k%d' % i, [i]) for i in range(100))
+        xml = dumps(v, canonical=False)
+        self.assertNotEqual(xml, dumps(v))
+        self.assertEqual(loads(xml), v)
+        f = StringIO()
+        dump(v, f, canonical=False)
+        self.assertEqual(f.getvalue(), xml)
+
+    def test_map_file(self):
+        from zope.xmlpickle.streamindex import StreamIndex
+        f = StringIO()
+        pickler = cPickle.Pickler(f, 2)
+        l = ['x' * 1000]
+        for i in range(50):
+            pickler.dump([i, l, u'\u1234'])
+        s = f.getvalue()
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, s)
+            os.close(fd)
+            m = map_file(path)
+            self.assertEqual(toxml(m, 7), toxml(s, 7))
+            m.seek(0)
+            self.assertEqual(list(iter_toxml(m)), list(iter_toxml(s)))
+            m.seek(0)
+            index = StreamIndex.build(m)
+            self.assertEqual(len(index), 50)
+            self.assertEqual(index.toxml(m, 49), toxml(s, 49))
+        finally:
+            os.remove(path)
+
+    def test_convert(self):
+        from zope.xmlpickle.convert import find_jobs, run, up_to_date
+        v = {'a': [1, 2L, u'\u1234'], 'b': Simple(1, 2)}
+        directory = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(directory, 'sub'))
+            for name in 'x.pickle', 'sub/y.pkl':
+                f = open(os.path.join(directory, name), 'wb')
+                cPickle.dump(v, f, 2)
+                f.close()
+            open(os.path.join(directory, 'z.txt'), 'w').close()
+
+            output = os.path.join(directory, 'out')
+            jobs = find_jobs([directory], output_dir=output)
+            self.assertEqual(
+                [job[1][len(output):] for job in jobs],
+                ['/x.xml', '/sub/y.xml'])
+            report = []
+            self.assertEqual(run(jobs, 2, report.append), 0)
+            self.assertEqual(len(report), 3)
+            xml = open(os.path.join(output, 'sub', 'y.xml')).read()
+            self.assertEqual(loads(xml), v)
+            self.assertEqual([up_to_date(job) for job in jobs], [True, True])
+
+            jobs = find_jobs([output], to_xml=False, protocol=2)
+            self.assertEqual(run(jobs, 1, report.append), 0)
+            f = open(os.path.join(output, 'x.pickle'), 'rb')
+            self.assertEqual(cPickle.load(f), v)
+            f.close()
+
+            jobs = find_jobs([os.path.join(directory, 'z.txt')])
+            self.assertEqual(run(jobs, 1, report.append), 1)
+            self.assertFalse(os.path.exists(jobs[0][1]))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_convert_again(self):
+        # Outputs written next to their inputs aren't converted back
+        from zope.xmlpickle.convert import find_jobs, run, up_to_date
+        directory = tempfile.mkdtemp()
+        try:
+            f = open(os.path.join(directory, 'f0.pkl'), 'wb')
+            cPickle.dump([1, 2], f, 2)
+            f.close()
+            report = []
+            for i in range(3):
+                jobs = [job for job in find_jobs([directory])
+                        if not up_to_date(job)]
+                self.assertEqual(run(jobs, 1, report.append), 0)
+                self.assertEqual(len(jobs), i == 0 and 1 or 0)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['f0.pkl', 'f0.xml'])
+            self.assert_(report[-1].startswith('0 converted'))
+            self.assertEqual(
+                [job[0] for job in find_jobs([directory])],
+                [os.path.join(directory, 'f0.pkl')])
+
+            from zope.xmlpickle.convert import main
+            report = []
+            main([directory], report.append)
+            self.assertEqual(report[0], '1 up to date\n')
+            # Two inputs can't be converted to one output
+            inputs = [os.path.join(directory, 'f0.pkl'),
+                      os.path.join(directory, 'f0.pickle')]
+            shutil.copy(inputs[0], inputs[1])
+            self.assertRaises(ValueError, find_jobs, inputs)
+            self.assertEqual(len(find_jobs([directory, inputs[0]])), 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_batch(self):
+        obs = [Simple(i, [i] * i) for i in range(50)] + [None, u'\u1234']
+        xmls = dumps_many(obs)
+        self.assertEqual(xmls, map(dumps, obs))
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(dumps_many(obs, chunk_size=7, pool=pool), xmls)
+            self.assertEqual(loads_many(xmls, pool=pool), obs)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(loads_many(xmls, processes=3, chunk_size=100), obs)
+        self.assertEqual(dumps_many([], processes=2), [])
+
+    def test_large_binary_strings(self):
+        from zope.xmlpickle import load
+        v = [''.join(map(chr, range(256))) * 1000, u'\x01' * 70000]
+        for encoding in 'base64', 'hex':
+            xml = dumps(v, binary_encoding=encoding)
+            self.assertTrue(' encoding="%s"' % encoding in xml)
+            f = StringIO()
+            dump(v, f, binary_encoding=encoding)
+            self.assertEqual(f.getvalue(), xml)
+            self.assertEqual(loads(xml), v)
+            self.assertEqual(load(StringIO(xml)), v)
+            # Small blocks split the encoded text anywhere
+            output = StringIO()
+            fromxml_file(StringIO(xml), output, buffer_size=7)
+            self.assertEqual(output.getvalue(), fromxml(xml))
+            self.assertEqual(cPickle.loads(fromxml(xml)), v)
+        self.assertEqual(toxml(cPickle.dumps(v, 1)), dumps(v))
+        self.assertRaises(ValueError, dumps, v, binary_encoding='base85')
+
+    def test_compact(self):
+        from zope.xmlpickle import toxml_to
+        v = {'a': [1, '  spaced\n text ', u'\u1234'], 'b': Simple(1, (2, 3)),
+             'c': '\x00' * 100, 'd': newSimple(None, {})}
+        p = _dumpsUsing_PicklerThatSortsDictItems(v, 1)
+        pretty = dumps(v)
+        compact = dumps(v, pretty=False)
+        self.assertEqual(toxml(p, pretty=False), compact)
+        self.assertTrue(len(compact) < len(pretty))
+        self.assertFalse('>\n' in compact or '> <' in compact)
+        self.assertEqual(fromxml(compact), fromxml(pretty))
+        self.assertEqual(loads(compact), v)
+        f = StringIO()
+        dump(v, f, pretty=False)
+        self.assertEqual(f.getvalue(), compact)
+        f = StringIO()
+        toxml_to(p, f, pretty=False)
+        self.assertEqual(f.getvalue(), compact)
+
+    def test_compression(self):
+        import bz2, gzip, zlib
+        from zope.xmlpickle import compression
+        v = {'a': [1, 2L, u'\u1234'], 'b': Simple(1, 2), 'c': 'x' * 100000}
+        xml = dumps(v)
+        def gunzip(s):
+            return gzip.GzipFile(fileobj=StringIO(s)).read()
+        directory = tempfile.mkdtemp()
+        try:
+            for name, decompress in [
+                ('v.xml.gz', gunzip),
+                ('v.xml.bz2', bz2.decompress),
+                ('v.xml.zz', zlib.decompress),
+                ('v.xml', str),
+                ]:
+                path = os.path.join(directory, name)
+                dump(v, path, buffer_size=1000)
+                data = open(path, 'rb').read()
+                self.assertEqual(decompress(data), xml)
+                self.assertEqual(load(path), v)
+                self.assertEqual(load(open(path, 'rb')), v)
+        finally:
+            shutil.rmtree(directory)
+
+        for codec in 'gzip', 'bz2', 'zlib':
+            f = StringIO()
+            dump(v, f, compression=codec)
+            self.assertTrue(len(f.getvalue()) < len(xml) // 10)
+            f.seek(0)
+            self.assertEqual(load(f), v)
+            f.seek(0)
+            self.assertEqual(load(f, compression=codec), v)
+            # Concatenated streams read as one
+            f = StringIO()
+            out = compression.compressing(f, codec)
+            out.write(xml[:500])
+            out.close()
+            out = compression.compressing(f, codec)
+            out.write(xml[500:])
+            out.close()
+            f.seek(0)
+            self.assertEqual(compression.decompressing(f).read(), xml)
+            self.assertEqual(load(StringIO(f.getvalue())), v)
+            # and so in pieces, with only a block or so decompressed
+            # ahead of them
+            f.seek(0)
+            d = compression.decompressing(f)
+            pieces = []
+            for size in [1, 7, 499, 4096, 100000] * 20 + [-1]:
+                pieces.append(d.read(size))
+                self.assertTrue(d._size <= 2 * compression.BLOCK_SIZE)
+            self.assertEqual(''.join(pieces), xml)
+            self.assertEqual(d.read(), '')
+            # Streams can end where a read does
+            class File:
+                def __init__(self, blocks):
+                    self.blocks = blocks
+                def read(self, size=-1):
+                    return self.blocks and self.blocks.pop(0) or ''
+            streams = []
+            for part in xml[:500], xml[500:]:
+                f = StringIO()
+                out = compression.compressing(f, codec)
+                out.write(part)
+                out.close()
+                streams.append(f.getvalue())
+            self.assertEqual(load(File(streams[:]), compression=codec), v)
+            self.assertEqual(load(File(streams[:])), v)
+
+        if compression.lzma is None:
+            self.assertRaises(ValueError, dump, v, StringIO(),
+                              compression='xz')
+        else:
+            f = StringIO()
+            dump(v, f, compression='xz')
+            f.seek(0)
+            self.assertEqual(load(f), v)
+        self.assertRaises(ValueError, dump, v, StringIO(), compression='zip')
+        self.assertRaises(ValueError, load, StringIO(xml), compression='zip')
+
+    def test_stats(self):
+        v = [1, 2L, 'x' * 300, u'\u1234', (Simple(1, 2), {'a': None})]
+        p = cPickle.dumps(v, 1)
+        xml = dumps(v)
+        for convert, arg, phases in (
+            (dumps, v, ['output', 'pickle']),
+            (loads, xml, ['parse']),
+            (toxml, p, ['output', 'unpickle']),
+            (fromxml, xml, ['join', 'parse']),
+            ):
+            stats = Stats()
+            result = convert(arg, stats=stats)
+            if convert is loads:
+                self.assertEqual(result, loads(xml))
+            else:
+                self.assertEqual(result, convert(arg))
+            self.assertEqual(sorted(stats.phases), phases)
+            self.assertTrue(stats.steps)
+
+        stats = Stats()
+        output = StringIO()
+        fromxml_file(StringIO(xml), output, stats=stats)
+        self.assertEqual(output.getvalue(), fromxml(xml))
+        self.assertEqual(stats.steps['string'][0], 2)
+        report = StringIO()
+        stats.report(report.write)
+        self.assertTrue('string' in report.getvalue())
+        self.assertRaises(TypeError, stats.instrument, object())
+
     def test_complex(self):
         self.__test(complex(1,2))
 
@@ -241,6 +543,558 @@ class Test(unittest.TestCase):
         p2 = pickle.dumps(newl)
         self.assertEqual(p1, p2)
 
+    def test_shared_objects(self):
+        # The XML depends on which objects are referred to later, so
+        # check that dumps agrees with toxml of a pickle.
+        s = 'not an identifier'
+        a = newSimple(1, 2)
+        b = Simple(1, 2)
+        t = ([], )
+        t[0].append(t)
+        for v in ([s, s, 'spam', 'spam'],
+                  [a, a],
+                  [b, b],
+                  [newSimple(1, 2), newSimple(3, 4)],
+                  [newSimple(1, 2), object],
+                  [object, newSimple(1, 2)],
+                  [newSimple(1, 2), copy_reg._reconstructor],
+                  [a, a.__dict__],
+                  [WInitial(1, 2), WInitial(3, 4)],
+                  {'t': t, (1, 2): t},
+                  ):
+            self.assertEqual(dumps(v), _dumps_via_pickle(v))
+
+    def test_persistent_id(self):
+        def persistent_id(ob):
+            if isinstance(ob, Simple):
+                return ob.spam
+        class Pickler(_PicklerThatSortsDictItems):
+            def persistent_id(self, ob):
+                return persistent_id(ob)
+        class XMLPickler(ToXMLPickler):
+            def persistent_id(self, ob):
+                return persistent_id(ob)
+        v = {'simple': Simple('spam', 1), 'list': [Simple(('x', 1), 2)]}
+        pickler = XMLPickler()
+        pickler.dump(v)
+        r = []
+        pickler.output(r.append)
+        self.assertEqual(''.join(r), _dumps_via_pickle(v, Pickler))
+
+    def test_dump(self):
+        from zope.xmlpickle import dump, toxml_to
+        class File:
+            def __init__(self):
+                self.blocks = []
+            def write(self, s):
+                self.blocks.append(s)
+        v = {'simple': Simple('spam', 1), 'text': 'x' * 50,
+             'list': [newSimple(i, str(i)) for i in range(20)]}
+        f = File()
+        dump(v, f, buffer_size=40)
+        self.assertEqual(''.join(f.blocks), dumps(v))
+        self.assert_(len(f.blocks) > 10)
+        for block in f.blocks:
+            self.assert_(len(block) < 80 or block == 'x' * 50)
+
+        p = pickle.dumps(v, 1)
+        f = File()
+        toxml_to(p, f, buffer_size=40)
+        self.assertEqual(''.join(f.blocks), toxml(p))
+        self.assert_(len(f.blocks) > 10)
+
+    def test_fromxml_file_writes_as_it_reads(self):
+        xml = dumps([newSimple(i, [str(i)]) for i in range(100)])
+        output = StringIO()
+        written = []
+        class Input:
+            def __init__(self):
+                self.input = StringIO(xml)
+            def read(self, size):
+                written.append(len(output.getvalue()))
+                return self.input.read(size)
+        fromxml_file(Input(), output, buffer_size=100)
+        self.assertEqual(output.getvalue(), fromxml(xml))
+        # The pickle is written while the input is read
+        self.assert_(written[len(written) // 2] > len(output.getvalue()) / 3)
+
+    def test_load(self):
+        from zope.xmlpickle import load
+        v = [newSimple(1, {'a': (1, 2)}), u'\u20ac', 'x\0y', 1L << 80]
+        self.assertEqual(load(StringIO(dumps(v))), v)
+
+    def test_load_persistent(self):
+        from zope.xmlpickle.unpickler import XMLUnpickler
+        xml = ('<pickle><list>'
+               '<string id="o0">eggs</string>'
+               '<persistent><string>spam</string></persistent>'
+               '<persistent><reference id="o0"/></persistent>'
+               '</list></pickle>')
+        self.assertRaises(cPickle.UnpicklingError, loads, xml)
+        unpickler = XMLUnpickler(StringIO(xml))
+        unpickler.persistent_load = lambda pid: 'loaded ' + pid
+        self.assertEqual(unpickler.load(),
+                         ['eggs', 'loaded spam', 'loaded eggs'])
+
+    def test_shared_nodes(self):
+        from zope.xmlpickle import ppml
+        a = Simple(1, 2)
+        p = pickle.dumps([1, 1, 'spam', 'spam', 'not an id', a, a], 0)
+        tree = ppml.ToXMLUnpickler(StringIO(p)).load()
+        items = tree.value()._subs
+        self.assert_(items[0] is items[1])
+        self.assert_(items[2] is items[3])
+        self.assert_(items[0].shared)
+        self.assertRaises(TypeError, setattr, items[0], 'id', 'o1')
+        self.assertEqual(items[4].id, '')
+        self.assert_(not items[4].shared)
+        self.assertEqual(items[5].id, 'o0')
+        self.assertEqual(items[5].klass, ppml.Global(__name__, 'Simple'))
+        self.assert_(items[5].klass.shared)
+        self.assertRaises(AttributeError, setattr, items[0], 'spam', 1)
+
+    def test_protocol_2(self):
+        s = 'not an id'
+        for v in (newSimple(1, 2), newWInitial(1, 2), DictSub(a=1),
+                  ListSub([1, s]), set([1, 2]), frozenset([s]), set(),
+                  (1,), (1, 2), (1, 2, 3), [s, s], 2L**70, -2L**40,
+                  u'\u20ac'):
+            xml = toxml(pickle.dumps(v, 2))
+            self.assertEqual(_fromxml_file(xml), fromxml(xml))
+            self.assertEqual(cPickle.loads(fromxml(xml)), v)
+            self.assertEqual(loads(xml), v)
+
+    def test_python3_pickle(self):
+        # pickle.dumps([b'ab', 'text', {1, 2}, frozenset([3]), t, t,
+        #               2**70, collections.OrderedDict(a=1)], 4)
+        # with t = (1, 2), made by Python 3
+        p = ('\x80\x04\x95Y\x00\x00\x00\x00\x00\x00\x00]\x94(C\x02ab\x94'
+             '\x8c\x04text\x94\x8f\x94(K\x01K\x02\x90(K\x03\x91\x94K\x01K'
+             '\x02\x86\x94h\x05\x8a\t\x00\x00\x00\x00\x00\x00\x00\x00@'
+             '\x8c\x0bcollections\x94\x8c\x0bOrderedDict\x94\x93\x94)R\x94'
+             '\x8c\x01a\x94K\x01se.')
+        xml = toxml(p)
+        # The memoized strings in the global don't use up ids
+        self.assert_('<tuple id="o0">' in xml)
+        self.assert_('<reference id="o0"/>' in xml)
+        self.assert_('<global name="OrderedDict" module="collections"/>'
+                     in xml)
+        t = (1, 2)
+        v = ['ab', u'text', set([1, 2]), frozenset([3]), t, t, 2L**70,
+             OrderedDict(a=1)]
+        self.assertEqual(loads(xml), v)
+        self.assertEqual(cPickle.loads(fromxml(xml)), v)
+        self.assertEqual(_fromxml_file(xml), fromxml(xml))
+        v = loads(xml)
+        self.assert_(v[4] is v[5])
+
+    def test_reduce_with_items(self):
+        v = ReducedItems([1, 2])
+        xml = dumps(v)
+        self.assert_('<listitems>' in xml)
+        self.assertEqual(xml, _dumps_via_pickle(v))
+        self.assertEqual(loads(xml), v)
+        self.assertEqual(cPickle.loads(fromxml(xml)), v)
+        self.assertEqual(_fromxml_file(xml), fromxml(xml))
+
+    def test_fromxml_protocol(self):
+        xml = dumps([newSimple(1, (2, 3)), 2L**70, 2**40, (1, 2, 3, 4)])
+        p = fromxml(xml, protocol=2)
+        self.assertEqual(p[:2], pickle.PROTO + '\x02')
+        self.assertEqual(
+            [op.name for op, arg, pos in pickletools.genops(p)
+             if op.proto == 2],
+            ['PROTO', 'NEWOBJ', 'TUPLE2', 'LONG1'])
+        self.assert_(len(p) < len(fromxml(xml)))
+        self.assertEqual(dumps(cPickle.loads(p)), xml)
+        self.assertRaises(ValueError, fromxml, xml, 0)
+        self.assertRaises(ValueError, fromxml, xml, 3)
+
+        copy_reg.add_extension(__name__, 'Simple', 240)
+        try:
+            p = fromxml(dumps(Simple(1, 2)), protocol=2)
+            self.assert_(pickle.EXT1 + '\xf0' in p)
+            self.assertEqual(cPickle.loads(p), Simple(1, 2))
+        finally:
+            copy_reg.remove_extension(__name__, 'Simple', 240)
+
+    def test_pickler_subclass(self):
+        from xml.parsers import expat
+        from zope.xmlpickle import ppml
+        class Doubling(ppml.xmlPickler):
+            def int(self, tag, data):
+                data[2] = str(2 * int(data[2]))
+                return ppml.xmlPickler.int(self, tag, data)
+            def answer(self, tag, data):
+                return self.int('int', ['int', {}, '21'])
+        class StreamingDoubling(Doubling, ppml.xmlStreamingPickler):
+            pass
+        xml = dumps([1, (2, 'x'), {'a': 3}]).replace(
+            '<string>x</string>', '<answer/>')
+        for pickler in Doubling, StreamingDoubling:
+            f = StringIO()
+            if pickler is Doubling:
+                handler = pickler()
+            else:
+                handler = pickler(f.write)
+            parser = expat.ParserCreate()
+            parser.CharacterDataHandler = handler.handle_data
+            parser.StartElementHandler = handler.handle_starttag
+            parser.EndElementHandler = handler.handle_endtag
+            parser.Parse(xml, True)
+            if pickler is Doubling:
+                f.write(handler.get_value())
+            self.assertEqual(cPickle.loads(f.getvalue()),
+                             [2, (4, 42), {'a': 6}])
+        # Subclasses have tables of their own
+        xml = xml.replace('<answer/>', '<int>5</int>')
+        self.assertEqual(cPickle.loads(fromxml(xml)), [1, (2, 5), {'a': 3}])
+
+    def test_iter_toxml(self):
+        f = StringIO()
+        pickler = cPickle.Pickler(f, 1)
+        records = [[i, Simple(i, 'x')] for i in range(300)]
+        for i, record in enumerate(records):
+            pickler.dump([record, records[i // 2]])
+        s = f.getvalue()
+        xmls = list(iter_toxml(s))
+        self.assertEqual(len(xmls), 300)
+        for i in (0, 1, 150, 299):
+            self.assertEqual(xmls[i], toxml(s, i))
+        self.assertEqual(list(iter_toxml(StringIO(s))), xmls)
+        self.assertRaises(EOFError, list, iter_toxml(s[:-1]))
+        self.assertEqual(list(iter_toxml('')), [])
+        self.assertEqual(list(iter_toxml(s, pretty=False))[150],
+                         toxml(s, 150, pretty=False))
+        stats = Stats()
+        self.assertEqual(list(iter_toxml(s, stats=stats)), xmls)
+        self.assertEqual(sorted(stats.phases), ['output', 'unpickle'])
+        self.assertEqual(stats.phases['output'][0], 300)
+        self.assertTrue(stats.steps)
+
+    def test_stream_index(self):
+        from zope.xmlpickle.streamindex import StreamIndex
+        f = StringIO()
+        pickler = cPickle.Pickler(f, 1)
+        a = Simple(1, 'not an id')
+        b = newSimple(2, [])
+        pickler.dump([a, 'spam'])
+        pickler.dump(b)
+        pickler.dump([a, 'spam', b, 'spam'])
+        pickler.dump([b, a, ['eggs', a]])
+        s = f.getvalue()
+        index = StreamIndex.build(StringIO(s))
+        f = StringIO()
+        index.save(f)
+        f.seek(0)
+        index = StreamIndex.load(f)
+        xmls = list(iter_toxml(s))
+        self.assertEqual(len(index), len(xmls))
+        for i in (3, 1, 2, 0):
+            self.assertEqual(index.toxml(s, i), xmls[i])
+            self.assertEqual(toxml(s, i, index), xmls[i])
+            self.assertEqual(index.toxml(StringIO(s), i), xmls[i])
+
+    def test_transcode(self):
+        def transcoded(p, index=0, pretty=True):
+            out = []
+            transcode(p, out.append, index, pretty)
+            return ''.join(out)
+
+        s = 'not an id'
+        l = [1, s]
+        values = [[l, l, s, s], newSimple(1, l), Simple(1, (l, 2)),
+                  WInitial(1, 2), newWInitial(l, l), DictSub(a=l),
+                  ListSub([1, s]), ReducedItems([1, 2]), set([1, 2]),
+                  frozenset([s]), {'spam': l, 1: (l, l)}, (l, (), ()),
+                  2L**70, u'\u20ac', 1.5, None, True]
+        for protocol in 0, 1, 2:
+            for v in values + [values]:
+                p = cPickle.dumps(v, protocol)
+                self.assertEqual(transcoded(p), toxml(p))
+                self.assertEqual(transcoded(p, pretty=False),
+                                 toxml(p, pretty=False))
+
+        f = StringIO()
+        pickler = cPickle.Pickler(f, 2)
+        for v in values:
+            pickler.dump(v)
+        s = f.getvalue()
+        for i in 0, 5, len(values) - 1:
+            self.assertEqual(transcoded(s, i), toxml(s, i))
+            self.assertEqual(transcoded(StringIO(s), i), toxml(s, i))
+
+        # DUP can't be transcoded in one pass, so a tree is used
+        p = pickle.MARK + pickle.NONE + pickle.DUP + pickle.TUPLE + '.'
+        self.assertEqual(transcoded(p), toxml(p))
+
+    def test_registry(self):
+        from zope.xmlpickle.registry import register, unregister
+        p = Point(1, 'a "b" & <c>\n')
+        q = Point(2, u'\u20ac')
+        v = [p, q, p, Simple(1, 2)]
+        register(Point, 'point',
+                 lambda p: {'x': str(p.x), 'label': p.label},
+                 lambda attrs: Point(int(attrs['x']),
+                                     attrs['label'].decode('utf-8')))
+        register(Simple, 'simple',
+                 lambda s: {'spam': repr(s.spam), 'eggs': repr(s.eggs)},
+                 lambda attrs: Simple(int(attrs['spam']),
+                                      int(attrs['eggs'])))
+        try:
+            xml = dumps(v)
+            self.assert_('<point id="o0" label="a &quot;b&quot; &amp; '
+                         '&lt;c&gt;&#10;" x="1"/>' in xml)
+            self.assert_('<reference id="o0"/>' in xml)
+            self.assert_('<simple eggs="2" spam="1"/>' in xml)
+            self.assert_('<klass>' not in xml)
+            for loaded in (loads(xml), loads(dumps(v, pretty=False)),
+                           cPickle.loads(fromxml(xml)),
+                           cPickle.loads(fromxml(xml, protocol=2)),
+                           cPickle.loads(_fromxml_file(xml))):
+                self.assertEqual(loaded, v)
+                self.assert_(loaded[0] is loaded[2])
+
+            # Subclasses aren't written by the writer
+            self.assert_('<object>' in dumps(newSimple(1, 2)))
+
+            self.assertRaises(ValueError, register, Point, 'list',
+                              None, None)
+            self.assertRaises(ValueError, register, Point, '1point',
+                              None, None)
+            self.assertRaises(ValueError, register, newSimple, 'point',
+                              None, None)
+            self.assertRaises(ValueError, dumps, Point(1, '\x00'))
+        finally:
+            unregister(Point)
+            unregister(Simple)
+        self.assertRaises(ValueError, loads, xml)
+        self.assertRaises(ValueError, fromxml, xml)
+        self.assertEqual(dumps(v), _dumps_via_pickle(v))
+
+    def test_select(self):
+        from zope.xmlpickle import select
+        l = ['spam']
+        l.append(l)
+        v = Simple(l, {'title': u'T\u20ac', 'other': [l, 1]})
+        xml = dumps([v, 42])
+        path = 'classic_object/attributes/attribute[@name="eggs"]'
+        self.assertEqual(select(xml, path + '/dictionary/item[2]'),
+                         u'T\u20ac')
+        self.assertEqual(select(StringIO(xml), 'int'), 42)
+        self.assertEqual(select(xml, u'int[1]'), 42)
+
+        # References are resolved, also to values that contain them
+        other = select(xml, path + '/dictionary/item[@key="other"]')
+        self.assertEqual(other[1], 1)
+        self.assert_(other[0][1] is other[0])
+        spam = select(xml, 'classic_object/attributes/attribute[2]')
+        self.assertEqual(spam[0], 'spam')
+        self.assert_(spam[1] is spam)
+        spam = select(xml, path + '/dictionary/item/list/list/reference')
+        self.assert_(spam[1] is spam)
+        self.assertEqual(dumps(select(xml, '')), xml)
+
+        # A value referred to right after an empty one
+        e = []
+        f = [1]
+        compact = dumps({'aa': (e, f), 'bb': [e, f]}, pretty=False)
+        self.assertEqual(select(compact, 'item[@key="bb"]'), [[], [1]])
+
+        # Only what's selected is loaded
+        xml = xml.replace('module="zope.xmlpickle.tests.test_xmlpickle"',
+                          'module="no.such.module"')
+        self.assertEqual(select(xml, 'int'), 42)
+        self.assertRaises(ImportError, loads, xml)
+
+        self.assertRaises(KeyError, select, xml, 'int[2]')
+        self.assertRaises(KeyError, select, xml, 'string')
+        self.assertRaises(ValueError, select, xml, 'int[@id]')
+        self.assertRaises(ValueError, select, xml, 'int/')
+
+    def test_lazy(self):
+        from zope.xmlpickle.lazy import LazyDict, LazyList
+        l = ['spam']
+        l.append(l)
+        s = Simple(l, {'eggs': [l, 1], 'ham': ()})
+        v = [s, {'toast': l, 'beans': [[{}], []]}, newSimple(1, [2])]
+        xml = dumps(v)
+        loaded = loads(xml, lazy=True)
+        self.assertEqual(loaded.__class__, LazyList)
+        self.assertEqual(dumps(loaded), xml)
+
+        # The items of the lists and dictionaries that are used are
+        # loaded, in any order
+        for path in ([], [1, 'toast'], [0], [1, 'beans', 0, 0]):
+            loaded = loads(xml, lazy=True)
+            x = loaded
+            for step in path:
+                x = x[step]
+            self.assertEqual(dumps(loaded), xml)
+        loaded = loads(xml, lazy=True)
+        toast = loaded[1]['toast']
+        self.assert_('_lazy' in loaded[0].spam.__dict__)
+        self.assert_(toast is loaded[0].spam)
+        self.assert_(toast[1] is toast)
+        self.assert_(toast is loaded[0].eggs['eggs'][0])
+        self.assertEqual(loaded[0].eggs.__class__, LazyDict)
+        self.assertEqual(loaded[2].spam, 1)
+        self.assertEqual(loaded[2].eggs.__class__, LazyList)
+        self.assertEqual(loaded[1].__class__, LazyDict)
+        self.assertEqual(loaded[1]['beans'], [[{}], []])
+        self.assertEqual(sorted(loaded[1]), ['beans', 'toast'])
+        self.assertEqual(cPickle.loads(cPickle.dumps(loaded[1]['beans'])),
+                         [[{}], []])
+        self.assertEqual(loads(xml, lazy=True)[0].spam[0], 'spam')
+
+        xml = dumps([{'spam': [1]}, 2])
+        self.assertEqual(loads(xml.replace('<list', '<!-- --><list'),
+                               lazy=True),
+                         [{'spam': [1]}, 2])
+        self.assertEqual(loads(xml.decode('utf-8'), lazy=True),
+                         [{'spam': [1]}, 2])
+        self.assertRaises(ValueError, loads,
+                          xml.replace('</list>', '</dictionary>'),
+                          lazy=True)
+
+    def test_fragment_cache(self):
+        from zope.xmlpickle import FragmentCache
+        name = 'a name that is <not> an identifier'
+        table = tuple([(i, name, i * 0.5, ('x', u'\xe9' * i))
+                       for i in range(20)])
+        blob = '\x00\xff' * 50
+        doc = 'spam & eggs ' * 10
+        cache = FragmentCache(3)
+        for v, kw in [
+            ([table, blob, doc], {}),
+            ([table, blob, doc], {}),
+            ({'spam': [doc, (table, )], 'eggs': blob}, {}),
+            # Referred to after they are pasted
+            ([doc, table, doc, table[3], blob, blob], {}),
+            ([table, blob, doc], {'pretty': False}),
+            ([table, blob, doc], {'binary_encoding': 'hex'}),
+            # Values in them were dumped before
+            ([name, table, table[0][3], doc], {}),
+            ([Simple(table, doc), newSimple(blob, table)], {}),
+            ]:
+            self.assertEqual(dumps(v, cache=cache, **kw), dumps(v, **kw))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.hits, 14)
+        self.assertEqual(cache.misses, 9)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+        for i in range(3):
+            dumps([table, [1]], cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        # The value used least recently is dropped
+        cache = FragmentCache(1)
+        for i in range(2):
+            dumps([table, doc], cache=cache)
+        self.assertEqual((len(cache), cache.hits, cache.misses), (1, 0, 4))
+        dumps([doc, doc, table], cache=cache)
+        self.assertEqual(cache.hits, 1)
+
+        # Mutable values aren't cached
+        t = (['spam'], ) * 30
+        dumps(t, cache=cache)
+        t[0].append('eggs')
+        self.assertEqual(dumps(t, cache=cache), dumps(t))
+        self.assertEqual(len(cache), 1)
+        self.assertRaises(ValueError, FragmentCache, 0)
+
+    def test_fragment_cache_shared(self):
+        import threading
+        from zope.xmlpickle import FragmentCache
+        name = 'a name that is <not> an identifier'
+        table = tuple([('x%d' % i, name) for i in range(20)])
+        cache = FragmentCache()
+        dumps(table, cache=cache)
+
+        # Picklers that have pasted the same value give its nodes ids
+        # of their own
+        values = [[table, table[3]], [table, table[5], table], [table]]
+        picklers = []
+        for v in values:
+            pickler = ToXMLPickler(cache=cache)
+            pickler.dump(v)
+            picklers.append(pickler)
+        for v, pickler in zip(values, picklers):
+            r = []
+            pickler.output(r.append)
+            self.assertEqual(''.join(r), dumps(v))
+        self.assertEqual(cache.hits, 3)
+
+        failures = []
+        def dump(v):
+            xml = dumps(v)
+            for i in range(50):
+                if dumps(v, cache=cache) != xml:
+                    failures.append(v)
+        threads = [threading.Thread(target=dump, args=(v, ))
+                   for v in values]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        self.assertEqual(cache.hits, 153)
+
+    def test_iter_dumps(self):
+        from zope.xmlpickle import iter_dumps
+        v = [{'spam': (i, u'\xe9' * i, '\xff' * i)} for i in range(1000)]
+        for kw in {}, {'pretty': False}, {'binary_encoding': 'hex'}:
+            xml = dumps(v, **kw)
+            blocks = list(iter_dumps(v, buffer_size=1000, **kw))
+            self.assertEqual(''.join(blocks), xml)
+            self.assert_(len(blocks) > 10)
+            self.assert_(min(map(len, blocks[:-1])) >= 1000)
+        stats = Stats()
+        self.assertEqual(''.join(iter_dumps(v, stats=stats)), dumps(v))
+        self.assertEqual(sorted(stats.phases), ['output', 'pickle'])
+
+        # Generators sharing a cache, advanced in turn
+        from zope.xmlpickle import FragmentCache
+        cache = FragmentCache()
+        table = tuple([x['spam'] for x in v])
+        values = [[table, table[3]], [table, table[5], table],
+                  [table, table[3]]]
+        dumps(table, cache=cache)
+        generators = [iter_dumps(x, buffer_size=100, cache=cache)
+                      for x in values]
+        blocks = [[] for x in values]
+        while generators:
+            for i, g in list(enumerate(generators)):
+                if g is None:
+                    continue
+                try:
+                    blocks[i].append(g.next())
+                except StopIteration:
+                    generators[i] = None
+            if generators.count(None) == len(generators):
+                break
+        for x, b in zip(values, blocks):
+            self.assertEqual(''.join(b), dumps(x))
+            self.assertEqual(loads(''.join(b))[1], x[1])
+        self.assertEqual(cache.hits, 3)
+
+    def test_feed(self):
+        from xml.parsers import expat
+        from zope.xmlpickle.unpickler import XMLUnpickler
+        v = [Simple(1, u'\xe9'), {'spam': ['\xff' * 100, 1.5]}]
+        xml = dumps(v)
+        for size in 1, 7, len(xml):
+            u = XMLUnpickler()
+            for i in range(0, len(xml), size):
+                u.feed(xml[i:i+size])
+            self.assertEqual(u.close(), v)
+        u.feed(xml.decode('utf-8'))
+        self.assertEqual(u.close(), v)
+        self.assertRaises(expat.ExpatError, u.close)
+        u.feed(xml[:-10])
+        self.assertRaises(expat.ExpatError, u.close)
+
     def test_list(self):
         self.__test([])
         self.__test([1,2,3])
@@ -267,6 +1121,19 @@ class Simple:
         return '%s %r' % (self.__class__.__name__, self.__dict__)
 
 
+class Point(object):
+
+    def __init__(self, x, label):
+        self.x = x
+        self.label = label
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
 class WInitial(Simple):
     def __getinitargs__(self):
         return self.spam, self.eggs
@@ -292,8 +1159,29 @@ class DictSub(dict):
         return not self.__eq__(other)
 
 
+class ListSub(list):
+    pass
+
+
+class ReducedItems(list):
+    def __reduce__(self):
+        return ReducedItems, (), None, iter(self)
+
+
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(Test),
         doctest.DocTestSuite('zope.xmlpickle.xmlpickle'),
+        doctest.DocTestSuite('zope.xmlpickle.ppml'),
+        doctest.DocTestSuite('zope.xmlpickle.pickler'),
+        doctest.DocTestSuite('zope.xmlpickle.unpickler'),
+        doctest.DocTestSuite('zope.xmlpickle.streamindex'),
+        doctest.DocTestSuite('zope.xmlpickle.stats'),
+        doctest.DocTestSuite('zope.xmlpickle.batch'),
+        doctest.DocTestSuite('zope.xmlpickle.compression'),
+        doctest.DocTestSuite('zope.xmlpickle.transcoder'),
+        doctest.DocTestSuite('zope.xmlpickle.registry'),
+        doctest.DocTestSuite('zope.xmlpickle.query'),
+        doctest.DocTestSuite('zope.xmlpickle.lazy'),
+        doctest.DocTestSuite('zope.xmlpickle.cache'),
         ))
@@ -0,0 +1,1523 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Convert pickles to XML without loading them into a tree of nodes
+
+toxml() loads a pickle into a tree of zope.xmlpickle.ppml nodes and
+then writes the tree out, because the start tag of an element depends
+on opcodes that can come long after the one that starts it: whether
+a list or an object gets an id isn't known until it is fetched from
+the memo, whether a list is empty until its items are appended, and
+whether an object is written as an <object>, a <classic_object> or an
+<initialized_object> until its state is set.
+
+transcode() makes the same XML in two passes over the pickle instead.
+The first is a scan of the opcodes, like pickletools.genops() but for
+protocols 3 to 5 too, that finds the memo slots that are fetched and
+the ids they will get, and records, for each list, tuple, set,
+dictionary and object, a small entry with what its start tag and the
+second pass need to know.  The second pass reads the opcodes again and
+writes the XML as it goes, keeping only the elements that are open:
+
+>>> import pickle
+>>> from zope.xmlpickle import toxml
+>>> l = [1]
+>>> p = pickle.dumps([l, l, {'spam': 'eggs'}], 2)
+>>> out = []
+>>> transcode(p, out.append)
+>>> print ''.join(out).strip()
+<?xml version="1.0" encoding="utf-8" ?>
+<pickle>
+  <list>
+    <list id="o0">
+      <int>1</int>
+    </list>
+    <reference id="o0"/>
+    <dictionary>
+      <item key="spam">
+          <string>eggs</string>
+      </item>
+    </dictionary>
+  </list>
+</pickle>
+>>> ''.join(out) == toxml(p)
+True
+
+What is kept in memory is the ids of the fetched slots, the entries,
+which take about 20 bytes each, the identifier strings in the memo,
+which are repeated rather than referred to, and the names that
+protocol 4 globals are made of.  That's a fraction of a tree of nodes,
+though the two passes take about twice as long as toxml().
+
+Picklers don't write some things that the pickle machine allows,
+such as DUP or a memo slot that is set twice, and a pickle that can't
+be written in one pass is converted with a tree, as toxml() does, so
+the XML is the same either way.
+
+"""
+
+import re
+import struct
+
+from array import array
+
+from copy_reg import _inverted_registry
+
+from zope.xmlpickle import ppml
+from zope.xmlpickle.ppml import mloads, identifier
+from zope.xmlpickle.ppml import \
+     PERSID, NONE, INT, BININT, BININT1, BININT2, LONG, FLOAT, \
+     BINFLOAT, STRING, BINSTRING, SHORT_BINSTRING, UNICODE, \
+     BINUNICODE, TUPLE, EMPTY_TUPLE, EMPTY_LIST, EMPTY_DICT, LIST, \
+     DICT, INST, OBJ, GLOBAL, REDUCE, GET, BINGET, LONG_BINGET, PUT, \
+     BINPUT, LONG_BINPUT, STOP, MARK, BUILD, SETITEMS, SETITEM, \
+     BINPERSID, APPEND, APPENDS, \
+     PROTO, NEWOBJ, EXT1, EXT2, EXT4, TUPLE1, TUPLE2, TUPLE3, LONG1, LONG4
+from zope.xmlpickle.ppml import \
+     BINBYTES, SHORT_BINBYTES, SHORT_BINUNICODE, BINUNICODE8, BINBYTES8, \
+     EMPTY_SET, ADDITEMS, FROZENSET, NEWOBJ_EX, STACK_GLOBAL, MEMOIZE, \
+     FRAME, BYTEARRAY8, READONLY_BUFFER, HIGHEST_PROTOCOL
+from zope.xmlpickle.stats import _null
+from zope.xmlpickle.xmlpickle import _input, _toxml
+from pickle import POP, POP_MARK, NEWTRUE, NEWFALSE
+
+
+class _Unsupported(Exception):
+    """The pickle can't be converted in one pass"""
+
+
+# Pass 1
+# ======
+#
+# The stack holds a tuple for each value on the pickle machine's
+# stack: (the number of the opcode the value's XML starts at, the
+# number of the opcode that made it, its kind, info, and extra: the
+# memo slot the value was put in, for the kinds whose info isn't an
+# entry, or, for a tuple of 3 values, what _conds() says of them).
+# Opcodes are numbered from the start of the stream.
+
+_LEAF, _OBJECT_LEAF, _STRING, _UNICODE, _GLOBAL, _NAMED, _REF, _ENTRY, \
+       _MARKER = range(9)
+
+# An entry is made for each container, each MARK and each value whose
+# XML starts before the opcode that makes it.  There can be as many
+# entries as there are nodes in a tree, so they are numbered in the
+# order they are made and kept in arrays, with dictionaries for the
+# details that only some objects have.
+
+(_LIST, _TUPLE, _SET, _FROZENSET, _DICT, _REDUCE, _NEWOBJ, _NEWOBJ_EX,
+ _NEWOBJ_EX_KW, _INST, _OBJ, _PERSID, _STACK_GLOBAL, _POPPED, _POP_MARK,
+ _POPPED_MARK, _APPENDS, _SETITEMS, _ADDITEMS, _OPEN_MARK) = range(20)
+
+_names = 'list', 'tuple', 'set', 'frozenset', 'dictionary'
+_collections = frozenset((_LIST, _TUPLE, _SET, _FROZENSET, _DICT))
+_objects = frozenset((_REDUCE, _NEWOBJ, _NEWOBJ_EX, _NEWOBJ_EX_KW, _INST,
+                      _OBJ))
+_batches = frozenset((_APPENDS, _SETITEMS, _ADDITEMS))
+
+# Flags
+_NONEMPTY = 1           # A collection with items
+_MARKED = 2             # Made from the values after a MARK
+_STATE = 4              # An object whose only part is one state
+_STATE_DICT = 8         # An object whose last state is a dictionary
+_CLASSIC = 16           # An object made without arguments
+_CANDIDATE = 32         # An object that may be written as an <object>
+_FORM = 64              # The index of an object's form in _forms, times
+
+_forms = 'initialized_object', 'new_object', 'object', 'classic_object'
+
+_reconstructor = 'copy_reg', '_reconstructor'
+_object = '__builtin__', 'object'
+
+# Names that are their own XML text
+_name_like = re.compile(r'^[\w.]+$').match
+
+# Picklers number the memo slots from 0 up, skipping one now and then
+_MAX_GAP = 1 << 10
+
+
+def _cond(desc, kind, info):
+    # Is the value desc describes == a node of kind with info, as
+    # ppml.Base.__eq__ decides?  Returns True, False or, if the answer
+    # depends on whether the value gets an id, its memo slot.
+    if desc[2] != kind:
+        return True
+    if desc[3] != info:
+        return False
+    if desc[4] is None:
+        return True
+    return desc[4]
+
+def _conds(items):
+    # What Initialized_Object.output asks of a tuple of 3 arguments
+    return (_cond(items[1], _GLOBAL, _object),
+            _cond(items[2], _NAMED, 'none'))
+
+def _combine(*conds):
+    # False, or the slots that mustn't get ids for all of conds to hold
+    slots = []
+    for cond in conds:
+        if cond is False:
+            return False
+        if cond is not True:
+            slots.append(cond)
+    return slots
+
+def _args_cond(desc):
+    if desc[2] == _ENTRY and desc[4] is not None:
+        return desc[4]
+    return False,
+
+
+class _Scanner(object):
+    """The first pass"""
+
+    def __init__(self, file):
+        self.read = file.read
+        self.readline = file.readline
+        self.tell = file.tell
+        self.proto = 0
+        self.n = 0
+        self.puts = 0
+        self.ids = {}           # slot -> id, of the slots fetched
+        self.repeated = {}      # slot -> identifier string
+        self.names = {}         # slot -> string that may be a name
+        self._next = 0
+        self._holes = set()
+        self._got = 0
+        self._new = [None, None]
+        self._pairs = {}
+
+    def scan(self, index=0):
+        """Scan up to the end of the pickle at index
+
+        offset and start are then the file offset the pickle starts
+        at, and the number of its first opcode, the number of memo
+        puts before it and its protocol.  The entries of the pickle
+        are described by kinds, flags, slots and counts, and by parts
+        and globals, and order holds, for each entry in the order the
+        second pass gets to them, the number of the opcode it starts
+        at, relative to the first, shifted left by 32 bits, or'ed with
+        0xffffffff less the entry's number.
+        """
+        while 1:
+            self.offset = self.tell()
+            self.start = self.n, self.puts, self.proto
+            self.kinds = array('b')
+            self.flags = array('B')
+            self.slots = array('i')     # The memo slot, or -1
+            self.counts = array('I')    # See _Transcoder._open()
+            self.starts = array('I')
+            self.parts = {}             # entry -> _Object parts
+            self.cands = {}             # entry -> slots, see _combine()
+            self.globals = {}           # entry -> (module, name)
+            self._scan()
+            if index <= 0:
+                break
+            index -= 1
+
+        kinds, flags = self.kinds, self.flags
+        for e in xrange(len(kinds)):
+            if kinds[e] in _objects:
+                flags[e] |= _forms.index(self._form(e)) * _FORM
+        # Entries that start at the same opcode are opened outermost,
+        # that is last made, first
+        starts = self.starts
+        self.order = array('L', sorted(
+            [starts[e] << 32 | 0xffffffff - e for e in xrange(len(starts))]))
+        del self.starts, self.cands
+
+    def _form(self, e):
+        kind = self.kinds[e]
+        if kind == _NEWOBJ or kind == _NEWOBJ_EX:
+            return 'new_object'
+        flags = self.flags[e]
+        parts = self.parts.get(e, ())
+        if flags & _STATE_DICT and parts.count('S') == len(parts):
+            if flags & _CANDIDATE:
+                ids = self.ids
+                for slot in self.cands.get(e, ()):
+                    if slot in ids:
+                        break
+                else:
+                    return 'object'
+            if flags & _CLASSIC:
+                return 'classic_object'
+        return 'initialized_object'
+
+    def _scan(self):
+        self.stack = []
+        read = self.read
+        dispatch = self.dispatch
+        while 1:
+            key = read(1)
+            if not key:
+                raise EOFError
+            stop = dispatch.get(key, _Scanner.unsupported)(self)
+            self.n += 1
+            if stop:
+                return
+
+    def unsupported(self):
+        raise _Unsupported
+
+    def _push(self, kind=_LEAF, info=None):
+        n = self.n
+        self.stack.append((n, n, kind, info, None))
+
+    def _pop(self):
+        stack = self.stack
+        if not stack or stack[-1][2] == _MARKER:
+            raise _Unsupported
+        return stack.pop()
+
+    def _top(self):
+        stack = self.stack
+        if not stack:
+            raise _Unsupported
+        return stack[-1]
+
+    def _entry(self, kind, start, flags=0, count=0):
+        e = len(self.kinds)
+        self.kinds.append(kind)
+        self.flags.append(flags)
+        self.slots.append(-1)
+        self.counts.append(count)
+        self.starts.append(start - self.start[0])
+        return e
+
+    def _begin(self, kind, desc_kind=_ENTRY, flags=0):
+        # An entry that starts here
+        n = self.n
+        self.stack.append((n, n, desc_kind, self._entry(kind, n, flags),
+                           None))
+
+    def _empty(self, desc):
+        # Is the value desc describes false?
+        if desc[2] != _ENTRY:
+            return False
+        e = desc[3]
+        return (self.kinds[e] in _collections
+                and not self.flags[e] & _NONEMPTY)
+
+    def _pair(self, module, name):
+        # Objects of the same class share the tuple
+        pair = module, name
+        return self._pairs.setdefault(pair, pair)
+
+    def _module(self, module):
+        if self.proto >= 3:
+            module = ppml._python3_modules.get(module, module)
+        return module
+
+    dispatch = {}
+
+    def load_persid(self):
+        self.readline()
+        self._push()
+    dispatch[PERSID] = load_persid
+
+    def load_binpersid(self):
+        pid = self._pop()
+        e = self._entry(_PERSID, pid[0])
+        self.stack.append((pid[0], self.n, _ENTRY, e, None))
+    dispatch[BINPERSID] = load_binpersid
+
+    def load_none(self):
+        self._push(_NAMED, 'none')
+    dispatch[NONE] = load_none
+
+    def load_false(self):
+        self._push(_NAMED, 'false')
+    dispatch[NEWFALSE] = load_false
+
+    def load_true(self):
+        self._push(_NAMED, 'true')
+    dispatch[NEWTRUE] = load_true
+
+    def load_int(self):
+        s = self.readline()[:-1]
+        i = int(s)
+        if s[0] == "0":
+            if i == 1:
+                self._push(_NAMED, 'true')
+                return
+            elif i == 0 and s != "0":
+                self._push(_NAMED, 'false')
+                return
+        self._push()
+    dispatch[INT] = load_int
+
+    def load_binint(self):
+        mloads('i' + self.read(4))
+        self._push()
+    dispatch[BININT] = load_binint
+
+    def load_binint1(self):
+        ord(self.read(1))
+        self._push()
+    dispatch[BININT1] = load_binint1
+
+    def load_binint2(self):
+        mloads('i' + self.read(2) + '\000\000')
+        self._push()
+    dispatch[BININT2] = load_binint2
+
+    def load_long(self):
+        long(self.readline()[:-1], 0)
+        self._push()
+    dispatch[LONG] = load_long
+
+    def load_float(self):
+        float(self.readline()[:-1])
+        self._push()
+    dispatch[FLOAT] = load_float
+
+    def load_binfloat(self, unpack=struct.unpack):
+        unpack('>d', self.read(8))
+        self._push()
+    dispatch[BINFLOAT] = load_binfloat
+
+    def load_string(self):
+        self._push(_STRING,
+                   eval(self.readline()[:-1], {'__builtins__': {}}))
+    dispatch[STRING] = load_string
+
+    def load_binstring(self):
+        len = mloads('i' + self.read(4))
+        self._push(_STRING, self.read(len))
+    dispatch[BINSTRING] = load_binstring
+    dispatch[BINBYTES] = load_binstring
+
+    def load_short_binstring(self):
+        len = ord(self.read(1))
+        self._push(_STRING, self.read(len))
+    dispatch[SHORT_BINSTRING] = load_short_binstring
+    dispatch[SHORT_BINBYTES] = load_short_binstring
+
+    def load_binbytes8(self):
+        len, = struct.unpack('<Q', self.read(8))
+        self._push(_STRING, self.read(len))
+    dispatch[BINBYTES8] = load_binbytes8
+
+    # Unicode strings are kept as utf-8, the text they are written as
+    # if they are names
+
+    def load_unicode(self):
+        self._push(_UNICODE, unicode(self.readline()[:-1],
+                                     'raw-unicode-escape').encode('utf-8'))
+    dispatch[UNICODE] = load_unicode
+
+    def _unicode(self, len):
+        s = self.read(len)
+        s.decode('utf-8')
+        self._push(_UNICODE, s)
+
+    def load_binunicode(self):
+        self._unicode(mloads('i' + self.read(4)))
+    dispatch[BINUNICODE] = load_binunicode
+
+    def load_short_binunicode(self):
+        self._unicode(ord(self.read(1)))
+    dispatch[SHORT_BINUNICODE] = load_short_binunicode
+
+    def load_binunicode8(self):
+        self._unicode(struct.unpack('<Q', self.read(8))[0])
+    dispatch[BINUNICODE8] = load_binunicode8
+
+    def load_long1(self):
+        n = ord(self.read(1))
+        self.read(n)
+        self._push()
+    dispatch[LONG1] = load_long1
+
+    def load_long4(self):
+        n = mloads('i' + self.read(4))
+        self.read(n)
+        self._push()
+    dispatch[LONG4] = load_long4
+
+    def load_bytearray8(self):
+        len, = struct.unpack('<Q', self.read(8))
+        self.read(len)
+        self._push(_OBJECT_LEAF)
+    dispatch[BYTEARRAY8] = load_bytearray8
+
+    def load_global(self):
+        module = self.readline()[:-1]
+        name = self.readline()[:-1]
+        self._push(_GLOBAL, (self._module(module), name))
+    dispatch[GLOBAL] = load_global
+
+    def _extension(self, code):
+        key = _inverted_registry.get(code)
+        if not key:
+            raise _Unsupported
+        self._push(_GLOBAL, (self._module(key[0]), key[1]))
+
+    def load_ext1(self):
+        self._extension(ord(self.read(1)))
+    dispatch[EXT1] = load_ext1
+
+    def load_ext2(self):
+        self._extension(mloads('i' + self.read(2) + '\000\000'))
+    dispatch[EXT2] = load_ext2
+
+    def load_ext4(self):
+        self._extension(mloads('i' + self.read(4)))
+    dispatch[EXT4] = load_ext4
+
+    def load_stack_global(self):
+        name = self._name(self._pop())
+        module_desc = self._pop()
+        module = self._name(module_desc)
+        start = module_desc[0]
+        e = self._entry(_STACK_GLOBAL, start)
+        self.globals[e] = self._pair(module, name)
+        self.stack.append(
+            (start, self.n, _GLOBAL, (self._module(module), name), None))
+    dispatch[STACK_GLOBAL] = load_stack_global
+
+    def _name(self, desc):
+        # What ToXMLUnpickler.__name returns, including taking back
+        # the id of a reference it gave one
+        kind, info = desc[2], desc[3]
+        if kind == _REF:
+            new = self._new
+            if new[-1] is not None and new[-1][0] == desc[1]:
+                del self.ids[info]
+                self._got -= 1
+                new.pop()
+                new.insert(0, None)
+            info = self.names.get(info)
+            if info is None:
+                raise _Unsupported
+        elif (kind != _STRING and kind != _UNICODE) or not _name_like(info):
+            raise _Unsupported
+        return info
+
+    def load_empty_tuple(self):
+        self._begin(_TUPLE)
+    dispatch[EMPTY_TUPLE] = load_empty_tuple
+
+    def load_empty_list(self):
+        self._begin(_LIST)
+    dispatch[EMPTY_LIST] = load_empty_list
+
+    def load_empty_dictionary(self):
+        self._begin(_DICT)
+    dispatch[EMPTY_DICT] = load_empty_dictionary
+
+    def load_empty_set(self):
+        self._begin(_SET)
+    dispatch[EMPTY_SET] = load_empty_set
+
+    def load_mark(self):
+        # The kind is set by the opcode that ends the mark
+        self._begin(_OPEN_MARK, _MARKER, _MARKED)
+    dispatch[MARK] = load_mark
+
+    def _marker(self):
+        stack = self.stack
+        k = len(stack) - 1
+        while k >= 0 and stack[k][2] != _MARKER:
+            k -= 1
+        if k < 0:
+            raise _Unsupported
+        return k
+
+    def _end(self, kind, k, items, extra=None):
+        stack = self.stack
+        start, e = stack[k][0], stack[k][3]
+        self.kinds[e] = kind
+        if items:
+            self.flags[e] |= _NONEMPTY
+        stack[k:] = [(start, self.n, _ENTRY, e, extra)]
+
+    def load_tuple(self):
+        k = self._marker()
+        items = self.stack[k+1:]
+        self._end(_TUPLE, k, len(items), len(items) == 3 and _conds(items)
+                  or None)
+    dispatch[TUPLE] = load_tuple
+
+    def load_list(self):
+        k = self._marker()
+        self._end(_LIST, k, len(self.stack) - k - 1)
+    dispatch[LIST] = load_list
+
+    def load_frozenset(self):
+        k = self._marker()
+        self._end(_FROZENSET, k, len(self.stack) - k - 1)
+    dispatch[FROZENSET] = load_frozenset
+
+    def load_dict(self):
+        k = self._marker()
+        n = len(self.stack) - k - 1
+        if n % 2:
+            raise _Unsupported
+        self._end(_DICT, k, n // 2)
+    dispatch[DICT] = load_dict
+
+    def _candidate(self, e, cand):
+        if cand is not False:
+            self.flags[e] |= _CANDIDATE
+            if cand:
+                self.cands[e] = cand
+
+    def _end_object(self, kind, k, klass, args):
+        # The entry of the mark becomes an object's
+        stack = self.stack
+        start, e = stack[k][0], stack[k][3]
+        del stack[k:]
+        self.kinds[e] = kind
+        self.counts[e] = len(args)
+        if len(args) == 3:
+            self._candidate(e, _combine(klass, *_conds(args)))
+        elif not args:
+            self.flags[e] |= _CLASSIC
+        stack.append((start, self.n, _ENTRY, e, None))
+        return e
+
+    def load_inst(self):
+        k = self._marker()
+        args = self.stack[k+1:]
+        module = self.readline()[:-1]
+        name = self.readline()[:-1]
+        e = self._end_object(
+            _INST, k, (self._module(module), name) == _reconstructor, args)
+        self.globals[e] = self._pair(module, name)
+    dispatch[INST] = load_inst
+
+    def load_obj(self):
+        k = self._marker()
+        items = self.stack[k+1:]
+        if not items:
+            raise _Unsupported
+        self._end_object(
+            _OBJ, k, _cond(items[0], _GLOBAL, _reconstructor), items[1:])
+    dispatch[OBJ] = load_obj
+
+    def _object(self, kind, start, count=0):
+        e = self._entry(kind, start, 0, count)
+        self.stack.append((start, self.n, _ENTRY, e, None))
+        return e
+
+    def load_reduce(self):
+        args = self._pop()
+        callable = self._pop()
+        e = self._object(_REDUCE, callable[0])
+        self._candidate(e, _combine(_cond(callable, _GLOBAL, _reconstructor),
+                                    *_args_cond(args)))
+        if self._empty(args):
+            self.flags[e] |= _CLASSIC
+    dispatch[REDUCE] = load_reduce
+
+    def load_newobj(self):
+        self._pop()
+        klass = self._pop()
+        self._object(_NEWOBJ, klass[0])
+    dispatch[NEWOBJ] = load_newobj
+
+    def load_newobj_ex(self):
+        kw = self._pop()
+        self._pop()
+        klass = self._pop()
+        if self._empty(kw) and self.kinds[kw[3]] == _DICT:
+            self._object(_NEWOBJ_EX, klass[0])
+        else:
+            # The class and arguments are written as a call of
+            # copy_reg.__newobj_ex__
+            self._object(_NEWOBJ_EX_KW, klass[0], 3)
+    dispatch[NEWOBJ_EX] = load_newobj_ex
+
+    def _tuple(self, n):
+        stack = self.stack
+        items = stack[-n:]
+        if len(items) < n or [item for item in items if item[2] == _MARKER]:
+            raise _Unsupported
+        start = items[0][0]
+        e = self._entry(_TUPLE, start, _NONEMPTY, n)
+        stack[-n:] = [(start, self.n, _ENTRY, e, n == 3 and _conds(items)
+                       or None)]
+
+    def load_tuple1(self):
+        self._tuple(1)
+    dispatch[TUPLE1] = load_tuple1
+
+    def load_tuple2(self):
+        self._tuple(2)
+    dispatch[TUPLE2] = load_tuple2
+
+    def load_tuple3(self):
+        self._tuple(3)
+    dispatch[TUPLE3] = load_tuple3
+
+    def _part(self, e, kind, items):
+        # Add to the list ('L') or dictionary ('D') items of an object.
+        # Its parts are 'S' for a state or [kind, units, items] for
+        # items, in order.
+        parts = self.parts.get(e)
+        if parts is None:
+            parts = self.parts[e] = []
+            if self.flags[e] & _STATE:
+                self.flags[e] &= ~_STATE
+                parts.append('S')
+        i = len(parts) - 1
+        while i >= 0 and parts[i] == 'S':
+            i -= 1
+        if i >= 0 and parts[i][0] == kind:
+            if i < len(parts) - 1:
+                # The tree would write these items before the state
+                raise _Unsupported
+            parts[i][1] += 1
+            parts[i][2] += items
+        else:
+            parts.append([kind, 1, items])
+
+    def _extend(self, desc, items):
+        if desc[2] == _ENTRY:
+            e = desc[3]
+            kind = self.kinds[e]
+            if kind == _LIST or kind == _SET or kind == _FROZENSET:
+                self.counts[e] += 1
+                if items:
+                    self.flags[e] |= _NONEMPTY
+                return
+            if kind in _objects:
+                self._part(e, 'L', items)
+                return
+        raise _Unsupported
+
+    def _setitems(self, desc, items):
+        if desc[2] == _ENTRY:
+            e = desc[3]
+            kind = self.kinds[e]
+            if kind == _DICT:
+                self.counts[e] += 1
+                if items:
+                    self.flags[e] |= _NONEMPTY
+                return
+            if kind in _objects:
+                self._part(e, 'D', items)
+                return
+        raise _Unsupported
+
+    def _batch(self, kind):
+        k = self._marker()
+        if k == 0:
+            raise _Unsupported
+        stack = self.stack
+        self.kinds[stack[k][3]] = kind
+        n = len(stack) - k - 1
+        del stack[k:]
+        return stack[-1], n
+
+    def load_append(self):
+        self._pop()
+        self._extend(self._top(), 1)
+    dispatch[APPEND] = load_append
+
+    def load_appends(self):
+        self._extend(*self._batch(_APPENDS))
+    dispatch[APPENDS] = load_appends
+
+    def load_additems(self):
+        self._extend(*self._batch(_ADDITEMS))
+    dispatch[ADDITEMS] = load_additems
+
+    def load_setitem(self):
+        self._pop()
+        self._pop()
+        self._setitems(self._top(), 1)
+    dispatch[SETITEM] = load_setitem
+
+    def load_setitems(self):
+        desc, n = self._batch(_SETITEMS)
+        if n % 2:
+            raise _Unsupported
+        self._setitems(desc, n // 2)
+    dispatch[SETITEMS] = load_setitems
+
+    def load_build(self):
+        state = self._pop()
+        desc = self._top()
+        if desc[2] == _ENTRY and self.kinds[desc[3]] in _objects:
+            e = desc[3]
+            flags = self.flags
+            parts = self.parts.get(e)
+            if parts is not None:
+                parts.append('S')
+            elif flags[e] & _STATE:
+                flags[e] &= ~_STATE
+                self.parts[e] = ['S', 'S']
+            else:
+                flags[e] |= _STATE
+            if state[2] == _ENTRY and self.kinds[state[3]] == _DICT:
+                flags[e] |= _STATE_DICT
+            else:
+                flags[e] &= ~_STATE_DICT
+        elif desc[2] != _OBJECT_LEAF and self._empty(state):
+            # An empty state is ignored
+            self._entry(_POPPED, state[0])
+        else:
+            raise _Unsupported
+    dispatch[BUILD] = load_build
+
+    def load_pop(self):
+        desc = self._top()
+        if desc[2] == _MARKER:
+            # Protocol 0 has no POP_MARK
+            self.stack.pop()
+            self.kinds[desc[3]] = _POPPED_MARK
+        else:
+            self._entry(_POPPED, self.stack.pop()[0])
+    dispatch[POP] = load_pop
+
+    def load_pop_mark(self):
+        k = self._marker()
+        self.kinds[self.stack[k][3]] = _POP_MARK
+        del self.stack[k:]
+    dispatch[POP_MARK] = load_pop_mark
+
+    def _get(self, slot):
+        if slot < 0 or slot >= self._next or slot in self._holes:
+            raise _Unsupported
+        n = self.n
+        value = self.repeated.get(slot)
+        if value is not None:
+            self.stack.append((n, n, _STRING, value, None))
+            return
+        if slot not in self.ids:
+            self.ids[slot] = 'o%d' % self._got
+            self._got += 1
+            new = self._new
+            del new[0]
+            new.append((n, slot))
+        self.stack.append((n, n, _REF, slot, None))
+
+    def _put(self, slot):
+        if slot < 0:
+            raise _Unsupported
+        if slot >= self._next:
+            if slot - self._next > _MAX_GAP:
+                raise _Unsupported
+            self._holes.update(xrange(self._next, slot))
+            self._next = slot + 1
+        elif slot in self._holes:
+            self._holes.remove(slot)
+        else:
+            # The slot is set again
+            raise _Unsupported
+        self.puts += 1
+        start, op, kind, info, old = self._top()
+        if kind == _ENTRY:
+            if self.slots[info] != -1:
+                raise _Unsupported
+            self.slots[info] = slot
+            return
+        if kind == _MARKER or op != self.n - 1:
+            # The second pass looks for the ids of values that aren't
+            # entries just after them
+            raise _Unsupported
+        if kind == _STRING and identifier(info):
+            self.repeated[slot] = info
+        elif ((kind == _STRING or kind == _UNICODE) and self.proto >= 4
+              and _name_like(info)):
+            self.names[slot] = info
+        self.stack[-1] = start, op, kind, info, slot
+
+    def _text_slot(self):
+        key = self.readline()[:-1]
+        try:
+            slot = int(key)
+        except ValueError:
+            raise _Unsupported
+        if repr(slot) != key:
+            raise _Unsupported
+        return slot
+
+    def load_get(self):
+        self._get(self._text_slot())
+    dispatch[GET] = load_get
+
+    def load_binget(self):
+        self._get(ord(self.read(1)))
+    dispatch[BINGET] = load_binget
+
+    def load_long_binget(self):
+        self._get(mloads('i' + self.read(4)))
+    dispatch[LONG_BINGET] = load_long_binget
+
+    def load_put(self):
+        self._put(self._text_slot())
+    dispatch[PUT] = load_put
+
+    def load_binput(self):
+        self._put(ord(self.read(1)))
+    dispatch[BINPUT] = load_binput
+
+    def load_long_binput(self):
+        self._put(mloads('i' + self.read(4)))
+    dispatch[LONG_BINPUT] = load_long_binput
+
+    def load_memoize(self):
+        self._put(self.puts)
+    dispatch[MEMOIZE] = load_memoize
+
+    def load_proto(self):
+        proto = ord(self.read(1))
+        if not 0 <= proto <= HIGHEST_PROTOCOL:
+            raise _Unsupported
+        self.proto = proto
+    dispatch[PROTO] = load_proto
+
+    def load_frame(self):
+        self.read(8)
+    dispatch[FRAME] = load_frame
+
+    def load_readonly_buffer(self):
+        pass
+    dispatch[READONLY_BUFFER] = load_readonly_buffer
+
+    def load_stop(self):
+        stack = self.stack
+        if len(stack) != 1 or stack[0][2] == _MARKER:
+            raise _Unsupported
+        return True
+    dispatch[STOP] = load_stop
+
+    # DUP and NEXT_BUFFER aren't supported
+
+
+# Pass 2
+# ======
+#
+# The frames are the elements being written, and the values waiting
+# for more of the values they are made of.  Each new value is a child
+# of the innermost frame that still takes children, which gives it a
+# role: how it's to be written.
+
+_ITEM, _WRAP, _KEY, _ATTRS, _OBJARGS, _BATCH, _ARGS = range(7)
+
+def _discard(s):
+    pass
+
+_SKIP = _ITEM, _discard, 0
+
+
+def _collection(write, indent, name, id, items):
+    # Write the start tag of a collection and return its end tag
+    if id:
+        id = ' id="%s"' % id
+    i = ' ' * indent
+    if items:
+        write('%s<%s%s>\n' % (i, name, id))
+        return '%s</%s>\n' % (i, name)
+    write('%s<%s%s />\n' % (i, name, id))
+    return ''
+
+
+class _Frame(object):
+
+    remaining = 0       # How many more children it takes
+    batch = False       # Does it take children until the mark ends?
+
+    def __init__(self, write, end=''):
+        self.write = write
+        self.end = end
+
+    def close(self):
+        if self.end:
+            self.write(self.end)
+
+    def end_batch(self):
+        self.batch = False
+
+
+class _Root(_Frame):
+
+    remaining = 1
+
+    def child(self, frames, batch):
+        self.remaining = 0
+        return _WRAP, self.write, 0, ppml.Pickle, ''
+
+
+class _Silent(_Frame):
+    # A value that isn't written
+
+    def __init__(self, remaining, batch=False):
+        _Frame.__init__(self, _discard)
+        self.remaining = remaining
+        self.batch = batch
+
+    def child(self, frames, batch):
+        if not self.batch:
+            self.remaining -= 1
+        return _SKIP
+
+
+class _StackGlobal(_Silent):
+    # The module and name of a global, which is written with role when
+    # it's made
+
+    def __init__(self, pair, role):
+        _Silent.__init__(self, 2)
+        self.pair = pair
+        self.role = role
+
+
+class _Persistent(_Frame):
+
+    remaining = 1
+
+    def __init__(self, write, indent, id):
+        _Frame.__init__(self, write)
+        self.indent = indent
+        self.id = id
+
+    def child(self, frames, batch):
+        self.remaining = 0
+        return _WRAP, self.write, self.indent, ppml.Persistent, self.id
+
+
+class _Item(_Frame):
+    # A dictionary item waiting for its value
+
+    remaining = 1
+
+    def __init__(self, write, end, role):
+        _Frame.__init__(self, write, end)
+        self.role = role
+
+    def child(self, frames, batch):
+        self.remaining = 0
+        return self.role
+
+
+class _Sequence(_Frame):
+
+    def __init__(self, write, indent, end, remaining, batch=False):
+        _Frame.__init__(self, write, end)
+        self.indent = indent
+        self.remaining = remaining
+        self.batch = batch
+
+    def item(self):
+        return _ITEM, self.write, self.indent
+
+    def child(self, frames, batch):
+        if not self.batch:
+            self.remaining -= 1
+        if batch:
+            return _BATCH, self
+        return self.item()
+
+
+class _Dictionary(_Sequence):
+
+    def __init__(self, write, indent, end, remaining, batch=False,
+                 cls=ppml.Dictionary):
+        _Sequence.__init__(self, write, indent, end, remaining, batch)
+        self.item_name = cls.item_name
+        self.key_name = cls.key_name
+        self.key_class = cls.key_class
+
+    def item(self):
+        return _KEY, self.write, self.indent, self
+
+
+class _Batch(_Frame):
+    # The values added to a container by APPENDS, SETITEMS or ADDITEMS
+
+    batch = True
+
+    def __init__(self, container):
+        _Frame.__init__(self, container.write)
+        self.container = container
+
+    def child(self, frames, batch):
+        return self.container.item()
+
+
+class _Arguments(_Silent):
+    # The arguments of an <object>, which are only written as its class
+
+    def __init__(self, write, indent, remaining, batch=False):
+        _Silent.__init__(self, remaining, batch)
+        self.klass = _WRAP, write, indent, ppml.Klass, ''
+
+    def child(self, frames, batch):
+        klass = self.klass
+        if klass is None:
+            return _Silent.child(self, frames, batch)
+        self.klass = None
+        if not self.batch:
+            self.remaining -= 1
+        return klass
+
+
+class _Object(_Frame):
+
+    def __init__(self, transcoder, e, write, indent):
+        flags = transcoder._flags[e]
+        form = self.form = _forms[flags // _FORM]
+        id = ''
+        if form == 'initialized_object' or form == 'new_object':
+            id = transcoder._id(e)
+        self.end = _collection(write, indent, form, id, True)
+        self.write = write
+        self.indent = indent = indent + 2
+
+        klass = _WRAP, write, indent, ppml.Klass, ''
+        arguments = _WRAP, write, indent, ppml.Arguments, ''
+        kind = transcoder._kinds[e]
+        self.nargs = transcoder._counts[e]
+        self.tail = None
+        if kind == _REDUCE or kind == _NEWOBJ:
+            if form == 'object':
+                todo = [_SKIP, (_OBJARGS, write, indent)]
+            elif form == 'classic_object':
+                todo = [klass, _SKIP]
+            else:
+                todo = [klass, arguments]
+        elif kind == _NEWOBJ_EX:
+            todo = [klass, arguments, _SKIP]
+        else:
+            # The arguments, and for inst and newobj_ex with keywords
+            # the class, aren't on the stack
+            if kind == _OBJ:
+                todo = [form == 'object' and _SKIP or klass]
+            else:
+                todo = []
+                if form != 'object':
+                    if kind == _INST:
+                        node = transcoder._global(*transcoder._globals[e])
+                    else:
+                        node = ppml.Global('copy_reg', '__newobj_ex__')
+                    ppml.Klass(node).output(write, indent)
+            if self.nargs:
+                todo.append(_ARGS)
+            elif form == 'initialized_object':
+                self.tail = ppml.Arguments(ppml.Tuple()).output
+                if kind != _OBJ:
+                    self.tail(write, indent)
+                    self.tail = None
+
+        todo.reverse()
+        self.todo = todo
+        parts = transcoder._parts.pop(e, None)
+        if parts is None:
+            parts = flags & _STATE and ['S'] or []
+        else:
+            parts.reverse()
+        self.parts = parts
+        self.states = parts.count('S')
+        self.batch = flags & _MARKED
+        if self.batch:
+            self.remaining = len(parts)
+        else:
+            self.remaining = len(parts) + len(todo)
+
+    def end_batch(self):
+        self.batch = False
+        if self.tail is not None:
+            self.tail(self.write, self.indent)
+
+    def child(self, frames, batch):
+        if not self.batch:
+            self.remaining -= 1
+        write, indent = self.write, self.indent
+        if self.todo:
+            role = self.todo.pop()
+            if role is not _ARGS:
+                return role
+            if self.form == 'object':
+                frame = _Arguments(write, indent, self.nargs)
+            else:
+                i = ' ' * indent
+                write('%s<arguments>\n' % i)
+                frames.append(_Frame(write, '%s</arguments>\n' % i))
+                end = _collection(write, indent + 2, 'tuple', '', True)
+                frame = _Sequence(write, indent + 4, end, self.nargs)
+            frames.append(frame)
+            return frame.child(frames, batch)
+
+        part = self.parts.pop()
+        if part == 'S':
+            self.states -= 1
+            if self.form == 'initialized_object' or self.form == 'new_object':
+                return _WRAP, write, indent, ppml.State, ''
+            if self.states:
+                return _SKIP
+            return _ATTRS, write, indent
+
+        kind, units, items = part
+        if kind == 'L':
+            end = _collection(write, indent, 'listitems', '', items)
+            frame = _Sequence(write, indent + 2, end, units)
+        else:
+            end = _collection(write, indent, 'dictitems', '', items)
+            frame = _Dictionary(write, indent + 2, end, units)
+        frames.append(frame)
+        return frame.child(frames, batch)
+
+
+def _leaf(load):
+    # Make a loader of a value that isn't an entry write it
+    def load_leaf(self):
+        load(self)
+        self._value(self.stack.pop())
+    return load_leaf
+
+
+class _Transcoder(ppml.ToXMLUnpickler):
+    """The second pass"""
+
+    def __init__(self, file, scanner, write):
+        ppml.ToXMLUnpickler.__init__(self, file)
+        self._kinds = scanner.kinds
+        self._flags = scanner.flags
+        self._slots = scanner.slots
+        self._counts = scanner.counts
+        self._parts = scanner.parts
+        self._globals = scanner.globals
+        self._order = scanner.order
+        self._ids = scanner.ids
+        self._repeated = scanner.repeated
+        self._n, self._puts, self.proto = scanner.start
+        self._first = self._n
+        self._i = 0
+        self._upcoming()
+        self._frames = [_Root(write)]
+        self._marks = []
+        self._key = None
+
+    def transcode(self):
+        self.stack = []
+        self.append = self.stack.append
+        read = self.read
+        dispatch = self.dispatch
+        while 1:
+            key = self._key
+            if key is None:
+                key = read(1)
+            else:
+                self._key = None
+            if not key:
+                raise EOFError
+            stop = dispatch[key](self)
+            self._n += 1
+            if stop:
+                return
+
+    def _put_id(self):
+        # The id of the value just read, if the next opcode puts it in
+        # the memo
+        read = self.read
+        key = read(1)
+        if key == BINPUT:
+            slot = ord(read(1))
+        elif key == MEMOIZE:
+            slot = self._puts
+        elif key == LONG_BINPUT:
+            slot = mloads('i' + read(4))
+        elif key == PUT:
+            slot = int(self.readline()[:-1])
+        else:
+            self._key = key
+            return ''
+        self._puts += 1
+        self._n += 1
+        return self._ids.get(slot, '')
+
+    def _child(self, batch=False):
+        frames = self._frames
+        frame = frames[-1]
+        while not (frame.batch or frame.remaining):
+            frames.pop()
+            if frame.end:
+                frame.write(frame.end)
+            frame = frames[-1]
+        return frame.child(frames, batch)
+
+    def _upcoming(self):
+        # Note the number of the next opcode that entries start at
+        order = self._order
+        if self._i < len(order):
+            self._next_start = self._first + (order[self._i] >> 32)
+        else:
+            self._next_start = -1
+
+    def _start(self):
+        # Open the entries that start at this opcode
+        order = self._order
+        i = self._i
+        start = order[i] >> 32
+        while 1:
+            self._open(0xffffffff - (order[i] & 0xffffffff))
+            i += 1
+            if i == len(order):
+                self._next_start = -1
+                break
+            if order[i] >> 32 != start:
+                self._next_start = self._first + (order[i] >> 32)
+                break
+        self._i = i
+
+    def _id(self, e):
+        slot = self._slots[e]
+        if slot < 0:
+            return ''
+        return self._ids.get(slot, '')
+
+    def _value(self, node):
+        start = self._n == self._next_start
+        id = self._put_id()
+        if start:
+            self._start()
+        self._render(node, id, self._child())
+
+    def _render(self, node, id, role):
+        if id:
+            if node.shared:
+                node = node.copy()
+            node.id = id
+        how = role[0]
+        if how is _KEY:
+            role = self._key_role(node, role)
+            if role is None:
+                return
+        write = role[1]
+        if write is _discard:
+            return
+        if role[0] is _ITEM:
+            node.output(write, role[2])
+        else:
+            wrapper = role[3](node)
+            if role[4]:
+                wrapper.id = role[4]
+            wrapper.output(write, role[2])
+
+    def _key_role(self, node, role):
+        # Start an item of a dictionary, and return the role of its
+        # key, or None if the key is written in the start tag
+        write, indent, dictionary = role[1:]
+        i = ' ' * indent
+        end = '%s</%s>\n' % (i, dictionary.item_name)
+        if (node is not None
+            and node.__class__ is ppml.String
+            and not node.encoding
+            and identifier(node.value())
+            ):
+            id = node.id
+            if id:
+                id = ' id="%s"' % id
+            write('%s<%s %s="%s"%s>\n' % (
+                i, dictionary.item_name, dictionary.key_name, node.value(),
+                id))
+            self._frames.append(_Item(write, end, (_ITEM, write, indent + 4)))
+            return None
+        write('%s<%s>\n' % (i, dictionary.item_name))
+        self._frames.append(
+            _Item(write, end, (_WRAP, write, indent + 2, ppml.Value, '')))
+        return _WRAP, write, indent + 2, dictionary.key_class, ''
+
+    def _open(self, e):
+        kind = self._kinds[e]
+        frames = self._frames
+        if kind == _POPPED:
+            frames.append(_Silent(1))
+            return
+        if kind == _POPPED_MARK:
+            # Its values were popped one by one
+            return
+        if kind == _POP_MARK:
+            frame = _Silent(0, True)
+            frames.append(frame)
+            self._marks.append(frame)
+            return
+        if kind in _batches:
+            frame = _Batch(self._child(True)[1])
+            frames.append(frame)
+            self._marks.append(frame)
+            return
+
+        role = self._child()
+        if kind == _STACK_GLOBAL:
+            frames.append(_StackGlobal(self._globals[e], role))
+            return
+        how = role[0]
+        if how is _KEY:
+            role = self._key_role(None, role)
+            how = _WRAP
+        write, indent = role[1], role[2]
+        if how is _WRAP:
+            name = role[3].__name__.lower()
+            id = role[4]
+            if id:
+                id = ' id="%s"' % id
+            i = ' ' * indent
+            write('%s<%s%s>\n' % (i, name, id))
+            frames.append(_Frame(write, '%s</%s>\n' % (i, name)))
+            indent += 2
+
+        # The values a container is made from that aren't after a
+        # MARK, and the times items are added to it
+        remaining = self._counts[e]
+        flags = self._flags[e]
+        marked = flags & _MARKED
+        items = flags & _NONEMPTY
+        if how is _OBJARGS:
+            frame = _Arguments(write, indent, remaining, marked)
+        elif how is _ATTRS:
+            end = _collection(write, indent, 'attributes', self._id(e),
+                              items)
+            frame = _Dictionary(write, indent + 2, end, remaining, marked,
+                                ppml.Attributes)
+        elif kind in _objects:
+            frame = _Object(self, e, write, indent)
+        elif kind == _PERSID:
+            frame = _Persistent(write, indent, self._id(e))
+        else:
+            end = _collection(write, indent, _names[kind], self._id(e),
+                              items)
+            if kind == _DICT:
+                frame = _Dictionary(write, indent + 2, end, remaining,
+                                    marked)
+            else:
+                frame = _Sequence(write, indent + 2, end, remaining, marked)
+        frames.append(frame)
+        if marked:
+            self._marks.append(frame)
+
+    def _end_mark(self):
+        frame = self._marks.pop()
+        frames = self._frames
+        while frames[-1] is not frame:
+            frames.pop().close()
+        frame.end_batch()
+
+    def _nothing(self):
+        pass
+
+    dispatch = {}
+
+    for _key in (PERSID, NONE, NEWFALSE, NEWTRUE, INT, BININT, BININT1,
+                 BININT2, LONG, FLOAT, BINFLOAT, STRING, BINSTRING,
+                 SHORT_BINSTRING, UNICODE, BINUNICODE, GLOBAL, EXT1, EXT2,
+                 EXT4, LONG1, LONG4, SHORT_BINBYTES, BINBYTES, BINBYTES8,
+                 SHORT_BINUNICODE, BINUNICODE8, BYTEARRAY8):
+        dispatch[_key] = _leaf(ppml.ToXMLUnpickler.dispatch[_key])
+    for _key in PROTO, FRAME, READONLY_BUFFER:
+        dispatch[_key] = ppml.ToXMLUnpickler.dispatch[_key]
+    for _key in EMPTY_TUPLE, EMPTY_LIST, EMPTY_DICT, EMPTY_SET, MARK:
+        dispatch[_key] = _start
+    for _key in (TUPLE, LIST, DICT, FROZENSET, OBJ, APPENDS, SETITEMS,
+                 ADDITEMS, POP_MARK):
+        dispatch[_key] = _end_mark
+    # The values these make were started by the first value they're
+    # made from, and they're ended by the next value that isn't theirs
+    for _key in (TUPLE1, TUPLE2, TUPLE3, APPEND, SETITEM, REDUCE, NEWOBJ,
+                 NEWOBJ_EX, BUILD, BINPERSID, POP):
+        dispatch[_key] = _nothing
+    del _key
+
+    def load_inst(self):
+        self.readline()
+        self.readline()
+        self._end_mark()
+    dispatch[INST] = load_inst
+
+    def load_stack_global(self):
+        frames = self._frames
+        while frames[-1].__class__ is not _StackGlobal:
+            frames.pop().close()
+        frame = frames.pop()
+        node = self._global(*frame.pair)
+        self._render(node, self._put_id(), frame.role)
+    dispatch[STACK_GLOBAL] = load_stack_global
+
+    def _get(self, slot):
+        value = self._repeated.get(slot)
+        if value is not None:
+            node = self._string(value)
+        else:
+            node = ppml.Reference(self._ids.get(slot, ''))
+        self._value(node)
+
+    def load_get(self):
+        self._get(int(self.readline()[:-1]))
+    dispatch[GET] = load_get
+
+    def load_binget(self):
+        self._get(ord(self.read(1)))
+    dispatch[BINGET] = load_binget
+
+    def load_long_binget(self):
+        self._get(mloads('i' + self.read(4)))
+    dispatch[LONG_BINGET] = load_long_binget
+
+    def load_put(self):
+        self.readline()
+        self._puts += 1
+    dispatch[PUT] = load_put
+
+    def load_binput(self):
+        self.read(1)
+        self._puts += 1
+    dispatch[BINPUT] = load_binput
+
+    def load_long_binput(self):
+        self.read(4)
+        self._puts += 1
+    dispatch[LONG_BINPUT] = load_long_binput
+
+    def load_memoize(self):
+        self._puts += 1
+    dispatch[MEMOIZE] = load_memoize
+
+    def load_stop(self):
+        frames = self._frames
+        while frames:
+            frames.pop().close()
+        return True
+    dispatch[STOP] = load_stop
+
+
+def transcode(p_or_file, write, index=0, pretty=True, stats=None):
+    """Write the XML toxml() makes of a pickle, without a tree of nodes
+
+    The pickle at index in a string or a seekable file is read twice,
+    once to scan it and once to write it to the write function.
+    pretty is as for toxml().
+    """
+    if stats is None:
+        stats = _null
+    file = _input(p_or_file)
+    start = file.tell()
+    scanner = _Scanner(file)
+    try:
+        stats.call('scan', scanner.scan, index)
+    except _Unsupported:
+        file.seek(start)
+        _toxml(file, index, write, stats, pretty)
+        return
+    file.seek(scanner.offset)
+    if pretty:
+        write('<?xml version="1.0" encoding="utf-8" ?>\n')
+    else:
+        write('<?xml version="1.0" encoding="utf-8" ?>')
+        write = ppml.Compact(write)
+    stats.call('output', _Transcoder(file, scanner, write).transcode)
@@ -0,0 +1,431 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Load Python objects straight from XML pickles.
+
+`XMLUnpickler` builds objects from expat events.  For each element it
+does what cPickle does with the pickle `ppml.xmlPickler` writes for
+it, without ever building that pickle.
+
+"""
+
+import sys
+from copy_reg import _reconstructor
+from cPickle import BadPickleGet, UnpicklingError
+from types import ClassType, InstanceType
+from xml.parsers import expat
+
+from zope.xmlpickle.ppml import Unconverter
+from zope.xmlpickle.registry import _readers
+
+# While an element is parsed, it has a frame on the stack:
+#
+#   [end, attrs, values, ready]
+#
+# end is the method that makes the element's value when the element
+# ends, from the attributes and the values of its children (or its
+# text).  ready, if not None, is called with the frame whenever a
+# child is added, which lets objects be created, and memoized, as
+# soon as their class and arguments are known, before their state is
+# loaded.  Lists and dictionaries are memoized before their items are
+# loaded, so their frames have a fifth slot, holding the container.
+
+
+def _memo_key(id):
+    # The same ids xmlPickler.put and xmlPickler.reference understand
+    prefix = id.rfind('.')
+    if prefix >= 0:
+        id = id[prefix+1:]
+    elif id[0] in 'io':
+        id = id[1:]
+    return int(id)
+
+
+def _instantiate(klass, args):
+    # What the OBJ opcode does
+    if (not args and type(klass) is ClassType
+        and not hasattr(klass, '__getinitargs__')):
+        return InstanceType(klass)
+    return klass(*args)
+
+
+class _Listitems(list):
+    pass
+
+class _Dictitems(list):
+    pass
+
+
+def _build(inst, state):
+    # What the BUILD opcode does
+    setstate = getattr(inst, '__setstate__', None)
+    if setstate is not None:
+        setstate(state)
+        return
+
+    slotstate = None
+    if type(state) is tuple and len(state) == 2:
+        state, slotstate = state
+    if state:
+        d = inst.__dict__
+        for k, v in state.iteritems():
+            if type(k) is str:
+                k = intern(k)
+            d[k] = v
+    if slotstate:
+        for k, v in slotstate.items():
+            setattr(inst, k, v)
+
+
+def _load_registered(self, frame):
+    # The end of the element of a class registered with
+    # registry.register, whose reader is in the frame's fifth slot
+    attrs = frame[1]
+    if frame[2]:
+        raise ValueError("registered elements have no content")
+    if 'id' in attrs:
+        attrs = dict(attrs)
+        return self._put(frame[4](attrs), {'id': attrs.pop('id')})
+    return frame[4](attrs)
+
+
+class XMLUnpickler(object):
+    """Load objects from XML pickles
+
+    Like pickle.Unpickler, an unpickler reads from a file, and
+    persistent_load can be set or overridden to load persistent
+    references:
+
+    >>> from cStringIO import StringIO
+    >>> from zope.xmlpickle import dumps
+    >>> XMLUnpickler(StringIO(dumps([42, 'spam']))).load()
+    [42, 'spam']
+
+    An XML string can also be loaded directly:
+
+    >>> XMLUnpickler().loads(dumps({'eggs': 1.5}))
+    {'eggs': 1.5}
+
+    or fed to the unpickler a chunk at a time, as it arrives, until it
+    is closed:
+
+    >>> u = XMLUnpickler()
+    >>> xml = dumps([42, 'spam'])
+    >>> for i in range(0, len(xml), 10):
+    ...     u.feed(xml[i:i+10])
+    >>> u.close()
+    [42, 'spam']
+    """
+
+    def __init__(self, file=None):
+        self._file = file
+        self.memo = {}
+        self._classes = {}
+        self._feeding = None    # The parser fed so far
+
+    def persistent_load(self, pid):
+        raise UnpicklingError(
+            "A load persistent id instruction was encountered,\n"
+            "but no persistent_load function was specified.")
+
+    def find_class(self, module, name):
+        try:
+            return self._classes[module, name]
+        except KeyError:
+            __import__(module)
+            klass = self._classes[module, name] = getattr(
+                sys.modules[module], name)
+            return klass
+
+    def load(self):
+        """Load an object from the XML read from the file"""
+        parser = self._parser()
+        parser.ParseFile(self._file)
+        return self._value()
+
+    def loads(self, xml):
+        """Load an object from an XML string"""
+        parser = self._parser()
+        if type(xml) is unicode:
+            xml = xml.encode('utf-8')
+        parser.Parse(xml, True)
+        return self._value()
+
+    def feed(self, data):
+        """Parse a chunk of XML"""
+        parser = self._feeding
+        if parser is None:
+            parser = self._feeding = self._parser()
+        if type(data) is unicode:
+            data = data.encode('utf-8')
+        parser.Parse(data, False)
+
+    def close(self):
+        """Load an object from the XML fed"""
+        parser = self._feeding or self._parser()
+        self._feeding = None
+        parser.Parse('', True)
+        return self._value()
+
+    def _parser(self):
+        self._stack = [[None, None, [], None]]
+        parser = expat.ParserCreate()
+        parser.returns_unicode = False
+        parser.buffer_text = True
+        parser.StartElementHandler = self.handle_starttag
+        parser.EndElementHandler = self.handle_endtag
+        parser.CharacterDataHandler = self.handle_data
+        return parser
+
+    def _value(self):
+        values = self._stack.pop()[2]
+        del self._stack
+        return values[0]
+
+    def handle_starttag(self, tag, attrs):
+        end = self.dispatch.get(tag)
+        if end is None:
+            reader = _readers.get(tag)
+            if reader is None:
+                raise ValueError(
+                    "unrecognized element in XML pickle: %r" % tag)
+            self._stack.append([_load_registered, attrs, [], None, reader])
+            return
+        start = self._starts.get(tag)
+        if start is None:
+            self._stack.append([end, attrs, [], None])
+        else:
+            self._stack.append(start(self, end, attrs))
+
+    def handle_endtag(self, tag):
+        stack = self._stack
+        frame = stack.pop()
+        value = frame[0](self, frame)
+        top = stack[-1]
+        top[2].append(value)
+        if top[3] is not None:
+            top[3](top)
+
+    def handle_data(self, data):
+        frame = self._stack[-1]
+        if data.strip() or frame[0] in self._text:
+            frame[2].append(data)
+
+    def _put(self, value, attrs):
+        id = attrs.get('id')
+        if id:
+            self.memo[_memo_key(id)] = value
+        return value
+
+    dispatch = {}
+    _starts = {}
+
+    def load_wrapper(self, frame):
+        return frame[2][0]
+    for tag in ('pickle', 'key', 'value', 'name', 'klass', 'state',
+                'arguments'):
+        dispatch[tag] = load_wrapper
+
+    def load_persistent(self, frame):
+        return self.persistent_load(frame[2][0])
+    dispatch['persistent'] = dispatch['persis'] = load_persistent
+
+    def load_none(self, frame):
+        return None
+    dispatch['none'] = load_none
+
+    def load_true(self, frame):
+        return True
+    dispatch['true'] = load_true
+
+    def load_false(self, frame):
+        return False
+    dispatch['false'] = load_false
+
+    def load_int(self, frame):
+        return int(''.join(frame[2]))
+    dispatch['int'] = load_int
+
+    def load_long(self, frame):
+        return long(''.join(frame[2]).strip(), 0)
+    dispatch['long'] = load_long
+
+    def load_float(self, frame):
+        return float(''.join(frame[2]))
+    dispatch['float'] = load_float
+
+    # The text of encoded strings is decoded as it is parsed, by an
+    # Unconverter in place of the list of values.
+
+    def start_string(self, end, attrs):
+        encoding = attrs.get('encoding')
+        if encoding:
+            return [end, attrs, Unconverter(encoding), None]
+        return [end, attrs, [], None]
+    _starts['string'] = _starts['unicode'] = start_string
+
+    def load_string(self, frame):
+        v = frame[2]
+        if v.__class__ is Unconverter:
+            v = v.value()
+        else:
+            v = ''.join(v)
+        return self._put(v, frame[1])
+    dispatch['string'] = load_string
+
+    def load_unicode(self, frame):
+        v = frame[2]
+        if v.__class__ is Unconverter:
+            v = v.value()
+        else:
+            v = ''.join(v)
+        return self._put(unicode(v, 'utf-8'), frame[1])
+    dispatch['unicode'] = load_unicode
+
+    _text = load_string, load_unicode
+
+    def load_tuple(self, frame):
+        values = frame[2]
+        if not values:
+            return ()
+        return self._put(tuple(values), frame[1])
+    dispatch['tuple'] = load_tuple
+
+    def load_set(self, frame):
+        return self._put(set(frame[2]), frame[1])
+    dispatch['set'] = load_set
+
+    def load_frozenset(self, frame):
+        return self._put(frozenset(frame[2]), frame[1])
+    dispatch['frozenset'] = load_frozenset
+
+    def load_listitems(self, frame):
+        return _Listitems(frame[2])
+    dispatch['listitems'] = load_listitems
+
+    def load_dictitems(self, frame):
+        return _Dictitems(frame[2])
+    dispatch['dictitems'] = load_dictitems
+
+    def start_list(self, end, attrs):
+        return [end, attrs, [], None, self._put([], attrs)]
+    _starts['list'] = start_list
+
+    def load_list(self, frame):
+        l = frame[4]
+        l.extend(frame[2])
+        return l
+    dispatch['list'] = load_list
+
+    def start_dictionary(self, end, attrs):
+        return [end, attrs, [], None, self._put({}, attrs)]
+    _starts['dictionary'] = _starts['attributes'] = start_dictionary
+
+    def load_dictionary(self, frame):
+        d = frame[4]
+        for key, value in frame[2]:
+            d[key] = value
+        return d
+    dispatch['dictionary'] = dispatch['attributes'] = load_dictionary
+
+    def load_item(self, frame, key_name='key'):
+        attrs = frame[1]
+        values = frame[2]
+        key = attrs.get(key_name)
+        if key is not None:
+            return self._put(key, attrs), values[0]
+        return values[0], values[1]
+    dispatch['item'] = load_item
+
+    def load_attribute(self, frame):
+        return self.load_item(frame, 'name')
+    dispatch['attribute'] = load_attribute
+
+    def load_reference(self, frame):
+        key = _memo_key(frame[1]['id'])
+        try:
+            return self.memo[key]
+        except KeyError:
+            raise BadPickleGet(key)
+    dispatch['reference'] = load_reference
+
+    def load_global(self, frame):
+        attrs = frame[1]
+        return self._put(self.find_class(attrs['module'], attrs['name']),
+                         attrs)
+    dispatch['global'] = load_global
+
+    # Objects are created once their class and arguments are known,
+    # and then replace them in their frame.
+
+    def _new(self, frame, inst):
+        frame[2][:] = [self._put(inst, frame[1])]
+        frame[3] = None
+
+    def ready_initialized_object(self, frame):
+        values = frame[2]
+        if len(values) == 2:
+            self._new(frame, _instantiate(values[0], values[1]))
+
+    def start_initialized_object(self, end, attrs):
+        return [end, attrs, [], self.ready_initialized_object]
+    _starts['initialized_object'] = start_initialized_object
+
+    def ready_new_object(self, frame):
+        values = frame[2]
+        if len(values) == 2:
+            klass = values[0]
+            self._new(frame, klass.__new__(klass, *values[1]))
+
+    def start_new_object(self, end, attrs):
+        return [end, attrs, [], self.ready_new_object]
+    _starts['new_object'] = start_new_object
+
+    def ready_object(self, frame):
+        self._new(frame, _reconstructor(frame[2][0], object, None))
+
+    def start_object(self, end, attrs):
+        return [end, attrs, [], self.ready_object]
+    _starts['object'] = start_object
+
+    def ready_classic_object(self, frame):
+        self._new(frame, _instantiate(frame[2][0], ()))
+
+    def start_classic_object(self, end, attrs):
+        return [end, attrs, [], self.ready_classic_object]
+    _starts['classic_object'] = start_classic_object
+
+    def load_object(self, frame):
+        if frame[3] is not None:
+            raise ValueError("object without a class or arguments")
+        values = frame[2]
+        inst = values[0]
+        for x in values[1:]:
+            c = x.__class__
+            if c is _Listitems:
+                # What APPENDS does
+                if isinstance(inst, list):
+                    list.extend(inst, x)
+                else:
+                    for item in x:
+                        inst.append(item)
+            elif c is _Dictitems:
+                for key, value in x:
+                    inst[key] = value
+            else:
+                _build(inst, x)
+        return inst
+    dispatch['initialized_object'] = dispatch['new_object'] = load_object
+    dispatch['object'] = dispatch['classic_object'] = load_object
+
+    del tag
@@ -17,14 +17,19 @@
 
 from xml.parsers import expat
 from cStringIO import StringIO
-from cPickle import loads as _standard_pickle_loads
+import mmap
 from pickle import \
      MARK as _MARK, \
      EMPTY_DICT as _EMPTY_DICT, \
      DICT as _DICT, \
      SETITEM as _SETITEM, \
      SETITEMS as _SETITEMS
+from zope.xmlpickle import compression as _compression
+from zope.xmlpickle import lazy as _lazy
 from zope.xmlpickle import ppml
+from zope.xmlpickle.pickler import ToXMLPickler, _sort_items
+from zope.xmlpickle.stats import _null
+from zope.xmlpickle.unpickler import XMLUnpickler
 import pickle
 
 
@@ -55,7 +60,7 @@ class _PicklerThatSortsDictItems(pickle.Pickler):
             write(_MARK)
 
         items = object.items()
-        items.sort()
+        _sort_items(items)
         for key, value in items:
             save(key)
             save(value)
@@ -75,7 +80,7 @@ def _dumpsUsing_PicklerThatSortsDictItems(object, bin = 0):
     return file.getvalue()
 
 
-def toxml(p, index=0):
+def toxml(p, index=0, stream_index=None, stats=None, pretty=True):
     """Convert a standard Python pickle to xml
 
     You can provide a pickle string and get XML of an individual pickle:
@@ -132,41 +137,438 @@ def toxml(p, index=0):
     the last pickle in the example above has a reference to the
     list pickled in the first pickle.
 
+    To get at a pickle, all of the pickles before it are read, unless
+    a zope.xmlpickle.streamindex.StreamIndex of the string is given:
+
+    >>> from zope.xmlpickle.streamindex import StreamIndex
+    >>> toxml(s, 2, StreamIndex.build(s)) == toxml(s, 2)
+    True
+
+    Rather than a string, a file, or a memory-mapped file, can be
+    given.  map_file() maps a file of pickles, so that large files can
+    be converted without reading them into memory:
+
+    >>> import os, tempfile
+    >>> fd, path = tempfile.mkstemp()
+    >>> os.write(fd, s)
+    30
+    >>> os.close(fd)
+    >>> toxml(map_file(path), 2) == toxml(s, 2)
+    True
+    >>> os.remove(path)
+
+    If pretty is false, the XML has no line breaks or indentation
+    between elements, which makes it smaller and quicker to parse:
+
+    >>> print toxml(s, 2, pretty=False)
+    <?xml version="1.0" encoding="utf-8" ?><pickle><list><int>42</int><reference id="o0"/></list></pickle>
+
+    Where the time goes can be recorded by passing a
+    zope.xmlpickle.stats.Stats object as stats.  This is true of all
+    of the conversion functions here.
     """
-    u = ppml.ToXMLUnpickler(StringIO(p))
+    if stream_index is not None:
+        return stream_index.toxml(p, index, stats, pretty)
+    r = []
+    _toxml(p, index, r.append, stats, pretty)
+    return ''.join(r)
+
+
+def _toxml(p, index, write, stats=None, pretty=True):
+    if stats is None:
+        stats = _null
+    u = stats.instrument(ppml.ToXMLUnpickler(_input(p)))
     while index > 0:
-        xmlob = u.load()
+        xmlob = stats.call('unpickle', u.load)
         index -= 1
-    xmlob = u.load()
-    r = ['<?xml version="1.0" encoding="utf-8" ?>\n']
-    xmlob.output(r.append)
-    return ''.join(r)
+    xmlob = stats.call('unpickle', u.load)
+    stats.call('output', _output, xmlob, write, pretty)
+
+
+def _input(p_or_file):
+    # Pickles are read from a file or a memory-mapped file as they are
+    if isinstance(p_or_file, str):
+        return StringIO(p_or_file)
+    return p_or_file
+
+
+def map_file(path):
+    """Map a file of pickles into memory, read-only
+
+    The result can be passed to toxml(), toxml_to(), iter_toxml() and
+    zope.xmlpickle.streamindex.StreamIndex in place of a string.  Only
+    the parts of the file that are converted are read, by the
+    operating system, and the pages read are shared by all of the
+    processes that map the file.
+    """
+    f = open(path, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def _output(xmlob, write, pretty=True):
+    if pretty:
+        write('<?xml version="1.0" encoding="utf-8" ?>\n')
+        xmlob.output(write)
+    else:
+        write('<?xml version="1.0" encoding="utf-8" ?>')
+        xmlob.output(ppml.Compact(write))
+
+
+def iter_toxml(p_or_file, stats=None, pretty=True):
+    """Convert each of the pickles in a string or file to xml
+
+    The pickles are read in a single pass, with one memo, and the XML
+    of each is the same as toxml() returns for its index:
+
+    >>> import pickle
+    >>> f = StringIO()
+    >>> pickler = pickle.Pickler(f)
+    >>> l = [1]
+    >>> pickler.dump(l)
+    >>> pickler.dump([42, l])
+    >>> s = f.getvalue()
+    >>> [xml == toxml(s, i) for i, xml in enumerate(iter_toxml(s))]
+    [True, True]
+
+    A file can be given instead of a string:
+
+    >>> f.seek(0)
+    >>> for xml in iter_toxml(f):
+    ...     print xml.strip()
+    <?xml version="1.0" encoding="utf-8" ?>
+    <pickle>
+      <list>
+        <int>1</int>
+      </list>
+    </pickle>
+    <?xml version="1.0" encoding="utf-8" ?>
+    <pickle>
+      <list>
+        <int>42</int>
+        <reference id="o0"/>
+      </list>
+    </pickle>
 
+    stats and pretty are as for toxml():
 
-def dumps(ob):
+    >>> compact = iter_toxml(s, pretty=False)
+    >>> [xml == toxml(s, i, pretty=False) for i, xml in enumerate(compact)]
+    [True, True]
+    """
+    if stats is None:
+        stats = _null
+    u = stats.instrument(ppml.ToXMLUnpickler(_input(p_or_file)))
+    while 1:
+        try:
+            xmlob = stats.call('unpickle', u.load)
+        except EOFError:
+            if u.stack:
+                # The last pickle was cut short
+                raise
+            return
+        r = []
+        stats.call('output', _output, xmlob, r.append, pretty)
+        yield ''.join(r)
+
+
+DEFAULT_BUFFER_SIZE = 1 << 16
+
+class _Buffer(object):
+    """Pass many small writes on to a file in blocks of about size bytes
+    """
+
+    def __init__(self, write, size):
+        self._write = write
+        self._size = size
+        self._data = []
+        self._len = 0
+
+    def write(self, s):
+        if len(s) >= self._size:
+            # No point in copying it
+            self.flush()
+            self._write(s)
+            return
+        self._data.append(s)
+        self._len += len(s)
+        if self._len >= self._size:
+            self.flush()
+
+    def flush(self):
+        if self._data:
+            self._write(''.join(self._data))
+            self._data = []
+            self._len = 0
+
+
+def toxml_to(p, file, index=0, buffer_size=DEFAULT_BUFFER_SIZE,
+             stats=None, pretty=True):
+    """Convert a standard Python pickle to xml written to a file
+
+    This is like toxml(), but the XML is written to a file, or anything
+    else with a write method, in blocks of about buffer_size bytes
+    rather than collected in a string:
+
+    >>> import pickle
+    >>> f = StringIO()
+    >>> toxml_to(pickle.dumps([1, 2]), f, buffer_size=10)
+    >>> f.getvalue() == toxml(pickle.dumps([1, 2]))
+    True
+
+    pretty is as for toxml().
+    """
+    buffer = _Buffer(file.write, buffer_size)
+    _toxml(p, index, buffer.write, stats, pretty)
+    buffer.flush()
+
+
+def dumps(ob, canonical=True, stats=None, binary_encoding='base64',
+          pretty=True, cache=None):
     """Serialize an object to XML
+
+    The XML is the same as toxml() makes of a pickle of the object,
+    but the object is written to XML directly.
+
+    Dictionary items are sorted by key, so equal objects give the
+    same XML.  If that isn't needed, canonical can be false to save
+    the sorting, and items are written in the order the dictionaries
+    have them.
+
+    Strings that can't be included in XML text as they are, are
+    encoded with binary_encoding, which may be 'base64' or, for small
+    strings of a few bytes, 'hex':
+
+    >>> print dumps('\\x00\\xff', binary_encoding='hex').strip()
+    <?xml version="1.0" encoding="utf-8" ?>
+    <pickle> <string encoding="hex">00ff</string> </pickle>
+
+    If pretty is false, the XML is written without line breaks and
+    indentation between elements, as toxml() does.
+
+    If cache is a zope.xmlpickle.cache.FragmentCache, the XML of
+    tuples and long strings is kept in it, and reused when they are
+    dumped again.
     """
-    p = _dumpsUsing_PicklerThatSortsDictItems(ob, 1)
-    return toxml(p)
+    if stats is None:
+        stats = _null
+    pickler = stats.instrument(ToXMLPickler(canonical, binary_encoding,
+                                            cache))
+    stats.call('pickle', pickler.dump, ob)
+    r = []
+    stats.call('output', pickler.output, r.append, pretty)
+    return ''.join(r)
 
 
-def fromxml(xml):
-    """Convert xml to a standard Python pickle
+def _open(file, mode):
+    # Open file if it's a path.  Returns the file and whether it was
+    # opened here.
+    if isinstance(file, basestring):
+        return open(file, mode), True
+    return file, False
+
+
+def dump(ob, file, buffer_size=DEFAULT_BUFFER_SIZE, canonical=True,
+         stats=None, binary_encoding='base64', pretty=True,
+         compression=None, cache=None):
+    """Serialize an object to XML written to a file
+
+    The XML is the same as dumps() returns, but it is written to a
+    file, or anything else with a write method, in blocks of about
+    buffer_size bytes as it is rendered:
+
+    >>> f = StringIO()
+    >>> dump({'a': [1, 2]}, f, buffer_size=10)
+    >>> f.getvalue() == dumps({'a': [1, 2]})
+    True
+
+    file can also be a path, which is opened, written and closed.
+
+    The XML is compressed a block at a time, as it is written, with
+    the codec named by compression: 'gzip', 'bz2', 'zlib' or 'xz'.  By
+    default, the codec is chosen by the extension of the file's name,
+    if it's .gz, .bz2, .zz or .xz, and otherwise the XML isn't
+    compressed.  load() detects the codec when it reads the file:
+
+    >>> f = StringIO()
+    >>> dump({'a': [1, 2]}, f, compression='gzip')
+    >>> f.getvalue()[:2] == '\\x1f\\x8b'
+    True
+    >>> f.seek(0)
+    >>> load(f)
+    {'a': [1, 2]}
+
+    canonical, binary_encoding, pretty and cache are as for dumps().
     """
-    handler = ppml.xmlPickler()
+    if stats is None:
+        stats = _null
+    pickler = stats.instrument(ToXMLPickler(canonical, binary_encoding,
+                                            cache))
+    stats.call('pickle', pickler.dump, ob)
+    file, opened = _open(file, 'wb')
+    try:
+        if compression is None:
+            compression = _compression.codec_of_path(
+                getattr(file, 'name', None) or '')
+        if compression is None:
+            out = file
+        else:
+            out = _compression.compressing(file, compression)
+        buffer = _Buffer(out.write, buffer_size)
+        stats.call('output', pickler.output, buffer.write, pretty)
+        buffer.flush()
+        if out is not file:
+            out.close()
+    finally:
+        if opened:
+            file.close()
+
+
+def iter_dumps(ob, buffer_size=DEFAULT_BUFFER_SIZE, canonical=True,
+               stats=None, binary_encoding='base64', pretty=True,
+               cache=None):
+    """Serialize an object to XML generated in blocks
+
+    The blocks, of about buffer_size bytes, add up to what dumps()
+    returns, and are rendered as they are asked for, so that they can
+    be sent, and the sender can wait for them to go, a block at a time:
+
+    >>> blocks = list(iter_dumps(range(5000), buffer_size=1000))
+    >>> len(blocks) > 1, ''.join(blocks) == dumps(range(5000))
+    (True, True)
+
+    The object is walked before the first block is generated.  The
+    other arguments are as for dump(), and generators can share a
+    cache while they are advanced in turn.  XMLUnpickler.feed parses
+    XML received a block at a time.
+    """
+    if stats is None:
+        stats = _null
+    pickler = stats.instrument(ToXMLPickler(canonical, binary_encoding,
+                                            cache))
+    stats.call('pickle', pickler.dump, ob)
+    parts = pickler.iter_output(pretty)
+    blocks = []
+    buffer = _Buffer(blocks.append, buffer_size)
+    while 1:
+        part = stats.call('output', next, parts, None)
+        if part is None:
+            break
+        buffer.write(part)
+        if blocks:
+            for block in blocks:
+                yield block
+            del blocks[:]
+    buffer.flush()
+    for block in blocks:
+        yield block
+
+
+def _parser(handler, buffer_size=DEFAULT_BUFFER_SIZE):
+    # Text is passed on in as few pieces as possible, undecoded
     parser = expat.ParserCreate()
+    parser.returns_unicode = False
+    parser.buffer_text = True
+    parser.buffer_size = buffer_size
     parser.CharacterDataHandler = handler.handle_data
     parser.StartElementHandler = handler.handle_starttag
     parser.EndElementHandler = handler.handle_endtag
-    parser.Parse(xml)
-    pickle = handler.get_value()
+    return parser
+
+
+def fromxml(xml, protocol=None, stats=None):
+    """Convert xml to a standard Python pickle
+
+    The pickle uses protocol 1 unless protocol 2, which makes smaller
+    pickles that load faster, is asked for:
+
+    >>> import cPickle
+    >>> xml = dumps([(1, 2), 2L**70])
+    >>> len(fromxml(xml)), len(fromxml(xml, protocol=2))
+    (35, 22)
+    >>> cPickle.loads(fromxml(xml, protocol=2))
+    [(1, 2), 1180591620717411303424L]
+
+    """
+    if stats is None:
+        stats = _null
+    handler = stats.instrument(ppml.xmlPickler(protocol))
+    parser = _parser(handler)
+    if type(xml) is unicode:
+        xml = xml.encode('utf-8')
+    stats.call('parse', parser.Parse, xml, True)
+    pickle = stats.call('join', handler.get_value)
     pickle = str(pickle)
     return pickle
 
 
-def loads(xml):
+def fromxml_file(input, output, buffer_size=DEFAULT_BUFFER_SIZE,
+                 protocol=None, stats=None):
+    """Convert xml read from a file to a pickle written to a file
+
+    The XML is read and parsed buffer_size bytes at a time, and the
+    pickle is written as the XML is parsed, so large documents can be
+    converted without holding either in memory:
+
+    >>> xml = dumps([1, 'spam', {'eggs': 2.5}])
+    >>> f = StringIO()
+    >>> fromxml_file(StringIO(xml), f, buffer_size=10)
+    >>> f.getvalue() == fromxml(xml)
+    True
+
+    The pickle protocol can be given as for fromxml().
+    """
+    if stats is None:
+        stats = _null
+    buffer = _Buffer(output.write, buffer_size)
+    handler = stats.instrument(
+        ppml.xmlStreamingPickler(buffer.write, protocol))
+    parser = _parser(handler, buffer_size)
+    stats.call('parse', _parse_file, parser, input, buffer_size)
+    buffer.flush()
+
+
+def _parse_file(parser, input, buffer_size):
+    while 1:
+        data = input.read(buffer_size)
+        if not data:
+            break
+        parser.Parse(data)
+    parser.Parse('', 1)
+
+
+def loads(xml, stats=None, lazy=False):
     """Create an object from serialized XML
+
+    The object is the same as cPickle.loads makes of fromxml(xml), but
+    it is built from the XML directly.  If lazy is true, the XML is
+    only indexed, and the object's lists and dictionaries are loaded
+    the first time they are used (see zope.xmlpickle.lazy).
+    """
+    if stats is None:
+        stats = _null
+    if lazy:
+        return stats.call('index', _lazy.load_lazily, xml)
+    return stats.call('parse', stats.instrument(XMLUnpickler()).loads, xml)
+
+
+def load(file, stats=None, compression=None):
+    """Create an object from serialized XML read from a file
+
+    file can also be a path, which is opened, read and closed.  If the
+    XML was compressed, by dump() or by gzip, bzip2, xz or zlib, it is
+    decompressed a block at a time as it is parsed.  The codec is
+    detected from the first bytes of the file, unless it is named by
+    compression.
     """
-    pickle = fromxml(xml)
-    ob = _standard_pickle_loads(pickle)
-    return ob
+    if stats is None:
+        stats = _null
+    file, opened = _open(file, 'rb')
+    try:
+        unpickler = XMLUnpickler(_compression.decompressing(file, compression))
+        return stats.call('parse', stats.instrument(unpickler).load)
+    finally:
+        if opened:
+            file.close()